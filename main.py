@@ -3,7 +3,8 @@ from rnn.build_model.build_model_lstm import build_model_lstm
 from rnn.build_model.build_model_cw import build_model_cw
 from rnn.build_model.build_model_soft import build_model_soft
 from rnn.build_model.build_model_hard import build_model_hard
-from rnn.datasets.dataset import get_minibatch
+from rnn.datasets.dataset import (get_minibatch, open_text_corpus,
+                                  has_indices, has_documents, is_procedural)
 from rnn.train import train_model
 from rnn.utils import parse_args
 from rnn.visualize import run_visualizations
@@ -21,27 +22,69 @@ if __name__ == "__main__":
     # Make sure we don't have skip_connections with only one hidden layer
     assert(not(args.skip_connections and args.layers == 1))
 
+    # A resumed training restores its own parameters
+    assert(not(args.resume_from and args.load_path))
+
+    # Overlapping minibatches need a corpus of indices
+    assert(not(args.tbptt_stride and (
+        not has_indices(dataset) or is_procedural(dataset) or
+        args.tbptt_stride > time_length)))
+
+    # The hard gates are random, their segments cannot be recomputed. The
+    # periods of the clockwork modules must divide the segments, and the
+    # training carries the states at the end of a segment
+    assert(not(args.checkpoint_every and (
+        rnn_type == "hard" or
+        (rnn_type == "clockwork" and
+         args.checkpoint_every % 2 ** (args.layers - 1)) or
+        args.tbptt_stride % args.checkpoint_every)))
+
     # Prepare data
+    if dataset == "mytext":
+        open_text_corpus(dataset, args.train_path, args.valid_path,
+                         args.test_path, args.document_separator)
+
+    # The minibatches of documents are not contiguous
+    assert(not(args.tbptt_stride and has_documents(dataset)))
+
+    # The data-parallel workers split the columns of a character corpus
+    assert(args.workers == 1 or (
+        has_indices(dataset) and not is_procedural(dataset) and
+        not has_documents(dataset) and not args.resume_from))
+
+    # The workers of a parameter server push dense gradients
+    assert(not(args.ps_address and (args.sparse_lookup or
+                                    args.resume_from)))
+    # Their checkpoints are saved with the parameters of the server, which
+    # are pulled every monitoring_freq batches
+    assert(not(args.ps_address and args.save_freq % args.monitoring_freq))
+    assert(0 <= args.worker < args.workers)
+
     train_stream, valid_stream = get_minibatch(
         dataset, mini_batch_size, mini_batch_size_valid,
-        time_length, args.tot_num_char)
+        time_length, args.tot_num_char, args.prefetch, args.batch_offsets,
+        args.procedural_batches, args.generation_workers,
+        args.tbptt_stride or None, args.bucket_batches)
 
     # Build the model
     gate_values = None
+    monitored_variables = []
     if rnn_type == "simple":
-        (cost, unregularized_cost, updates,
+        (cost, unregularized_cost, updates, train_updates,
             hidden_states) = build_model_vanilla(args)
     elif rnn_type == "clockwork":
-        cost, unregularized_cost, updates, hidden_states = build_model_cw(args)
+        (cost, unregularized_cost, updates, train_updates,
+         hidden_states) = build_model_cw(args)
     elif rnn_type == "lstm":
-        (cost, unregularized_cost, updates, gate_values,
+        (cost, unregularized_cost, updates, train_updates, gate_values,
          hidden_states) = build_model_lstm(args)
     elif rnn_type == "soft":
-        (cost, unregularized_cost, updates, gate_values,
+        (cost, unregularized_cost, updates, train_updates, gate_values,
          hidden_states) = build_model_soft(args)
     elif rnn_type == "hard":
-        (cost, unregularized_cost, updates,
+        (cost, unregularized_cost, updates, train_updates, skipped_ratios,
          hidden_states) = build_model_hard(args)
+        monitored_variables = skipped_ratios
     else:
         assert(False)
 
@@ -50,7 +93,9 @@ if __name__ == "__main__":
         train_model(cost, unregularized_cost, updates,
                     train_stream, valid_stream,
                     args,
-                    gate_values=gate_values)
+                    gate_values=gate_values,
+                    monitored_variables=monitored_variables,
+                    train_updates=train_updates)
     else:
         run_visualizations(cost, updates,
                            train_stream, valid_stream,
@@ -1,14 +1,21 @@
+import theano
 from theano import tensor
+from theano.ifelse import ifelse
 from theano.sandbox.rng_mrg import MRG_RandomStreams
 
-from blocks.bricks import Initializable, Tanh, Activation
+from blocks.bricks import Initializable, Linear, Tanh, Activation
 from blocks.bricks.base import application, lazy
-from blocks.bricks.recurrent import BaseRecurrent, recurrent
+from blocks.bricks.parallel import Fork
+from blocks.bricks.recurrent import (BaseRecurrent, recurrent,
+                                     RECURRENTSTACK_SEPARATOR)
 # from blocks.initialization import IsotropicGaussian, Constant
 from blocks.roles import add_role, WEIGHT, BIAS, INITIAL_STATE
 from blocks.utils import (
     check_theano_variable, shared_floatx_nans, shared_floatx_zeros)
 
+floatX = theano.config.floatX
+
+
 class LookupTable(Initializable):
 
     """Encapsulates representations of a range of integers.
@@ -57,7 +64,8 @@ class LookupTable(Initializable):
         Parameters
         ----------
         indices : :class:`~tensor.TensorVariable`
-            The indices of interest. The dtype must be integer.
+            The indices of interest. The dtype must be integer, compact
+            unsigned dtypes are widened inside the graph.
         Returns
         -------
         output : :class:`~tensor.TensorVariable`
@@ -66,10 +74,79 @@ class LookupTable(Initializable):
             `indices` parameter. The last dimension stands for the
             representation element.
         """
-        check_theano_variable(indices, None, "int")
+        check_theano_variable(indices, None, ("int", "uint"))
         output_shape = [indices.shape[i]
                         for i in range(indices.ndim)] + [self.dim]
-        return self.W[indices.flatten()].reshape(output_shape) + self.b
+        indices = tensor.cast(indices.flatten(), 'int64')
+        return self.W[indices].reshape(output_shape) + self.b
+
+
+class FusedLookupTable(Initializable):
+
+    """Several lookup tables of the same indices, gathered at once.
+
+    The tables are stored side by side in a single matrix and their biases
+    are folded into it, so one gather produces the representations of all
+    the outputs, which are then split into views.
+
+    Parameters
+    ----------
+    length : int
+        The size of the lookup tables.
+    dims : list of int
+        The dimensionality of the representations of each output.
+    Notes
+    -----
+    See :class:`.Initializable` for initialization parameters. The biases
+    are initialized with `biases_init` and added to the rows of the table.
+    """
+
+    @lazy(allocation=['length', 'dims'])
+    def __init__(self, length, dims, **kwargs):
+        super(FusedLookupTable, self).__init__(**kwargs)
+        self.length = length
+        self.dims = dims
+
+    @property
+    def W(self):
+        return self.parameters[0]
+
+    def _allocate(self):
+        W = shared_floatx_nans((self.length, sum(self.dims)),
+                               name='W_lookup')
+        self.parameters.append(W)
+        add_role(W, WEIGHT)
+
+    def _initialize(self):
+        self.weights_init.initialize(self.W, self.rng)
+        bias = self.biases_init.generate(self.rng, (sum(self.dims),))
+        self.W.set_value(self.W.get_value() + bias)
+
+    @application
+    def apply(self, indices):
+        """Perform lookup.
+        Parameters
+        ----------
+        indices : :class:`~tensor.TensorVariable`
+            The indices of interest. The dtype must be integer, compact
+            unsigned dtypes are widened inside the graph.
+        Returns
+        -------
+        outputs : list of :class:`~tensor.TensorVariable`
+            Representations for the indices of the query, one for each
+            element of `dims`.
+        """
+        check_theano_variable(indices, None, ("int", "uint"))
+        shape = [indices.shape[i] for i in range(indices.ndim)]
+        indices = tensor.cast(indices.flatten(), 'int64')
+        output = self.W[indices]
+        outputs = []
+        start = 0
+        for dim in self.dims:
+            outputs.append(
+                output[:, start:start + dim].reshape(shape + [dim]))
+            start += dim
+        return outputs
 
 
 # Very similar to the SimpleRecurrent implementation. But the computation is
@@ -132,19 +209,156 @@ class ClockworkBase(BaseRecurrent, Initializable):
             inputs + tensor.dot(states, self.W)),
             states)
 
-        if mask:
+        if mask is not None:
             next_states = (mask[:, None] * next_states +
                            (1 - mask[:, None]) * states)
 
         time = time + tensor.ones_like(time)
         return next_states, time
 
+    @recurrent(sequences=['inputs', 'mask'], states=['states'],
+               outputs=['states'], contexts=[])
+    def apply_active(self, inputs=None, states=None, mask=None):
+        """Apply the transition on the active time steps only.
+
+        The sequences only contain the steps where `time % period == 0`,
+        see :class:`ClockworkStack`.
+
+        """
+        next_states = self.children[0].apply(
+            inputs + tensor.dot(states, self.W))
+
+        if mask is not None:
+            next_states = (mask[:, None] * next_states +
+                           (1 - mask[:, None]) * states)
+        return next_states
+
     @application(outputs=apply.states)
     def initial_states(self, batch_size, *args, **kwargs):
         return [tensor.repeat(self.parameters[1][None, :], batch_size, 0),
                 self.parameters[2][None, :]]
 
 
+class ClockworkStack(Initializable):
+
+    """Stack of clockwork modules that skip their inactive time steps.
+
+    A module of period `p` only changes its state on the steps `t` such
+    that `t % p == 0` and copies it otherwise. Instead of computing every
+    step and discarding the result, each module is scanned over the
+    sequence `inputs[::p]` and its states are repeated `p` times to get
+    back to the full time resolution. The module of period `p` thus costs
+    `1 / p` of a full recurrence, including the projection of the states
+    of the module below.
+
+    The children and parameters are named as in a
+    :class:`~blocks.bricks.recurrent.RecurrentStack` of
+    :class:`ClockworkBase`, so the parameters of both models are
+    interchangeable.
+
+    Parameters
+    ----------
+    transitions : list of :class:`ClockworkBase`
+        The modules, from the bottom to the top.
+    skip_connections : bool
+        Whether each module receives its own inputs.
+
+    """
+
+    def __init__(self, transitions, skip_connections=False, **kwargs):
+        kwargs.setdefault('name', 'recurrentstack')
+        super(ClockworkStack, self).__init__(**kwargs)
+        for level, transition in enumerate(transitions):
+            transition.name += RECURRENTSTACK_SEPARATOR + str(level)
+        self.transitions = transitions
+        self.skip_connections = skip_connections
+        self.forks = [Fork(['inputs'], name='fork_' + str(level),
+                           prototype=Linear(use_bias=False))
+                      for level in range(1, len(transitions))]
+        self.children = self.transitions + self.forks
+
+    def _push_allocation_config(self):
+        for transition in self.transitions:
+            transition.push_allocation_config()
+        for level, fork in enumerate(self.forks):
+            fork.input_dim = self.transitions[level].get_dim('states')
+            fork.output_dims = self.transitions[level + 1].get_dims(
+                fork.output_names)
+
+    @staticmethod
+    def suffix(name, level):
+        if level == 0:
+            return name
+        return name + RECURRENTSTACK_SEPARATOR + str(level)
+
+    @application
+    def apply(self, mask=None, **kwargs):
+        """Apply the stack to whole sequences.
+
+        Parameters
+        ----------
+        mask : :class:`~tensor.TensorVariable`, optional
+            The 2D mask, in the shape (time, batch).
+        \*\*kwargs
+            The inputs (`inputs`, `inputs#1`...) in the shape
+            (time, batch, features) and the initial states (`states`,
+            `states#1`...) in the shape (batch, features) of each level.
+
+        Returns
+        -------
+        list of :class:`~tensor.TensorVariable`
+            The states of each level, in the shape (time, batch, features).
+
+        """
+        length = kwargs['inputs'].shape[0]
+        results = []
+        for level, transition in enumerate(self.transitions):
+            period = transition.period
+            inputs = kwargs.get(self.suffix('inputs', level))
+            if inputs is not None:
+                inputs = inputs[::period]
+            if level > 0:
+                below = self.forks[level - 1].apply(
+                    results[-1][::period], as_list=True)[0]
+                inputs = below if inputs is None else inputs + below
+            layer_mask = None
+            if mask is not None:
+                layer_mask = mask[::period]
+
+            states = transition.apply_active(
+                inputs=inputs, mask=layer_mask,
+                states=kwargs[self.suffix('states', level)])
+            if period > 1:
+                states = tensor.repeat(states, period, axis=0)[:length]
+            results.append(states)
+        return results
+
+
+def gate_input_projection(mlp, inputs, dim):
+    """Contribution of the inputs to the first layer of a gate MLP.
+
+    The MLP of a gated transition is applied to the concatenation of the
+    inputs and the states, so its first layer splits into an input part,
+    which can be computed for all the time steps before the recurrence,
+    and a state part, see :func:`gate_from_projection`.
+
+    """
+    first_layer = mlp.linear_transformations[0]
+    return tensor.dot(inputs, first_layer.W[:dim]) + first_layer.b
+
+
+def gate_from_projection(mlp, gate_inputs, states, dim):
+    """Output of a gate MLP, given the projection of its inputs."""
+    first_layer = mlp.linear_transformations[0]
+    hidden = gate_inputs + tensor.dot(states, first_layer.W[dim:])
+    for i, activation in enumerate(mlp.activations):
+        if i > 0:
+            hidden = mlp.linear_transformations[i].apply(hidden)
+        if activation is not None:
+            hidden = activation.apply(hidden)
+    return hidden
+
+
 class SoftGatedRecurrent(BaseRecurrent, Initializable):
 
     @lazy(allocation=['dim'])
@@ -188,9 +402,29 @@ class SoftGatedRecurrent(BaseRecurrent, Initializable):
     def _initialize(self):
         self.weights_init.initialize(self.state_to_state, self.rng)
 
-    @recurrent(sequences=['mask', 'inputs'], states=['states'],
-               outputs=['states', "gate_value"], contexts=[])
-    def apply(self, inputs, states, mask=None):
+    @application(sequences=['mask', 'inputs'], states=['states'],
+                 outputs=['states', "gate_value"], contexts=[])
+    def apply(self, inputs, states=None, mask=None, **kwargs):
+        """Apply the gated recurrent transition.
+
+        The input part of the gate MLP is computed for the whole sequence
+        at once, outside of the recurrence, see :meth:`apply_gated`. The
+        other keyword arguments (`iterate`...) are those of
+        :func:`~blocks.bricks.recurrent.recurrent`.
+
+        """
+        # The recurrent wrapper takes an explicit None for a given state,
+        # the initial states are only used when `states` is not passed
+        if states is not None:
+            kwargs['states'] = states
+        gate_inputs = gate_input_projection(self.mlp, inputs, self.dim)
+        return self.apply_gated(inputs=inputs, gate_inputs=gate_inputs,
+                                mask=mask, **kwargs)
+
+    @recurrent(sequences=['mask', 'inputs', 'gate_inputs'],
+               states=['states'], outputs=['states', "gate_value"],
+               contexts=[])
+    def apply_gated(self, inputs, gate_inputs, states, mask=None):
         """Apply the gated recurrent transition.
         Parameters
         ----------
@@ -200,6 +434,9 @@ class SoftGatedRecurrent(BaseRecurrent, Initializable):
         inputs : :class:`~tensor.TensorVariable`
             The 2 dimensional matrix of inputs in the shape (batch_size,
             dim)
+        gate_inputs : :class:`~tensor.TensorVariable`
+            The contribution of the inputs to the first layer of the gate
+            MLP, see :func:`gate_input_projection`.
         mask : :class:`~tensor.TensorVariable`
             A 1D binary array in the shape (batch,) which is 1 if there is
             data available, 0 if not. Assumed to be 1-s only if not given.
@@ -208,11 +445,9 @@ class SoftGatedRecurrent(BaseRecurrent, Initializable):
         output : :class:`~tensor.TensorVariable`
             Next states of the network.
         """
-        # Concatenate the inputs of the MLP
-        mlp_input = tensor.concatenate((inputs, states), axis=1)
-
         # Compute the output of the MLP
-        gate_value = self.mlp.apply(mlp_input)
+        gate_value = gate_from_projection(self.mlp, gate_inputs, states,
+                                          self.dim)
 
         # TODO: Find a way to remove the following "hack".
         # Simply removing the two next lines won't work
@@ -227,7 +462,7 @@ class SoftGatedRecurrent(BaseRecurrent, Initializable):
         next_states = (next_states * gate_value +
                        states * (1 - gate_value))
 
-        if mask:
+        if mask is not None:
             next_states = (mask[:, None] * next_states +
                            (1 - mask[:, None]) * states)
         return next_states, gate_value
@@ -270,6 +505,8 @@ class HardGatedRecurrent(BaseRecurrent, Initializable):
             return 0
         if name in ['inputs', 'states']:
             return self.dim
+        if name == 'skipped':
+            return 0
         return super(HardGatedRecurrent, self).get_dim(name)
 
     def _allocate(self):
@@ -283,10 +520,41 @@ class HardGatedRecurrent(BaseRecurrent, Initializable):
     def _initialize(self):
         self.weights_init.initialize(self.state_to_state, self.rng)
 
-    @recurrent(sequences=['mask', 'inputs'],
-               states=['states'], outputs=['states'], contexts=[])
-    def apply(self, inputs, states, mask=None):
+    @application(sequences=['mask', 'inputs'], states=['states'],
+                 outputs=['states', 'skipped'], contexts=[])
+    def apply(self, inputs, states=None, mask=None, **kwargs):
+        """Apply the gated recurrent transition.
+
+        The input part of the gate MLP is computed for the whole sequence
+        at once, outside of the recurrence, see :meth:`apply_gated`. The
+        other keyword arguments (`iterate`...) are those of
+        :func:`~blocks.bricks.recurrent.recurrent`.
+
+        """
+        # The recurrent wrapper takes an explicit None for a given state,
+        # the initial states are only used when `states` is not passed
+        if states is not None:
+            kwargs['states'] = states
+        gate_inputs = gate_input_projection(self.mlp, inputs, self.dim)
+        # A single random threshold for the gates of each time step
+        if kwargs.get('iterate', True):
+            random = self.randomstream.uniform((inputs.shape[0],))
+        else:
+            random = self.randomstream.uniform((1,))[0]
+        return self.apply_gated(inputs=inputs, gate_inputs=gate_inputs,
+                                random=random, mask=mask, **kwargs)
+
+    @recurrent(sequences=['mask', 'inputs', 'gate_inputs', 'random'],
+               states=['states'], outputs=['states', 'skipped'],
+               contexts=[])
+    def apply_gated(self, inputs, gate_inputs, random, states, mask=None):
         """Apply the gated recurrent transition.
+
+        Only the rows whose gate is open are updated, the recurrent matrix
+        product of the other rows is not computed. If all the gates are
+        closed, the whole step is skipped. This gives the states of
+        `switch(random <= gate_value, next_states, states)`.
+
         Parameters
         ----------
         states : :class:`~tensor.TensorVariable`
@@ -295,6 +563,11 @@ class HardGatedRecurrent(BaseRecurrent, Initializable):
         inputs : :class:`~tensor.TensorVariable`
             The 2 dimensional matrix of inputs in the shape (batch_size,
             dim)
+        gate_inputs : :class:`~tensor.TensorVariable`
+            The contribution of the inputs to the first layer of the gate
+            MLP, see :func:`gate_input_projection`.
+        random : :class:`~tensor.TensorVariable`
+            The scalar threshold of the gates, drawn uniformly in [0, 1).
         mask : :class:`~tensor.TensorVariable`
             A 1D binary array in the shape (batch,) which is 1 if there is
             data available, 0 if not. Assumed to be 1-s only if not given.
@@ -302,36 +575,39 @@ class HardGatedRecurrent(BaseRecurrent, Initializable):
         -------
         output : :class:`~tensor.TensorVariable`
             Next states of the network.
+        skipped : :class:`~tensor.TensorVariable`
+            The number of rows inside the mask which were not updated.
         """
-        # Concatenate the inputs of the MLP
-        mlp_input = tensor.concatenate((inputs, states), axis=1)
-
         # Compute the output of the MLP
-        gate_value = self.mlp.apply(mlp_input)
-        random = self.randomstream.uniform((1,))
-
-        # TODO: Find a way to remove the following "hack".
-        # Simply removing the two next lines won't work
-        gate_value = gate_value[:, 0]
-        gate_value = gate_value[:, None]
-
-        # Compute the next_states value, before gating
-        next_states = self.activation.apply(
-            states.dot(self.state_to_state) + inputs)
-
-        # Apply the gating
-        next_states = tensor.switch(tensor.le(random[0], gate_value),
-                                    next_states,
-                                    states)
-
-        if mask:
-            next_states = (mask[:, None] * next_states +
-                           (1 - mask[:, None]) * states)
-        return next_states
+        gate_value = gate_from_projection(self.mlp, gate_inputs, states,
+                                          self.dim)[:, 0]
+
+        # The rows to update, the masked rows keep their states as well
+        opened = tensor.le(random, gate_value)
+        if mask is not None:
+            valid = tensor.gt(mask, 0)
+            opened = opened * valid
+            skipped = valid.sum() - opened.sum()
+        else:
+            skipped = opened.shape[0] - opened.sum()
+        rows = opened.nonzero()[0]
+
+        # Compute the next_states value of the opened rows only. The product
+        # is written transposed: the scan gradient moves the accumulation
+        # of `dot(states[rows].T, gradient)` out of the loop, which needs
+        # the same number of rows at each step
+        updated = self.activation.apply(
+            tensor.dot(self.state_to_state.T, states[rows].T).T +
+            inputs[rows])
+        next_states = ifelse(tensor.any(opened),
+                             tensor.set_subtensor(states[rows], updated),
+                             states)
+
+        return next_states, tensor.cast(skipped, floatX)
 
     @application(outputs=apply.states)
     def initial_states(self, batch_size, *args, **kwargs):
-        return [tensor.repeat(self.parameters[2][None, :], batch_size, 0)]
+        return [tensor.repeat(self.parameters[1][None, :], batch_size, 0)]
 
 
 class LSTM(BaseRecurrent, Initializable):
@@ -373,10 +649,15 @@ class LSTM(BaseRecurrent, Initializable):
     def _initialize(self):
         self.weights_init.initialize(self.parameters[0], self.rng)
 
-    @recurrent(sequences=['inputs', 'mask'], states=['states', 'cells'],
-               contexts=[], outputs=['states', 'cells', 'in_gate',
-                                     'forget_gate', 'out_gate'])
-    def apply(self, inputs, states, cells, mask=None):
+    def step(self, inputs, states, cells, mask=None):
+        """One step of the LSTM, with the values of its gates.
+
+        Returns
+        -------
+        tuple of :class:`~tensor.TensorVariable`
+            The next states and cells, the input, forget and output gates.
+
+        """
         def slice_last(x, no):
             return x[:, no * self.dim: (no + 1) * self.dim]
 
@@ -390,18 +671,52 @@ class LSTM(BaseRecurrent, Initializable):
         out_gate = tensor.nnet.sigmoid(slice_last(activation, 2))
         next_states = out_gate * nonlinearity(next_cells)
 
-        if mask:
+        # The padded steps keep both the states and the cells
+        if mask is not None:
             next_states = (mask[:, None] * next_states +
                            (1 - mask[:, None]) * states)
+            next_cells = (mask[:, None] * next_cells +
+                          (1 - mask[:, None]) * cells)
 
         return next_states, next_cells, in_gate, forget_gate, out_gate
 
+    @recurrent(sequences=['inputs', 'mask'], states=['states', 'cells'],
+               contexts=[], outputs=['states', 'cells'])
+    def apply(self, inputs, states, cells, mask=None):
+        """Apply the LSTM transition.
+
+        Only the states and cells are returned, so that the scan does not
+        store the gates of every time step. See :class:`AnalysisLSTM`.
+
+        """
+        return self.step(inputs, states, cells, mask)[:2]
+
     @application(outputs=apply.states)
     def initial_states(self, batch_size, *args, **kwargs):
         return [tensor.repeat(self.initial_state_[None, :], batch_size, 0),
                 tensor.repeat(self.initial_cells[None, :], batch_size, 0)]
 
 
+class AnalysisLSTM(LSTM):
+
+    """LSTM which also returns the values of its gates.
+
+    The parameters are the same as those of :class:`LSTM`, and so are
+    their names, so a trained LSTM can be loaded to analyse its gates.
+
+    """
+
+    def __init__(self, dim, activation=None, **kwargs):
+        kwargs.setdefault('name', 'lstm')
+        super(AnalysisLSTM, self).__init__(dim, activation, **kwargs)
+
+    @recurrent(sequences=['inputs', 'mask'], states=['states', 'cells'],
+               contexts=[], outputs=['states', 'cells', 'in_gate',
+                                     'forget_gate', 'out_gate'])
+    def apply(self, inputs, states, cells, mask=None):
+        return self.step(inputs, states, cells, mask)
+
+
 class HardLogistic(Activation):
 
     @application(inputs=['input_'], outputs=['output'])
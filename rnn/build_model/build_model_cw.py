@@ -4,12 +4,14 @@ import theano
 from theano import tensor
 
 from blocks.bricks import Tanh
-from blocks.bricks.recurrent import RecurrentStack
 
-from rnn.bricks import ClockworkBase
-from rnn.build_model.build_model_utils import (get_prernn, get_presoft,
+from rnn.bricks import ClockworkBase, ClockworkStack
+from rnn.build_model.build_model_utils import (get_prernn,
                                                get_rnn_kwargs, get_costs,
-                                               initialize_rnn)
+                                               get_checkpointed_costs,
+                                               get_state_updates,
+                                               initialize_rnn,
+                                               is_checkpointed)
 
 
 floatX = theano.config.floatX
@@ -38,48 +40,52 @@ def build_model_cw(args, dtype=floatX):
     else:
         assert False
 
-    rnn = RecurrentStack(transitions, skip_connections=args.skip_connections)
+    # Each module only computes the time steps where it is active
+    rnn = ClockworkStack(transitions, skip_connections=args.skip_connections)
     initialize_rnn(rnn, args)
 
     # Prepare inputs and initial states for the RNN
     kwargs, inits = get_rnn_kwargs(pre_rnn, args)
 
-    # Apply the RNN to the inputs
-    h = rnn.apply(low_memory=True, mask=x_mask, **kwargs)
-
-    # In the Clockwork case:
-    # h = [state, time, state_1, time_1 ...]
-    h = h[::2]
-
-    # Now we have correctly:
-    # h = [state, state_1, state_2 ...] if args.layers > 1
-    # h = [state] if args.layers == 1
-
-    # If we have skip connections, concatenate all the states
-    # Else only consider the state of the highest layer
-    last_states = {}
+    def apply_rnn(mask, **kwargs):
+        # Apply the RNN to the inputs
+        h = rnn.apply(mask=mask, as_list=True, **kwargs)
+
+        # h = [state, state_1, state_2 ...] if args.layers > 1
+        # h = [state] if args.layers == 1
+
+        # If we have skip connections, concatenate all the states
+        # Else only consider the state of the highest layer
+        if args.layers > 1:
+            # Save all the states, to carry the last ones
+            states = []
+            for d in range(args.layers):
+                h[d].name = "hidden_state_" + str(d)
+                states.append(h[d])
+            h = tensor.concatenate(h, axis=2)
+        else:
+            states = h
+            h = h[0]
+        h.name = "hidden_state_all"
+        return states, h
+
+    states, h = apply_rnn(x_mask, **kwargs)
     hidden_states = []
     if args.layers > 1:
-        # Save all the last states
-        for d in range(args.layers):
-            # TODO correct the bug
-            # h[d] = h[d] * x_mask
-            last_states[d] = h[d][-1, :, :]
-            h[d].name = "hidden_state_" + str(d)
-            hidden_states.append(h[d])
-        h = tensor.concatenate(h, axis=2)
+        hidden_states = states
+
+    if is_checkpointed(args):
+        # The states are only stored at the end of each segment
+        cost, unregularized_cost, boundaries = get_checkpointed_costs(
+            apply_rnn, kwargs, h, x_mask, args)
     else:
-        h = h[0] * x_mask
-        last_states[0] = h[-1, :, :]
-    h.name = "hidden_state_all"
+        cost, unregularized_cost = get_costs(h, x_mask, args)
+        boundaries = None
 
     # The updates of the hidden states
-    updates = []
-    for d in range(args.layers):
-        updates.append((inits[0][d], last_states[d]))
-
-    presoft = get_presoft(h, args)
-
-    cost, unregularized_cost = get_costs(presoft, args)
+    updates, train_updates = get_state_updates(
+        [(inits[0][d], states[d]) for d in range(args.layers)], args,
+        boundaries)
 
-    return cost, unregularized_cost, updates, hidden_states
+    return (cost, unregularized_cost, updates, train_updates,
+            hidden_states)
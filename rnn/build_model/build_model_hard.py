@@ -1,157 +1,87 @@
 import logging
-from collections import OrderedDict
 
-import numpy
 import theano
 from theano import tensor
 
 from blocks import initialization
-from blocks.bricks import (Linear, Tanh, Softmax,
-                           FeedforwardSequence, MLP, Logistic)
-from blocks.bricks.parallel import Fork
+from blocks.bricks import Tanh, MLP, Logistic
 from blocks.bricks.recurrent import SimpleRecurrent, RecurrentStack
 
-from rnn.bricks import LookupTable, HardGatedRecurrent
+from rnn.bricks import HardGatedRecurrent
+from rnn.build_model.build_model_utils import (get_prernn,
+                                               get_rnn_kwargs, get_costs,
+                                               get_state_updates,
+                                               initialize_rnn)
 
 floatX = theano.config.floatX
 logging.basicConfig(level='INFO')
 logger = logging.getLogger(__name__)
 
 
-def build_model_hard(vocab_size, args, dtype=floatX):
+def build_model_hard(args, dtype=floatX):
     logger.info('Building model ...')
 
-    # Parameters for the model
-    context = args.context
-    state_dim = args.state_dim
-    layers = args.layers
-    skip_connections = args.skip_connections
-
-    # Symbolic variables
-    # In both cases: Time X Batch
-    x = tensor.lmatrix('features')
-    y = tensor.lmatrix('targets')
-
-    # Build the model
-    output_names = []
-    output_dims = []
-    for d in range(layers):
-        if d > 0:
-            suffix = '_' + str(d)
-        else:
-            suffix = ''
-        if d == 0 or skip_connections:
-            output_names.append("inputs" + suffix)
-            output_dims.append(state_dim)
-
-    lookup = LookupTable(length=vocab_size, dim=state_dim)
-    lookup.weights_init = initialization.IsotropicGaussian(0.1)
-    lookup.biases_init = initialization.Constant(0)
-
-    fork = Fork(output_names=output_names, input_dim=args.mini_batch_size,
-                output_dims=output_dims,
-                prototype=FeedforwardSequence(
-                    [lookup.apply]))
-
-    transitions = [SimpleRecurrent(dim=state_dim, activation=Tanh())]
-    for i in range(layers - 1):
-        mlp = MLP(activations=[Logistic()], dims=[2 * state_dim, 1],
+    # Return list of 3D Tensor, one for each layer
+    # (Time X Batch X embedding_dim)
+    pre_rnn, x_mask = get_prernn(args)
+
+    transitions = [SimpleRecurrent(dim=args.state_dim, activation=Tanh())]
+    for i in range(args.layers - 1):
+        mlp = MLP(activations=[Logistic()], dims=[2 * args.state_dim, 1],
                   weights_init=initialization.IsotropicGaussian(0.1),
                   biases_init=initialization.Constant(0),
                   name="mlp_" + str(i))
         transitions.append(
-            HardGatedRecurrent(dim=state_dim,
+            HardGatedRecurrent(dim=args.state_dim,
                                mlp=mlp,
                                activation=Tanh()))
 
-    rnn = RecurrentStack(transitions, skip_connections=skip_connections)
+    rnn = RecurrentStack(transitions, skip_connections=args.skip_connections)
+    initialize_rnn(rnn, args)
 
-    # dim = layers * state_dim
-    output_layer = Linear(
-        input_dim=layers * state_dim,
-        output_dim=vocab_size, name="output_layer")
+    # Prepare inputs and initial states for the RNN
+    kwargs, inits = get_rnn_kwargs(pre_rnn, args)
 
-    # Return list of 3D Tensor, one for each layer
-    # (Time X Batch X embedding_dim)
-    pre_rnn = fork.apply(x)
-
-    # Give a name to the input of each layer
-    if skip_connections:
-        for t in range(len(pre_rnn)):
-            pre_rnn[t].name = "pre_rnn_" + str(t)
-    else:
-        pre_rnn.name = "pre_rnn"
-
-    # Prepare inputs for the RNN
-    kwargs = OrderedDict()
-    init_states = {}
-    for d in range(layers):
-        if d > 0:
-            suffix = '_' + str(d)
-        else:
-            suffix = ''
-        if skip_connections:
-            kwargs['inputs' + suffix] = pre_rnn[d]
-        elif d == 0:
-            kwargs['inputs' + suffix] = pre_rnn
-        init_states[d] = theano.shared(
-            numpy.zeros((args.mini_batch_size, state_dim)).astype(floatX),
-            name='state0_%d' % d)
-        kwargs['states' + suffix] = init_states[d]
-
-    # Apply the RNN to the inputs
-    h = rnn.apply(low_memory=True, **kwargs)
-
-    # Now we have correctly:
-    # h = [state_1, state_2, state_3 ...]
-
-    # Save all the last states
+    # Apply the RNN to the inputs, one layer after the other so that each
+    # gated layer computes the input part of its gate for all the time steps
+    h = rnn.apply(mask=x_mask, **kwargs)
+
+    # Now we have:
+    # h = [state, state_1, skipped_1, state_2, skipped_2, state_3, ...]
+
+    # Extract the fraction of skipped updates of each gated layer, among
+    # the positions inside the mask
+    positions = tensor.maximum(x_mask.sum(), 1)
+    skipped_ratios = []
+    for i, skipped in enumerate(h[2::2]):
+        skipped_ratio = skipped.sum() / positions
+        skipped_ratio.name = "skipped_ratio_" + str(i + 1)
+        skipped_ratios.append(skipped_ratio)
+    new_h = [h[0]]
+    new_h.extend(h[1::2])
+    h = new_h
+
+    # Now we have:
+    # h = [state, state_1, state_2, ...]
+
+    # Save all the states, to carry the last ones
     last_states = {}
     hidden_states = []
-    for d in range(layers):
-        last_states[d] = h[d][-1, :, :]
-        h[d].name = "hiddens_state_" + str(d)
+    for d in range(args.layers):
+        last_states[d] = h[d]
+        h[d].name = "hidden_state_" + str(d)
         hidden_states.append(h[d])
 
     # Concatenate all the states
-    if layers > 1:
+    if args.layers > 1:
         h = tensor.concatenate(h, axis=2)
     h.name = "hidden_state_all"
 
     # The updates of the hidden states
-    updates = []
-    for d in range(layers):
-        updates.append((init_states[d], last_states[d]))
-
-    presoft = output_layer.apply(h[context:, :, :])
-    # Define the cost
-    # Compute the probability distribution
-    time, batch, feat = presoft.shape
-    presoft.name = 'presoft'
-
-    cross_entropy = Softmax().categorical_cross_entropy(
-        y[context:, :].flatten(),
-        presoft.reshape((batch * time, feat)))
-    cross_entropy = cross_entropy / tensor.log(2)
-    cross_entropy.name = "cross_entropy"
-
-    # TODO: add regularisation for the cost
-    # the log(1) is here in order to differentiate the two variables
-    # for monitoring
-    cost = cross_entropy + tensor.log(1)
-    cost.name = "regularized_cost"
-
-    # Initialize the model
-    logger.info('Initializing...')
-
-    fork.initialize()
-
-    rnn.weights_init = initialization.Orthogonal()
-    rnn.biases_init = initialization.Constant(0)
-    rnn.initialize()
-
-    output_layer.weights_init = initialization.IsotropicGaussian(0.1)
-    output_layer.biases_init = initialization.Constant(0)
-    output_layer.initialize()
-
-    return cost, cross_entropy, updates, hidden_states
+    updates, train_updates = get_state_updates(
+        [(inits[0][d], last_states[d]) for d in range(args.layers)], args)
+
+    cost, cross_entropy = get_costs(h, x_mask, args)
+
+    return (cost, cross_entropy, updates, train_updates, skipped_ratios,
+            hidden_states)
@@ -6,11 +6,14 @@ from theano import tensor
 from blocks.bricks import Tanh
 from blocks.bricks.recurrent import RecurrentStack
 
-from rnn.build_model.build_model_utils import (get_prernn, get_presoft,
+from rnn.build_model.build_model_utils import (get_prernn,
                                                get_rnn_kwargs, get_costs,
-                                               initialize_rnn)
+                                               get_checkpointed_costs,
+                                               get_state_updates,
+                                               initialize_rnn,
+                                               is_checkpointed)
 
-from rnn.bricks import LSTM
+from rnn.bricks import LSTM, AnalysisLSTM
 
 
 floatX = theano.config.floatX
@@ -25,8 +28,16 @@ def build_model_lstm(args, dtype=floatX):
     # (Time X Batch X embedding_dim)
     pre_rnn, x_mask = get_prernn(args)
 
-    transitions = [LSTM(dim=args.state_dim, activation=Tanh())
+    # Only the visualization of the gates needs their values, the training
+    # graph does not store them
+    analysis = args.visualize == "gates"
+    if analysis:
+        transition = AnalysisLSTM
+    else:
+        transition = LSTM
+    transitions = [transition(dim=args.state_dim, activation=Tanh())
                    for _ in range(args.layers)]
+    outputs = len(transitions[0].apply.outputs)
 
     rnn = RecurrentStack(transitions, skip_connections=args.skip_connections)
     initialize_rnn(rnn, args)
@@ -34,66 +45,64 @@ def build_model_lstm(args, dtype=floatX):
     # Prepare inputs and initial states for the RNN
     kwargs, inits = get_rnn_kwargs(pre_rnn, args)
 
-    # Apply the RNN to the inputs
-    h = rnn.apply(mask=x_mask, **kwargs)
-
-    # h = [state, cell, in, forget, out, state_1,
-    #        cell_1, in_1, forget_1, out_1 ...]
-
-    last_states = {}
-    last_cells = {}
-    hidden_states = []
-    for d in range(args.layers):
-        # TODO correct bug
-        # h[5 * d] = h[5 * d] * x_mask
-        # h[5 * d + 1] = h[5 * d + 1] * x_mask
-
-        last_states[d] = h[5 * d][-1, :, :]
-        last_cells[d] = h[5 * d + 1][-1, :, :]
-
-        h[5 * d].name = "hidden_state_" + str(d)
-        h[5 * d + 1].name = "hidden_cell_" + str(d)
-        hidden_states.extend([h[5 * d], h[5 * d + 1]])
-
-    # The updates of the hidden states
-    # Note: if we have mask, then updating initial state
-    # with last state does not make sence anymore.
-    updates = []
-    for d in range(args.layers):
-        updates.append((inits[0][d], last_states[d]))
-        updates.append((inits[1][d], last_states[d]))
-
-    # h = [state, cell, in, forget, out, state_1,
-    #        cell_1, in_1, forget_1, out_1 ...]
-
-    # Extract the values
-    in_gates = h[2::5]
-    forget_gates = h[3::5]
-    out_gates = h[4::5]
-
-    gate_values = {"in_gates": in_gates,
-                   "forget_gates": forget_gates,
-                   "out_gates": out_gates}
-
-    h = h[::5]
+    def apply_rnn(mask, **kwargs):
+        # Apply the RNN to the inputs
+        h = rnn.apply(low_memory=True, mask=mask, **kwargs)
+
+        # h = [state, cell, state_1, cell_1 ...]
+        # or in analysis mode:
+        # h = [state, cell, in, forget, out, state_1,
+        #        cell_1, in_1, forget_1, out_1 ...]
+
+        # Note: the masked steps keep the states of the previous step
+        states = []
+        for d in range(args.layers):
+            h[outputs * d].name = "hidden_state_" + str(d)
+            h[outputs * d + 1].name = "hidden_cell_" + str(d)
+            states.extend([h[outputs * d], h[outputs * d + 1]])
+
+        # Extract the values
+        gate_values = None
+        if analysis:
+            gate_values = {"in_gates": h[2::outputs],
+                           "forget_gates": h[3::outputs],
+                           "out_gates": h[4::outputs]}
+
+        h = h[::outputs]
+
+        # Now we have correctly:
+        # h = [state, state_1, state_2 ...] if args.layers > 1
+        # h = [state] if args.layers == 1
+
+        # If we have skip connections, concatenate all the states
+        # Else only consider the state of the highest layer
+        if args.layers > 1:
+            if args.skip_connections or args.skip_output:
+                h = tensor.concatenate(h, axis=2)
+            else:
+                h = h[-1]
+        else:
+            h = h[0]
+        h.name = "hidden_state_all"
+        return states, h, gate_values
 
-    # Now we have correctly:
-    # h = [state, state_1, state_2 ...] if args.layers > 1
-    # h = [state] if args.layers == 1
+    hidden_states, h, gate_values = apply_rnn(x_mask, **kwargs)
 
-    # If we have skip connections, concatenate all the states
-    # Else only consider the state of the highest layer
-    if args.layers > 1:
-        if args.skip_connections or args.skip_output:
-            h = tensor.concatenate(h, axis=2)
-        else:
-            h = h[-1]
+    if is_checkpointed(args):
+        # The states and cells are only stored at the end of each segment
+        cost, unregularized_cost, boundaries = get_checkpointed_costs(
+            apply_rnn, kwargs, h, x_mask, args)
     else:
-        h = h[0]
-    h.name = "hidden_state_all"
+        cost, unregularized_cost = get_costs(h, x_mask, args)
+        boundaries = None
 
-    presoft = get_presoft(h, args)
-
-    cost, unregularized_cost = get_costs(presoft, args)
+    # The updates of the hidden states and cells, in the order of
+    # hidden_states
+    carried = []
+    for d in range(args.layers):
+        carried.append((inits[0][d], hidden_states[2 * d]))
+        carried.append((inits[1][d], hidden_states[2 * d + 1]))
+    updates, train_updates = get_state_updates(carried, args, boundaries)
 
-    return cost, unregularized_cost, updates, gate_values, hidden_states
+    return (cost, unregularized_cost, updates, train_updates, gate_values,
+            hidden_states)
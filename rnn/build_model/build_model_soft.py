@@ -8,9 +8,12 @@ from blocks.bricks import Tanh, MLP, Logistic, Rectifier
 from blocks.bricks.recurrent import SimpleRecurrent, RecurrentStack
 
 from rnn.bricks import SoftGatedRecurrent, HardLogistic
-from rnn.build_model.build_model_utils import (get_prernn, get_presoft,
+from rnn.build_model.build_model_utils import (get_prernn,
                                                get_rnn_kwargs, get_costs,
-                                               initialize_rnn)
+                                               get_checkpointed_costs,
+                                               get_state_updates,
+                                               initialize_rnn,
+                                               is_checkpointed)
 
 floatX = theano.config.floatX
 logging.basicConfig(level='INFO')
@@ -62,46 +65,54 @@ def build_model_soft(args, dtype=floatX):
     # Prepare inputs and initial states for the RNN
     kwargs, inits = get_rnn_kwargs(pre_rnn, args)
 
-    # Apply the RNN to the inputs
-    h = rnn.apply(low_memory=True, mask=x_mask, **kwargs)
-
-    # Now we have:
-    # h = [state, state_1, gate_value_1, state_2, gate_value_2, state_3, ...]
-
-    # Extract gate_values
-    gate_values = h[2::2]
-    new_h = [h[0]]
-    new_h.extend(h[1::2])
-    h = new_h
-
-    # Now we have:
-    # h = [state, state_1, state_2, ...]
-    # gate_values = [gate_value_1, gate_value_2, gate_value_3]
-
-    for i, gate_value in enumerate(gate_values):
-        gate_value.name = "gate_value_" + str(i)
-
-    # Save all the last states
-    last_states = {}
-    hidden_states = []
-    for d in range(args.layers):
-        h[d] = h[d] * x_mask
-        last_states[d] = h[d][-1, :, :]
-        h[d].name = "hidden_state_" + str(d)
-        hidden_states.append(h[d])
-
-    # Concatenate all the states
-    if args.layers > 1:
-        h = tensor.concatenate(h, axis=2)
-    h.name = "hidden_state_all"
+    def apply_rnn(mask, **kwargs):
+        # Apply the RNN to the inputs, one layer after the other so that
+        # each gated layer computes the input part of its gate for all the
+        # time steps
+        h = rnn.apply(mask=mask, **kwargs)
+
+        # Now we have:
+        # h = [state, state_1, gate_value_1, state_2, gate_value_2, ...]
+
+        # Extract gate_values
+        gate_values = h[2::2]
+        new_h = [h[0]]
+        new_h.extend(h[1::2])
+        h = new_h
+
+        # Now we have:
+        # h = [state, state_1, state_2, ...]
+        # gate_values = [gate_value_1, gate_value_2, gate_value_3]
+
+        for i, gate_value in enumerate(gate_values):
+            gate_value.name = "gate_value_" + str(i)
+
+        # Save all the states, to carry the last ones
+        states = []
+        for d in range(args.layers):
+            h[d].name = "hidden_state_" + str(d)
+            states.append(h[d])
+
+        # Concatenate all the states
+        if args.layers > 1:
+            h = tensor.concatenate(h, axis=2)
+        h.name = "hidden_state_all"
+        return states, h, gate_values
+
+    hidden_states, h, gate_values = apply_rnn(x_mask, **kwargs)
+
+    if is_checkpointed(args):
+        # The states are only stored at the end of each segment
+        cost, cross_entropy, boundaries = get_checkpointed_costs(
+            apply_rnn, kwargs, h, x_mask, args)
+    else:
+        cost, cross_entropy = get_costs(h, x_mask, args)
+        boundaries = None
 
     # The updates of the hidden states
-    updates = []
-    for d in range(args.layers):
-        updates.append((inits[0][d], last_states[d]))
-
-    presoft = get_presoft(h, args)
-
-    cost, cross_entropy = get_costs(presoft, args)
+    updates, train_updates = get_state_updates(
+        [(inits[0][d], hidden_states[d]) for d in range(args.layers)], args,
+        boundaries)
 
-    return cost, cross_entropy, updates, gate_values, hidden_states
+    return (cost, cross_entropy, updates, train_updates, gate_values,
+            hidden_states)
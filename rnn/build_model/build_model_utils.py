@@ -1,3 +1,4 @@
+import re
 from collections import OrderedDict
 
 import numpy
@@ -7,14 +8,23 @@ from theano import tensor
 
 from blocks import initialization
 from blocks.bricks import Linear, Softmax, FeedforwardSequence, Tanh
-from blocks.bricks.cost import SquaredError
 from blocks.bricks.parallel import Fork
-from rnn.datasets.dataset import has_indices, has_mask, get_output_size
+from blocks.graph import Annotation, add_annotation
+from rnn.datasets.dataset import (has_indices, has_mask, get_output_size,
+                                  get_index_dtype)
 
-from rnn.bricks import LookupTable
+from rnn.bricks import LookupTable, FusedLookupTable
+from rnn.recompute import checkpointed_costs
 
 floatX = theano.config.floatX
 RECURRENTSTACK_SEPARATOR = '#'
+FUSED_LOOKUP_NAME = 'fused_lookup'
+
+# The lookup tables of the Fork of get_prernn, e.g.
+# "/fork/fork_inputs#1/lookuptable.W_lookup" (older models use "_1" and
+# files written by numpy.savez use "-" as brick delimiter)
+LOOKUP_PARAMETER = re.compile(
+    r'fork_inputs(?:[#_](\d+))?[/-]lookuptable\.(W|b)_lookup$')
 
 
 def get_prernn(args):
@@ -44,9 +54,25 @@ def get_prernn(args):
     # Check if the dataset provides indices (in the case of a
     # fixed vocabulary, x is 2D tensor) or if it gives raw values
     # (x is 3D tensor)
+    if has_indices(args.dataset) and args.fused_lookup:
+        # A single gather for the inputs of all the layers
+        x = tensor.matrix('features', dtype=get_index_dtype(args.dataset))
+        lookup = FusedLookupTable(length=get_output_size(args.dataset),
+                                  dims=output_dims, name=FUSED_LOOKUP_NAME)
+        lookup.weights_init = initialization.IsotropicGaussian(0.1)
+        lookup.biases_init = initialization.Constant(0)
+        lookup.initialize()
+        prernn = lookup.apply(x, as_list=True)
+        if not args.skip_connections:
+            prernn = prernn[0]
+        if not has_mask(args.dataset):
+            x_mask = tensor.ones_like(x, dtype=floatX)
+        name_prernn(prernn, args)
+        return prernn, x_mask
+
     if has_indices(args.dataset):
         features = args.mini_batch_size
-        x = tensor.lmatrix('features')
+        x = tensor.matrix('features', dtype=get_index_dtype(args.dataset))
         vocab_size = get_output_size(args.dataset)
         lookup = LookupTable(length=vocab_size, dim=state_dim)
         lookup.weights_init = initialization.IsotropicGaussian(0.1)
@@ -79,6 +105,11 @@ def get_prernn(args):
     # Apply the fork
     prernn = fork.apply(x)
 
+    name_prernn(prernn, args)
+    return prernn, x_mask
+
+
+def name_prernn(prernn, args):
     # Give a name to the input of each layer
     if args.skip_connections:
         for t in range(len(prernn)):
@@ -86,14 +117,55 @@ def get_prernn(args):
     else:
         prernn.name = "pre_rnn"
 
-    return prernn, x_mask
+
+def fuse_lookup_parameters(param_values):
+    """Convert the values of the lookup tables of a Fork to a fused table.
+
+    The bias of each table is added to its rows and the tables are
+    concatenated in the order of the layers, as expected by the
+    :class:`FusedLookupTable` of :func:`get_prernn`. Parameter values that
+    do not contain separate lookup tables are returned unchanged.
+
+    """
+    tables = {}
+    for name in list(param_values.keys()):
+        match = LOOKUP_PARAMETER.search(name)
+        if match is None:
+            continue
+        level = int(match.group(1) or 0)
+        tables.setdefault(level, {})[match.group(2)] = param_values.pop(name)
+    if not tables:
+        return param_values
+
+    param_values['/' + FUSED_LOOKUP_NAME + '.W_lookup'] = numpy.concatenate(
+        [tables[level]['W'] + tables[level]['b']
+         for level in sorted(tables)], axis=1)
+    return param_values
+
+
+def convert_parameter_values(param_values, args):
+    """Convert the parameter values of models saved by older versions.
+
+    With `--fused_lookup`, the separate lookup tables are fused by
+    :func:`fuse_lookup_parameters`. The clockwork modules of
+    :class:`~rnn.bricks.ClockworkStack` do not count the time steps, so
+    the `initial_time` of the modules of older clockwork models is dropped.
+
+    """
+    if args.fused_lookup:
+        param_values = fuse_lookup_parameters(param_values)
+    if args.rnn_type == 'clockwork':
+        for name in list(param_values.keys()):
+            if name.endswith('.initial_time'):
+                del param_values[name]
+    return param_values
 
 
-def get_presoft(h, args):
+def get_output_layer(args):
     output_size = get_output_size(args.dataset)
     # If args.skip_connections: dim = args.layers * args.state_dim
     # else: dim = args.state_dim
-    use_all_states = args.skip_connections or args.skip_output or (args.rnn_type in ["clockwork", "soft"])
+    use_all_states = args.skip_connections or args.skip_output or (args.rnn_type in ["clockwork", "soft", "hard"])
     output_layer = Linear(
         input_dim=use_all_states * args.layers *
         args.state_dim + (1 - use_all_states) * args.state_dim,
@@ -102,6 +174,12 @@ def get_presoft(h, args):
     output_layer.weights_init = initialization.IsotropicGaussian(0.1)
     output_layer.biases_init = initialization.Constant(0)
     output_layer.initialize()
+    return output_layer
+
+
+def get_presoft(h, args, output_layer=None):
+    if output_layer is None:
+        output_layer = get_output_layer(args)
     presoft = output_layer.apply(h)
     if not has_indices(args.dataset):
         presoft = Tanh().apply(presoft)
@@ -140,62 +218,182 @@ def get_rnn_kwargs(pre_rnn, args):
     return kwargs, inits
 
 
-def get_costs(presoft, args):
+def get_context(args):
+    """Number of first time steps which are not counted in the cost.
 
-    if has_indices(args.dataset):
-        # Targets: (Time X Batch)
-        y = tensor.lmatrix('targets')
-        y_mask = tensor.ones_like(y, dtype=floatX)
-        y_mask = tensor.set_subtensor(y_mask[:args.context, :],
-                                      tensor.zeros_like(y_mask[:args.context,
-                                                               :],
-                                                        dtype=floatX))
+    With `--tbptt_stride k1`, the minibatches overlap and only their last
+    `k1` time steps are new: the others are only used to backpropagate
+    through a longer horizon.
 
-        time, batch, feat = presoft.shape
-        cross_entropy = Softmax().categorical_cross_entropy(
-            (y.flatten() *
-                y_mask.reshape((batch * time, ))),
-            (presoft.reshape((batch * time, feat)) *
-                y_mask.reshape((batch * time, 1))))
+    """
+    if args.tbptt_stride:
+        return max(args.context, args.time_length - args.tbptt_stride)
+    return args.context
 
-        # renormalization
-        renormalized_cross_entropy = cross_entropy * (
-            tensor.sum(tensor.ones_like(y_mask)) /
-            tensor.sum(y_mask))
 
-        # BPC: Bits Per Character
-        unregularized_cost = renormalized_cross_entropy / tensor.log(2)
-        unregularized_cost.name = "cross_entropy"
+def is_checkpointed(args):
+    """Whether the cost is computed by :func:`get_checkpointed_costs`.
+
+    The visualizations need the states of every time step, they always use
+    the plain graph.
+
+    """
+    return args.checkpoint_every > 0 and args.visualize == "nothing"
+
+
+def get_last_step(args):
+    """Index of the states carried to the next training minibatch.
+
+    The index is among the states of every time step or, with
+    `--checkpoint_every`, among the states at the end of every segment.
+
+    """
+    if not args.tbptt_stride:
+        return -1
+    if is_checkpointed(args):
+        return args.tbptt_stride // args.checkpoint_every - 1
+    return args.tbptt_stride - 1
+
+
+def get_state_updates(carried, args, boundaries=None):
+    """The updates which carry the states to the next minibatch.
+
+    The validation and generation sequences do not overlap, they carry the
+    states of their last time step. With `--tbptt_stride k1`, the next
+    training minibatch starts `k1` steps later, it carries the states of
+    the step `k1 - 1` instead.
+
+    Parameters
+    ----------
+    carried : list of tuples
+        The shared variable of each initial state, and the states of every
+        time step of this layer.
+    boundaries : list of :class:`~tensor.TensorVariable`, optional
+        With `--checkpoint_every`, the states at the end of every segment
+        for each carried state, see :func:`get_checkpointed_costs`. The
+        training carries them since they are computed with its cost. They
+        depend on the targets, so the generation carries the states of
+        `carried` instead.
+
+    Returns
+    -------
+    updates : list of tuples
+        The updates for the monitoring and the generation.
+    train_updates : list of tuples
+        The updates for the training algorithm.
 
+    """
+    updates = [(initial, states[-1]) for initial, states in carried]
+    if boundaries is None:
+        boundaries = [states for _, states in carried]
+    last_step = get_last_step(args)
+    train_updates = [(initial, states[last_step])
+                     for (initial, _), states in zip(carried, boundaries)]
+    return updates, train_updates
+
+
+def valid_rows(h, y_mask):
+    """The states of the positions where `y_mask` is not zero.
+
+    Returns
+    -------
+    rows : :class:`~tensor.TensorVariable`
+        The flat (time * batch) indices of the valid positions.
+    states : :class:`~tensor.TensorVariable`
+        The states of these positions, in the shape (rows, features).
+
+    """
+    rows = y_mask.flatten().nonzero()[0]
+    states = h.reshape((h.shape[0] * h.shape[1], h.shape[2]))[rows]
+    return rows, states
+
+
+def mean_over_rows(total, count):
+    """The mean of the costs of `count` valid rows, 0 if there is none
+    (e.g. a minibatch of documents shorter than the context)."""
+    return total / tensor.cast(tensor.maximum(count, 1), floatX)
+
+
+def get_targets(x_mask, args):
+    """The targets and the mask of the positions counted in the cost.
+
+    The positions of the context are not counted. With real values, the
+    target of the step t is the input of the step t + 1, so the targets
+    and their mask have one time step less than the inputs.
+
+    """
+    context = get_context(args)
+    if has_indices(args.dataset):
+        # Targets: (Time X Batch)
+        y = tensor.matrix('targets', dtype=get_index_dtype(args.dataset))
+        y_mask = x_mask
     else:
         # Targets: (Time X Batch X Features)
         y = tensor.tensor3('targets', dtype=floatX)
-        y_mask = tensor.ones_like(y[:, :, 0], dtype=floatX)
-        y_mask = tensor.set_subtensor(y_mask[:args.context, :],
-                                      tensor.zeros_like(y_mask[:args.context, :],
+        y_mask = x_mask[1:]
+    y_mask = tensor.set_subtensor(y_mask[:context, :],
+                                  tensor.zeros_like(y_mask[:context, :],
+                                                    dtype=floatX))
+
+    if not has_indices(args.dataset) and args.used_inputs is not None:
+        y_mask = tensor.set_subtensor(y_mask[:args.used_inputs, :],
+                                      tensor.zeros_like(y_mask[:args.used_inputs, :],
                                                         dtype=floatX))
+    return y, y_mask
 
-        if args.used_inputs is not None:
-            y_mask = tensor.set_subtensor(y_mask[:args.used_inputs, :],
-                                          tensor.zeros_like(y_mask[:args.used_inputs, :],
-                                                            dtype=floatX))
-        # SquaredError does not work on 3D tensor
-        target = (y * y_mask.dimshuffle(0, 1, 'x'))
-        values = (presoft[:-1, :, :] * y_mask.dimshuffle(0, 1, 'x'))
-
-        target = target.reshape((target.shape[0] * target.shape[1],
-                                 target.shape[2]))
-
-        values = values.reshape((values.shape[0] * values.shape[1],
-                                 values.shape[2]))
-
-        unregularized_cost = SquaredError().apply(target, values)
-        # renormalization
-        unregularized_cost = unregularized_cost * (
-            tensor.sum(tensor.ones_like(y_mask)) /
-            tensor.sum(y_mask))
+
+def row_costs(h, y, y_mask, output_layer, args):
+    """The cost of each valid position, see :func:`valid_rows`.
+
+    The states `h` are those which predict the targets `y`.
+
+    Returns
+    -------
+    costs : :class:`~tensor.TensorVariable`
+        The cost of each valid position, in the shape (rows,).
+    rows : :class:`~tensor.TensorVariable`
+        The flat indices of the valid positions.
+
+    """
+    rows, states = valid_rows(h, y_mask)
+    # The states are on the right of the product: in the gradient of the
+    # scan of checkpointed_costs, the optimization which pushes the sum of
+    # the `dot(states.T, ...)` of the segments out of the scan assumes the
+    # same number of rows in every segment
+    outputs = (tensor.dot(output_layer.W.T, states.T).T +
+               output_layer.b)
+
+    if has_indices(args.dataset):
+        costs = Softmax().categorical_cross_entropy(
+            tensor.cast(y, 'int64').flatten()[rows], outputs)
+    else:
+        # The squared error of each row, as SquaredError on a 2D tensor
+        target = y.reshape((y.shape[0] * y.shape[1], y.shape[2]))[rows]
+        costs = tensor.sqr(target - Tanh().apply(outputs)).sum(axis=1)
+    return costs, rows
+
+
+def mean_costs(total, count, presoft, args):
+    """The regularized and unregularized mean costs of the positions.
+
+    The cross entropy is given in bits. The output of the output layer for
+    every position, `presoft`, is not needed by the cost, it is attached to
+    it as an auxiliary variable to be found in its graph (generation,
+    visualization).
+
+    """
+    unregularized_cost = mean_over_rows(total, count)
+    if has_indices(args.dataset):
+        # BPC: Bits Per Character
+        unregularized_cost = unregularized_cost / tensor.log(2)
+        unregularized_cost.name = "cross_entropy"
+    else:
         unregularized_cost.name = "mean_squared_error"
 
+    annotation = Annotation()
+    annotation.add_auxiliary_variable(presoft, name='presoft')
+    add_annotation(unregularized_cost, annotation)
+
     # TODO: add regularisation for the cost
     # the log(1) is here in order to differentiate the two variables
     # for monitoring
@@ -204,6 +402,87 @@ def get_costs(presoft, args):
     return cost, unregularized_cost
 
 
+def get_costs(h, x_mask, args):
+    """The cost of the predictions made from the hidden states `h`.
+
+    Only the positions after the context and inside the mask are gathered
+    before the output layer, so the output layer and the softmax do not
+    run on the other positions. The cost is the mean over these positions,
+    and 0 when there is none.
+
+    """
+    output_layer = get_output_layer(args)
+    presoft = get_presoft(h, args, output_layer)
+
+    y, y_mask = get_targets(x_mask, args)
+    if not has_indices(args.dataset):
+        h = h[:-1]
+    costs, rows = row_costs(h, y, y_mask, output_layer, args)
+    return mean_costs(costs.sum(), rows.shape[0], presoft, args)
+
+
+def get_checkpointed_costs(apply_rnn, kwargs, h, x_mask, args):
+    """The costs of :func:`get_costs`, with `--checkpoint_every` steps
+    per segment of :func:`~rnn.recompute.checkpointed_costs`.
+
+    Only the states at the end of each segment are stored for the backward
+    pass. The states of the steps of a segment, the output layer and the
+    costs of its positions are recomputed from the states at its start.
+
+    Parameters
+    ----------
+    apply_rnn : callable
+        Called with the mask and the inputs and initial states of a
+        segment, as named in `kwargs`. Returns the states of every step of
+        the segment for each initial state of `kwargs` and the hidden
+        states given to the output layer, followed by other outputs which
+        are not used (e.g. the gates).
+    kwargs : dict
+        The inputs and initial states of the RNN, see
+        :func:`get_rnn_kwargs`.
+    h : :class:`~tensor.TensorVariable`
+        The hidden states of every step of the whole sequences. They are
+        only used by the output of the output layer for every position,
+        `presoft`, which is not computed for the cost.
+    x_mask : :class:`~tensor.TensorVariable`
+        The mask of the inputs.
+
+    Returns
+    -------
+    cost : :class:`~tensor.TensorVariable`
+    unregularized_cost : :class:`~tensor.TensorVariable`
+    boundaries : list of :class:`~tensor.TensorVariable`
+        The states at the end of each segment, for each initial state of
+        `kwargs`, in the shape (segments, batch, features).
+
+    """
+    output_layer = get_output_layer(args)
+    presoft = get_presoft(h, args, output_layer)
+
+    y, y_mask = get_targets(x_mask, args)
+    if not has_indices(args.dataset):
+        # Align the targets with the states which predict them
+        y = tensor.concatenate([y, tensor.zeros_like(y[:1])])
+        y_mask = tensor.concatenate([y_mask, tensor.zeros_like(y_mask[:1])])
+
+    input_names = [name for name in kwargs if name.startswith('inputs')]
+    state_names = [name for name in kwargs if name not in input_names]
+
+    def segment_costs(mask, y, y_mask, *args_):
+        segment_kwargs = OrderedDict(zip(input_names + state_names, args_))
+        states, h = apply_rnn(mask, **segment_kwargs)[:2]
+        costs, rows = row_costs(h, y, y_mask, output_layer, args)
+        return ([layer[-1] for layer in states] +
+                [costs.sum(), tensor.cast(rows.shape[0], floatX)])
+
+    boundaries, total, count = checkpointed_costs(
+        segment_costs,
+        [x_mask, y, y_mask] + [kwargs[name] for name in input_names],
+        [kwargs[name] for name in state_names], args.checkpoint_every)
+    cost, unregularized_cost = mean_costs(total, count, presoft, args)
+    return cost, unregularized_cost, boundaries
+
+
 def initialize_rnn(rnn, args):
     # Dont initialize as Orthogonal if we are about to load new parameters
     if args.load_path is not None:
@@ -6,9 +6,12 @@ from theano import tensor
 from blocks.bricks import Tanh
 from blocks.bricks.recurrent import SimpleRecurrent, RecurrentStack
 
-from rnn.build_model.build_model_utils import (get_prernn, get_presoft,
+from rnn.build_model.build_model_utils import (get_prernn,
                                                get_rnn_kwargs, get_costs,
-                                               initialize_rnn)
+                                               get_checkpointed_costs,
+                                               get_state_updates,
+                                               initialize_rnn,
+                                               is_checkpointed)
 
 floatX = theano.config.floatX
 logging.basicConfig(level='INFO')
@@ -31,45 +34,43 @@ def build_model_vanilla(args, dtype=floatX):
     # Prepare inputs and initial states for the RNN
     kwargs, inits = get_rnn_kwargs(pre_rnn, args)
 
-    # Apply the RNN to the inputs
-    h = rnn.apply(low_memory=True, mask=x_mask, **kwargs)
-
-    # We have
-    # h = [state, state_1, state_2 ...] if args.layers > 1
-    # h = state if args.layers == 1
-
-    # If we have skip connections, concatenate all the states
-    # Else only consider the state of the highest layer
-    last_states = {}
-    hidden_states = []
-    if args.layers > 1:
-        # Save all the last states
+    def apply_rnn(mask, **kwargs):
+        # Apply the RNN to the inputs
+        h = rnn.apply(low_memory=True, mask=mask, **kwargs)
+
+        # We have
+        # h = [state, state_1, state_2 ...] if args.layers > 1
+        # h = state if args.layers == 1
+
+        # If we have skip connections, concatenate all the states
+        # Else only consider the state of the highest layer
+        if args.layers == 1:
+            h.name = "hidden_state_0"
+            return [h], h
+        # Save all the states, to carry the last ones
+        states = []
         for d in range(args.layers):
-            # TODO correct bug
-            # h[d] = h[d] * x_mask
-            last_states[d] = h[d][-1, :, :]
             h[d].name = "hidden_state_" + str(d)
-            hidden_states.append(h[d])
+            states.append(h[d])
         if args.skip_connections or args.skip_output:
-            h = tensor.concatenate(h, axis=2)
-        else:
-            h = h[-1]
-    else:
-        # TODO correct bug
-        # hidden_states.append(h * x_mask)
-        hidden_states.append(h)
-        hidden_states[0].name = "hidden_state_0"
-        # Note: if we have mask, then updating initial state
-        # with last state does not make sence anymore.
-        last_states[0] = h[-1, :, :]
+            return states, tensor.concatenate(h, axis=2)
+        return states, h[-1]
 
-    # The updates of the hidden states
-    updates = []
-    for d in range(args.layers):
-        updates.append((inits[0][d], last_states[d]))
+    # Note: the masked steps keep the states of the previous step
+    hidden_states, h = apply_rnn(x_mask, **kwargs)
 
-    presoft = get_presoft(h, args)
+    if is_checkpointed(args):
+        # The states are only stored at the end of each segment
+        cost, unregularized_cost, boundaries = get_checkpointed_costs(
+            apply_rnn, kwargs, h, x_mask, args)
+    else:
+        cost, unregularized_cost = get_costs(h, x_mask, args)
+        boundaries = None
 
-    cost, unregularized_cost = get_costs(presoft, args)
+    # The updates of the hidden states
+    updates, train_updates = get_state_updates(
+        [(inits[0][d], hidden_states[d]) for d in range(args.layers)], args,
+        boundaries)
 
-    return cost, unregularized_cost, updates, hidden_states
+    return (cost, unregularized_cost, updates, train_updates,
+            hidden_states)
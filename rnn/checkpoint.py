@@ -0,0 +1,326 @@
+import itertools
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from six.moves import cPickle
+
+from blocks.extensions import SimpleExtension
+from blocks.serialization import save_parameter_values
+
+logger = logging.getLogger(__name__)
+
+# Entries of the status of the main loop which describe the running
+# process, they are not restored from a checkpoint
+RUNTIME_STATUS = ('training_started', 'epoch_started', 'resumed_from',
+                  'epoch_interrupt_received', 'batch_interrupt_received',
+                  'received_first_batch')
+
+
+def write_parameter_values(npz_file, param_values):
+    save_parameter_values(param_values, npz_file)
+
+
+def write_pickle(pickle_file, data):
+    cPickle.dump(data, pickle_file, protocol=cPickle.HIGHEST_PROTOCOL)
+
+
+def write_atomically(path, save, data):
+    """Write a file through a temporary file renamed at the end.
+
+    An interrupted write never leaves a partial file at `path`, the
+    previous version of the file is kept.
+
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    tmp_file = tempfile.NamedTemporaryFile(dir=directory, prefix=name + '.',
+                                           delete=False)
+    try:
+        with tmp_file:
+            save(tmp_file, data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.rename(tmp_file.name, path)
+    except:
+        os.remove(tmp_file.name)
+        raise
+
+
+class CheckpointWriter(object):
+
+    """Writes files in a background thread.
+
+    The training goes on while a file is written, so the data given to
+    :meth:`write` must be a snapshot which is not modified afterwards (e.g.
+    the values of the parameters, copied to host memory).
+
+    A new write to a path replaces the write which is still pending for
+    this path, if any. Besides the file being written, at most
+    `max_pending` files wait to be written: :meth:`write` blocks until
+    one of them is written, so that a slow disk does not pile up
+    snapshots in memory.
+
+    An error of the background thread is raised by the next call to
+    :meth:`write` or :meth:`flush`.
+
+    Parameters
+    ----------
+    max_pending : int, optional
+        The number of files which can wait to be written.
+
+    """
+
+    def __init__(self, max_pending=2):
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.writing = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run,
+                                       name='checkpoint_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, path, save, data):
+        """Write `data` at `path`, with `save(file, data)`."""
+        with self.condition:
+            self._raise_error()
+            self.pending.pop(path, None)
+            while len(self.pending) >= self.max_pending:
+                self.condition.wait()
+            self.pending[path] = (save, data)
+            self.condition.notify_all()
+
+    def flush(self):
+        """Wait until all the pending files are written."""
+        with self.condition:
+            while self.pending or self.writing:
+                self.condition.wait()
+            self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                path, (save, data) = self.pending.popitem(last=False)
+                self.writing = True
+                self.condition.notify_all()
+
+            error = None
+            try:
+                write_atomically(path, save, data)
+                logger.info("Written " + path)
+            except Exception as e:
+                logger.exception("Could not write " + path)
+                error = e
+            del data
+
+            with self.condition:
+                self.writing = False
+                if error is not None:
+                    self.error = error
+                self.condition.notify_all()
+
+
+class ResumedScheme(object):
+
+    """Iteration scheme whose next epoch starts after `skip` requests."""
+
+    def __init__(self, scheme, skip):
+        self.scheme = scheme
+        self.skip = skip
+
+    @property
+    def requests_examples(self):
+        return self.scheme.requests_examples
+
+    def get_request_iterator(self):
+        iterator = self.scheme.get_request_iterator()
+        if self.skip:
+            iterator = itertools.islice(iterator, self.skip, None)
+            self.skip = 0
+        return iterator
+
+
+def base_stream(stream):
+    """The :class:`~fuel.streams.DataStream` below the transformers."""
+    while hasattr(stream, 'data_stream'):
+        stream = stream.data_stream
+    return stream
+
+
+def get_stream_state(stream):
+    """The state of the current epoch of a stream of our datasets.
+
+    The state is made of the state returned by `open` (offsets of the
+    columns, order of the minibatches...) and of the attributes of the
+    dataset which drive the next epochs (random generator, number of
+    epochs).
+
+    """
+    stream = base_stream(stream)
+    dataset = stream.dataset
+    data_state = stream.data_state
+    if isinstance(data_state, dict) and 'pending' in data_state:
+        # The minibatches being generated by the workers of a
+        # ProceduralDataset are generated again
+        data_state = dict(data_state, pending={})
+    state = {'data_state': data_state}
+    if hasattr(dataset, 'rng'):
+        state['rng'] = dataset.rng.get_state()
+    if hasattr(dataset, 'epochs'):
+        state['epochs'] = dataset.epochs
+    return state
+
+
+def set_stream_state(stream, state, position):
+    """Resume a stream which has not been iterated yet.
+
+    The first epoch of the stream is the epoch of `state`, without its
+    first `position` minibatches. If the epoch was over, the stream
+    starts with the next epoch.
+
+    Returns
+    -------
+    int
+        The number of minibatches skipped in the first epoch.
+
+    """
+    stream = base_stream(stream)
+    dataset = stream.dataset
+    stream.data_state = state['data_state']
+    if 'rng' in state:
+        dataset.rng.set_state(state['rng'])
+    if 'epochs' in state:
+        dataset.epochs = state['epochs']
+    if position >= dataset.num_examples:
+        stream.next_epoch()
+        return 0
+    stream.iteration_scheme = ResumedScheme(stream.iteration_scheme,
+                                            position)
+    return position
+
+
+def training_state_variables(algorithm, updates, parameters):
+    """The shared variables updated by the training, but the parameters.
+
+    These are the state of the step rule (moments of Adam or RMSProp,
+    velocities...) and the variables of `updates` (carried hidden states,
+    state of the row-sparse step rule), in a deterministic order. The
+    updates added to the algorithm by the extensions, e.g. the
+    accumulators of the monitoring, are not part of the state.
+
+    """
+    parameters = set(parameters)
+    variables = []
+    for variable, _ in (list(algorithm.step_rule_updates) + list(updates)):
+        if variable not in parameters and variable not in variables:
+            variables.append(variable)
+    return variables
+
+
+class ResumableCheckpoint(SimpleExtension):
+
+    """Save and restore the whole state of the training.
+
+    A checkpoint holds the values of the parameters, the state of the step
+    rule and the carried hidden states, the status of the main loop
+    (iterations, epochs, best validation cost, patience) and the position
+    in the training stream. Resuming from it continues the training from
+    the same minibatch, without iterating over the previous ones.
+
+    The checkpoint is saved after each epoch and at the end of the
+    training (e.g. when the process receives SIGTERM), and every
+    `every_n_batches` batches if given. It is written in the background.
+
+    The minibatches of `--batch_offsets random` are drawn anew after a
+    resumption, and so are the random numbers of the hard gates and of
+    the weight noise.
+
+    Parameters
+    ----------
+    path : str
+        The file of the checkpoint.
+    variables : list of :class:`~tensor.TensorSharedVariable`
+        The state of the training besides the parameters, see
+        :func:`training_state_variables`.
+    resume_from : str, optional
+        A checkpoint to restore before the training.
+    writer : :class:`CheckpointWriter`, optional
+        The writer of the checkpoint.
+
+    """
+
+    def __init__(self, path, variables, resume_from=None, writer=None,
+                 **kwargs):
+        self.path = path
+        self.variables = variables
+        self.resume_from = resume_from
+        if writer is None:
+            writer = CheckpointWriter()
+        self.writer = writer
+        # The iteration of the first minibatch of the current epoch
+        self.epoch_start = 0
+        self.skipped = 0
+        kwargs.setdefault("before_training", True)
+        kwargs.setdefault("before_epoch", True)
+        kwargs.setdefault("after_epoch", True)
+        kwargs.setdefault("after_training", True)
+        super(ResumableCheckpoint, self).__init__(**kwargs)
+
+    def do(self, which_callback, *args):
+        status = self.main_loop.status
+        if which_callback == 'before_training':
+            if self.resume_from is not None:
+                self.load(self.resume_from)
+        elif which_callback == 'before_epoch':
+            self.epoch_start = status['iterations_done'] - self.skipped
+            self.skipped = 0
+        else:
+            self.save()
+            if which_callback == 'after_training':
+                self.writer.flush()
+
+    def save(self):
+        status = self.main_loop.status
+        checkpoint = {
+            'parameters': self.main_loop.model.get_parameter_values(),
+            'variables': [(variable.name, variable.get_value())
+                          for variable in self.variables],
+            'status': dict((key, value) for key, value in status.items()
+                           if key not in RUNTIME_STATUS),
+            'stream': get_stream_state(self.main_loop.data_stream),
+            'position': status['iterations_done'] - self.epoch_start}
+        self.writer.write(self.path, write_pickle, checkpoint)
+
+    def load(self, path):
+        logger.info("Resuming from " + path)
+        with open(path, 'rb') as checkpoint_file:
+            checkpoint = cPickle.load(checkpoint_file)
+
+        variables = self.variables
+        if len(variables) != len(checkpoint['variables']):
+            raise ValueError("The checkpoint {} does not match the training "
+                             "state of the model".format(path))
+        for variable, (name, value) in zip(variables,
+                                           checkpoint['variables']):
+            if (variable.name != name or
+                    variable.get_value().shape != value.shape):
+                raise ValueError("The checkpoint {} has a variable {} "
+                                 "instead of {}".format(path, name,
+                                                        variable.name))
+            variable.set_value(value)
+        self.main_loop.model.set_parameter_values(checkpoint['parameters'])
+
+        self.main_loop.status.update(checkpoint['status'])
+        self.skipped = set_stream_state(self.main_loop.data_stream,
+                                        checkpoint['stream'],
+                                        checkpoint['position'])
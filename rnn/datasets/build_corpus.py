@@ -0,0 +1,153 @@
+import argparse
+import logging
+import os
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from rnn.datasets.vocabulary import NUM_BYTES, Vocabulary
+
+logger = logging.getLogger(__name__)
+
+# Number of bytes read from a text file at once
+BLOCK_SIZE = 1 << 24
+
+
+def iter_blocks(path, block_size=BLOCK_SIZE):
+    """Bytes of a file, as uint8 arrays of at most `block_size` elements."""
+    with open(path, 'rb') as text_file:
+        while True:
+            block = text_file.read(block_size)
+            if not block:
+                return
+            yield numpy.fromstring(block, dtype=numpy.uint8)
+
+
+def byte_histogram(paths, block_size=BLOCK_SIZE):
+    """Number of occurrences of each of the 256 byte values in the files."""
+    counts = numpy.zeros(NUM_BYTES, dtype=numpy.int64)
+    for path in paths:
+        for block in iter_blocks(path, block_size):
+            counts += numpy.bincount(block, minlength=NUM_BYTES)
+    return counts
+
+
+def build_vocabulary(counts):
+    """Vocabulary of the bytes that occur, the most frequent first."""
+    # Stable sort, so that ties are ordered by byte value
+    order = numpy.argsort(-counts, kind='mergesort')
+    order = order[counts[order] > 0]
+    return Vocabulary(order.astype(numpy.uint8).view('S1'))
+
+
+def encode_file(path, vocab, destination, block_size=BLOCK_SIZE,
+                separator=None):
+    """Write the codes of a text file into a `.npy` file, block by block.
+
+    Returns
+    -------
+    offsets : :class:`~numpy.ndarray` or None
+        If a `separator` byte is given, the boundaries of the documents:
+        the document `i` is `[offsets[i], offsets[i + 1])` and ends with
+        its separator.
+
+    """
+    size = os.path.getsize(path)
+    codes = open_memmap(destination, mode='w+', dtype=vocab.dtype,
+                        shape=(size,))
+    ends = []
+    position = 0
+    for block in iter_blocks(path, block_size):
+        codes[position:position + len(block)] = vocab.char_to_code[block]
+        if separator is not None:
+            ends.append(numpy.flatnonzero(block == ord(separator)) +
+                        position + 1)
+        position += len(block)
+    codes.flush()
+    del codes
+
+    if separator is None:
+        return None
+    ends = numpy.concatenate([[0]] + ends + [[size]]).astype(numpy.int64)
+    return numpy.unique(ends)
+
+
+def parse_separator(value):
+    """The document separator given on the command line.
+
+    The separator is either given as a byte value (e.g. `10`), or as a
+    single byte with the escape sequences of Python string literals (e.g.
+    `\\n` or `\\x00`), since a shell hardly passes a newline.
+
+    """
+    if value.isdigit():
+        code = int(value)
+        if code >= NUM_BYTES:
+            raise argparse.ArgumentTypeError(
+                "the byte value of the document separator must be lower "
+                "than {}, got {}".format(NUM_BYTES, code))
+        return chr(code)
+    try:
+        separator = value.decode('string_escape')
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(
+            "invalid escape in the document separator {!r}: {}".format(
+                value, e))
+    if len(separator) != 1:
+        raise argparse.ArgumentTypeError(
+            "the document separator must be a single byte, {!r} is {} "
+            "bytes long".format(value, len(separator)))
+    return separator
+
+
+def build_corpus(destination, train_path, valid_path, test_path=None,
+                 document_separator=None, block_size=BLOCK_SIZE):
+    """Build a character corpus from text files, without loading them.
+
+    The files are read twice, one block at a time: a first pass counts the
+    bytes to build the vocabulary, a second pass encodes every split into a
+    memory-mappable `.npy` file. The directory has the same layout as the
+    extracted archives (see :class:`rnn.datasets.dataset.MappedCorpus`).
+
+    The vocabulary is made of bytes, so a multi-byte (e.g. UTF-8)
+    character is seen as several symbols.
+
+    Parameters
+    ----------
+    destination : str
+        The existing directory where the arrays are written.
+    train_path : str
+        The training text.
+    valid_path : str
+        The validation text.
+    test_path : str, optional
+        The test text. If not given, the validation text is used.
+    document_separator : str, optional
+        A byte which ends each document of the texts (e.g. a newline).
+        If given, the boundaries of the documents of each split are
+        written as well, see :class:`rnn.datasets.dataset.DocumentBuckets`.
+
+    """
+    if document_separator is not None and len(document_separator) != 1:
+        raise ValueError("the document separator must be a single byte, "
+                         "got {!r}".format(document_separator))
+    if test_path is None:
+        test_path = valid_path
+    paths = [('train', train_path), ('valid', valid_path),
+             ('test', test_path)]
+
+    logger.info("Counting the characters of " + train_path)
+    counts = byte_histogram(set(path for _, path in paths), block_size)
+    vocab = build_vocabulary(counts)
+    numpy.save(os.path.join(destination, 'vocab.npy'), vocab.code_to_char)
+    numpy.save(os.path.join(destination, 'vocab_size.npy'),
+               numpy.array(len(vocab)))
+
+    for split, path in paths:
+        logger.info("Encoding " + path)
+        offsets = encode_file(path, vocab,
+                              os.path.join(destination, split + '.npy'),
+                              block_size, document_separator)
+        if offsets is not None:
+            numpy.save(os.path.join(destination, split + '_offsets.npy'),
+                       offsets)
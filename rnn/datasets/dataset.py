@@ -1,13 +1,46 @@
+import hashlib
+import logging
 import os
+import shutil
+import tempfile
 
 import numpy
 from fuel import config
-from fuel.datasets import IndexableDataset
+from fuel.datasets import Dataset
 from fuel.schemes import SequentialExampleScheme
 from fuel.streams import DataStream
 
+from rnn.datasets.build_corpus import build_corpus
+from rnn.datasets.prefetch import PrefetchingDataStream
+from rnn.datasets.procedural import get_metadata, get_stream_procedural
+from rnn.datasets.vocabulary import Vocabulary, compact_dtype
 
-def get_data(dataset):
+logger = logging.getLogger(__name__)
+
+
+# Version of the on-disk layout of the extracted corpora. Bump it whenever
+# the way arrays are written into the cache changes.
+CACHE_VERSION = 2
+
+# Arrays smaller than this are read into memory instead of being mapped
+SMALL_ARRAY_BYTES = 1 << 20
+
+SPLITS = ('train', 'valid', 'test')
+
+# Datasets generated on the fly, see rnn.datasets.procedural
+PROCEDURAL_DATASETS = ('sine_procedural', 'toy_procedural', 'xml_procedural')
+
+# Datasets built from text files given on the command line
+TEXT_DATASETS = ('mytext',)
+
+# Process-wide registry: dataset name -> opened corpus
+_opened_corpora = {}
+
+# Dataset name -> Vocabulary
+_vocabularies = {}
+
+
+def get_path(dataset):
     if dataset == "wikipedia":
         path = os.path.join(config.data_path, 'wikipedia-text',
                             'char_level_enwik8.npz')
@@ -27,7 +60,192 @@ def get_data(dataset):
                             'data_5.npz')
     else:
         assert False
-    return numpy.load(path, 'rb')
+    return path
+
+
+def get_cache_path(path):
+    """Directory holding the uncompressed `.npy` copy of an archive.
+
+    The copy lives next to the archive, unless the `RNN_CACHE_PATH`
+    environment variable points to another (e.g. local and faster) disk.
+
+    """
+    directory, name = os.path.split(os.path.splitext(path)[0])
+    directory = os.environ.get('RNN_CACHE_PATH', directory)
+    return os.path.join(directory, '%s_npy_v%d' % (name, CACHE_VERSION))
+
+
+def make_tmp_dir(cache_path):
+    """Temporary directory where `cache_path` is built before being moved.
+
+    The parent directory of the cache is created if needed.
+
+    """
+    directory = os.path.dirname(cache_path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process created it in the meantime
+            if not os.path.isdir(directory):
+                raise
+    return tempfile.mkdtemp(prefix=os.path.basename(cache_path) + '.',
+                            dir=directory)
+
+
+def extract_archive(path, cache_path):
+    """Write every array of the `.npz` archive as a separate `.npy` file.
+
+    The arrays are written in a temporary directory which is renamed at the
+    end, so that an interrupted extraction never leaves a partial cache.
+
+    """
+    logger.info("Extracting " + path + " into " + cache_path)
+    tmp_path = make_tmp_dir(cache_path)
+    archive = numpy.load(path)
+    try:
+        vocab_size = None
+        if 'vocab_size' in archive.keys():
+            vocab_size = int(archive['vocab_size'])
+        for key in archive.keys():
+            array = archive[key]
+            # Store the character indices with the smallest dtype
+            if (vocab_size is not None and key in SPLITS and
+                    array.dtype.kind in 'iu'):
+                array = array.astype(compact_dtype(vocab_size))
+            numpy.save(os.path.join(tmp_path, key + '.npy'), array)
+    finally:
+        archive.close()
+    move_into_place(tmp_path, cache_path)
+
+
+def move_into_place(tmp_path, cache_path):
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # Another process built the same cache in the meantime
+        shutil.rmtree(tmp_path)
+        if not os.path.isdir(cache_path):
+            raise
+
+
+def get_text_cache_path(train_path, valid_path, test_path=None,
+                        document_separator=None):
+    """Directory holding the encoded copy of text files.
+
+    The name depends on the paths, sizes and modification times of the
+    files (and on the document separator), so that a modified text is
+    encoded again.
+
+    """
+    signature = hashlib.md5()
+    if document_separator is not None:
+        signature.update('separator:%d;' % ord(document_separator))
+    for path in (train_path, valid_path, test_path):
+        if path is not None:
+            stat = os.stat(path)
+            signature.update('%s:%d:%d;' % (os.path.abspath(path),
+                                            stat.st_size, stat.st_mtime))
+    cache_path = get_cache_path(train_path)
+    return '%s_%s' % (cache_path, signature.hexdigest()[:8])
+
+
+def open_text_corpus(dataset, train_path, valid_path, test_path=None,
+                     document_separator=None):
+    """Make text files available as the character dataset `dataset`.
+
+    The files are encoded once into the cache, see
+    :func:`rnn.datasets.build_corpus.build_corpus`. With a
+    `document_separator`, the texts are cut into documents which are
+    streamed by :class:`DocumentBuckets`.
+
+    """
+    cache_path = get_text_cache_path(train_path, valid_path, test_path,
+                                     document_separator)
+    if not os.path.isdir(cache_path):
+        logger.info("Building the corpus " + cache_path)
+        tmp_path = make_tmp_dir(cache_path)
+        try:
+            build_corpus(tmp_path, train_path, valid_path, test_path,
+                         document_separator)
+        except:
+            shutil.rmtree(tmp_path)
+            raise
+        move_into_place(tmp_path, cache_path)
+    _opened_corpora[dataset] = MappedCorpus(cache_path)
+    _vocabularies.pop(dataset, None)
+    return _opened_corpora[dataset]
+
+
+class MappedCorpus(object):
+
+    """Read-only, dict-like view of a directory of `.npy` files.
+
+    Arrays are memory-mapped, so opening a corpus costs nothing and the
+    pages are shared between all the streams (and processes) reading it.
+    Small arrays (vocabulary, sizes) are loaded once and kept in memory.
+
+    Parameters
+    ----------
+    path : str
+        Directory containing one `<key>.npy` file per array.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._arrays = {}
+        for filename in sorted(os.listdir(path)):
+            key, extension = os.path.splitext(filename)
+            if extension != '.npy':
+                continue
+            filename = os.path.join(path, filename)
+            try:
+                array = numpy.load(filename, mmap_mode='r')
+            except ValueError:
+                # Object arrays cannot be memory-mapped
+                array = numpy.load(filename)
+            if array.ndim == 0:
+                array = array[()]
+            elif array.nbytes < SMALL_ARRAY_BYTES:
+                array = numpy.array(array)
+            self._arrays[key] = array
+
+    def keys(self):
+        return self._arrays.keys()
+
+    def __contains__(self, key):
+        return key in self._arrays
+
+    def __getitem__(self, key):
+        return self._arrays[key]
+
+
+def is_procedural(dataset):
+    return dataset in PROCEDURAL_DATASETS
+
+
+def get_data(dataset):
+    if dataset in _opened_corpora:
+        return _opened_corpora[dataset]
+
+    if is_procedural(dataset):
+        # Nothing on disk, only the vocabulary and sizes
+        data = get_metadata(dataset)
+    elif dataset in TEXT_DATASETS:
+        raise ValueError("The text files of the dataset {} must be opened "
+                         "with open_text_corpus".format(dataset))
+    else:
+        path = get_path(dataset)
+        if os.path.isdir(path):
+            cache_path = path
+        else:
+            cache_path = get_cache_path(path)
+            if not os.path.isdir(cache_path):
+                extract_archive(path, cache_path)
+        data = MappedCorpus(cache_path)
+    _opened_corpora[dataset] = data
+    return data
 
 
 def has_indices(dataset):
@@ -37,12 +255,20 @@ def has_indices(dataset):
         return True
     elif dataset == "penntree":
         return True
+    elif dataset == "mytext":
+        return True
     elif dataset == "toy":
         return True
     elif dataset == "xml":
         return True
     elif dataset == "sine":
         return False
+    elif dataset == "toy_procedural":
+        return True
+    elif dataset == "xml_procedural":
+        return True
+    elif dataset == "sine_procedural":
+        return False
     else:
         assert False
 
@@ -55,104 +281,383 @@ def get_output_size(dataset):
         return data["feature_size"]
 
 
+def get_index_dtype(dataset):
+    """Name of the dtype used to store (and stream) the character indices.
+
+    The symbolic inputs of the model must be declared with this dtype, the
+    indices are only widened inside the computation graph.
+
+    """
+    data = get_data(dataset)
+    if "train" not in data:
+        return str(compact_dtype(data["vocab_size"]))
+    return str(data["train"].dtype)
+
+
 def get_character(dataset):
     data = get_data(dataset)
     return data["vocab"]
 
 
+def has_documents(dataset):
+    """Whether the corpus is made of separate documents.
+
+    The boundaries of the documents of each split are stored in the array
+    `<split>_offsets`, the minibatches are then built by
+    :class:`DocumentBuckets`.
+
+    """
+    data = get_data(dataset)
+    return 'train_offsets' in data.keys()
+
+
 def has_mask(dataset):
     data = get_data(dataset)
-    return 'mask' in data.keys()
+    return 'mask' in data.keys() or has_documents(dataset)
+
+
+def get_vocabulary(dataset):
+    if dataset not in _vocabularies:
+        _vocabularies[dataset] = Vocabulary(get_character(dataset))
+    return _vocabularies[dataset]
 
 
 def conv_into_char(vector, dataset):
-    correspondance = get_character(dataset)
-    return correspondance[vector]
+    return get_vocabulary(dataset).decode(vector)
+
+
+class CharacterCorpus(Dataset):
+
+    """Minibatches of a one dimensional corpus of character indices.
+
+    The corpus is cut into `mini_batch_size` contiguous columns, and the
+    minibatch number `i` holds the characters
+    `[i * stride, i * stride + time_length)` of every column, so that the
+    hidden states can be carried from one minibatch to the next.
+
+    With the default `offsets='fixed'`, the columns are a view of the
+    (possibly memory-mapped) corpus: nothing is copied before iteration,
+    and only the targets of the requested minibatch are built.
+
+    The other modes change the batch boundaries at every epoch, without
+    materializing a shuffled copy of the corpus. Each minibatch is then
+    gathered from the corpus with a single fancy-indexing operation.
+
+    Parameters
+    ----------
+    corpus : :class:`~numpy.ndarray`
+        1D array of character indices.
+    time_length : int
+        Number of time steps of each minibatch.
+    mini_batch_size : int
+        Number of columns of each minibatch.
+    offsets : str, optional
+        'fixed' always uses the same columns. 'contiguous' shifts the
+        columns by a random offset drawn at the beginning of each epoch:
+        the columns stay contiguous from one minibatch to the next, so the
+        hidden states can still be carried. 'random' draws an independent
+        start position for every sequence of every minibatch; the hidden
+        states must then be reset after each minibatch.
+    rng : :class:`~numpy.random.RandomState`, optional
+        The random generator used to draw the offsets.
+    stride : int, optional
+        The number of time steps between the starts of two consecutive
+        minibatches, `time_length` by default. With a smaller stride the
+        windows overlap, and only their last `stride` time steps are new
+        (truncated backpropagation through time with a horizon longer than
+        the stride).
+    shard : tuple of int, optional
+        `(index, count)` for the data-parallel workers: the corpus is cut
+        into `count * mini_batch_size` columns, and the minibatches only
+        hold the `mini_batch_size` columns of the shard `index`.
+
+    """
+    provides_sources = ('features', 'targets')
+
+    def __init__(self, corpus, time_length, mini_batch_size, offsets='fixed',
+                 rng=None, stride=None, shard=(0, 1), **kwargs):
+        if offsets not in ('fixed', 'contiguous', 'random'):
+            raise ValueError("unknown offsets: " + offsets)
+        self.corpus = corpus
+        self.time_length = time_length
+        self.mini_batch_size = mini_batch_size
+        self.offsets = offsets
+        if stride is None:
+            stride = time_length
+        self.stride = stride
+        if rng is None:
+            rng = numpy.random.RandomState(config.default_seed)
+        self.rng = rng
+
+        index, count = shard
+        self.num_columns = mini_batch_size * count
+        self.shard = slice(index * mini_batch_size,
+                           (index + 1) * mini_batch_size)
+
+        if offsets == 'fixed':
+            windows = corpus.shape[0] // (self.num_columns * time_length)
+        else:
+            # Keep at least one character after the last window for its
+            # targets
+            windows = (corpus.shape[0] - 1) // (self.num_columns *
+                                                time_length)
+        self.column_length = windows * time_length
+        self.num_examples = max(
+            0, (self.column_length - time_length) // stride + 1)
+
+        # Time X Batch view of the corpus
+        total_chars = self.column_length * self.num_columns
+        self.columns = corpus[:total_chars].reshape(
+            (self.num_columns, self.column_length)).T[:, self.shard]
+
+        # Offsets of the window of each time step, including the targets
+        self.window = numpy.arange(time_length + 1)[:, None]
+        super(CharacterCorpus, self).__init__(**kwargs)
+
+    def open(self):
+        if self.offsets != 'contiguous':
+            return None
+        # Start of each column for the current epoch. The columns are
+        # shifted together, so that they do not overlap
+        slack = (self.corpus.shape[0] - 1 -
+                 self.column_length * self.num_columns)
+        starts = (self.column_length * numpy.arange(self.num_columns) +
+                  self.rng.randint(0, slack + 1))
+        return starts[self.shard]
+
+    def get_data(self, state=None, request=None):
+        if self.offsets == 'fixed':
+            return self.get_fixed_data(request)
+
+        if self.offsets == 'contiguous':
+            starts = state + request * self.stride
+        else:
+            starts = self.rng.randint(
+                0, self.corpus.shape[0] - self.time_length,
+                self.mini_batch_size)
+        window = self.corpus[starts[None, :] + self.window]
+        return self.filter_sources((window[:-1], window[1:]))
+
+    def get_fixed_data(self, request):
+        start = request * self.stride
+        end = start + self.time_length
+        features = self.columns[start:end]
+
+        # The targets are the features shifted by one time step, the last
+        # character of each column has no target
+        targets = numpy.empty_like(features)
+        targets[:-1] = features[1:]
+        if end < self.column_length:
+            targets[-1] = self.columns[end]
+        else:
+            targets[-1] = 0
+        return self.filter_sources((features, targets))
 
 
 def get_stream_char(dataset, which_set, time_length, mini_batch_size,
-                    total_train_chars=None):
+                    total_train_chars=None, offsets='fixed', stride=None,
+                    shard=(0, 1), rng=None):
     data = get_data(dataset)
 
     # dataset is one long string containing the whole sequence of indexes
-    dataset = data[which_set]
-    if total_train_chars is None:
-        total_train_chars = dataset.shape[0]
+    corpus = data[which_set]
+    if total_train_chars is not None:
+        corpus = corpus[:total_train_chars]
 
-    nb_mini_batches = total_train_chars / (mini_batch_size * time_length)
-    total_train_chars = nb_mini_batches * mini_batch_size * time_length
-
-    dataset = dataset[:total_train_chars]
-
-    dataset = dataset.reshape(
-        mini_batch_size, total_train_chars / mini_batch_size)
-    dataset = dataset.T
-
-    targets_dataset = dataset[1:, :]
-    targets_dataset = numpy.concatenate(
-        (targets_dataset,
-         numpy.zeros((1, mini_batch_size)).astype(numpy.int64)), axis=0)
+    dataset = CharacterCorpus(corpus, time_length, mini_batch_size, offsets,
+                              rng=rng, stride=stride, shard=shard)
+    stream = DataStream(dataset,
+                        iteration_scheme=SequentialExampleScheme(
+                            dataset.num_examples))
+    return stream
 
-    dataset = dataset.reshape(
-        nb_mini_batches,
-        time_length, mini_batch_size)
-    targets_dataset = targets_dataset.reshape(
-        nb_mini_batches,
-        time_length, mini_batch_size)
 
-    dataset = IndexableDataset({'features': dataset,
-                                'targets': targets_dataset})
+class DocumentBuckets(Dataset):
+
+    """Padded minibatches of documents of similar lengths.
+
+    The documents longer than `time_length` time steps are cut into
+    pieces of `time_length` steps. At the beginning of each epoch, the
+    pieces are shuffled and grouped into buckets of `bucket_batches`
+    minibatches. Each bucket is sorted by length before being cut into
+    minibatches, so that the pieces of a minibatch have similar lengths
+    and little padding. The order of the minibatches is then shuffled.
+
+    A minibatch is as long as its longest piece. The `mask` is 0 on the
+    padding, whose features and targets repeat the last character of the
+    piece. The minibatches hold unrelated pieces, so the hidden states
+    must be reset after each of them.
+
+    Parameters
+    ----------
+    corpus : :class:`~numpy.ndarray`
+        1D array of character indices.
+    offsets : :class:`~numpy.ndarray`
+        The boundaries of the documents: the document `i` is
+        `corpus[offsets[i]:offsets[i + 1]]`.
+    time_length : int
+        The maximum number of time steps of a minibatch.
+    mini_batch_size : int
+        Number of pieces of each minibatch.
+    bucket_batches : int, optional
+        Number of minibatches of each bucket. Larger buckets give less
+        padding and less random minibatches.
+    rng : :class:`~numpy.random.RandomState`, optional
+        The random generator used to shuffle the pieces.
+
+    """
+    provides_sources = ('features', 'targets', 'mask')
+
+    def __init__(self, corpus, offsets, time_length, mini_batch_size,
+                 bucket_batches=100, rng=None, **kwargs):
+        self.corpus = corpus
+        self.time_length = time_length
+        self.mini_batch_size = mini_batch_size
+        self.bucket_batches = bucket_batches
+        if rng is None:
+            rng = numpy.random.RandomState(config.default_seed)
+        self.rng = rng
+
+        # The last character of a document is only a target
+        offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        starts = offsets[:-1]
+        steps = numpy.diff(offsets) - 1
+        starts, steps = starts[steps > 0], steps[steps > 0]
+
+        # Cut the documents into pieces of at most time_length steps
+        pieces = -(-steps // time_length)
+        piece = (numpy.arange(pieces.sum()) -
+                 numpy.repeat(numpy.cumsum(pieces) - pieces, pieces))
+        self.starts = numpy.repeat(starts, pieces) + piece * time_length
+        self.lengths = numpy.minimum(
+            numpy.repeat(steps, pieces) - piece * time_length, time_length)
+        self.num_examples = len(self.starts) // mini_batch_size
+        super(DocumentBuckets, self).__init__(**kwargs)
+
+    def open(self):
+        """The pieces of each minibatch of the epoch."""
+        batch_size = self.mini_batch_size
+        order = self.rng.permutation(len(self.starts))
+        order = order[:self.num_examples * batch_size]
+
+        bucket_size = batch_size * self.bucket_batches
+        for start in range(0, len(order), bucket_size):
+            bucket = order[start:start + bucket_size]
+            order[start:start + bucket_size] = bucket[
+                numpy.argsort(self.lengths[bucket], kind='mergesort')]
+        batches = order.reshape((self.num_examples, batch_size))
+
+        if self.num_examples > 0:
+            lengths = self.lengths[batches]
+            logger.info("Padding of the minibatches: {:.1%}".format(
+                1 - lengths.sum() / float(lengths.max(axis=1).sum() *
+                                          batch_size)))
+        return batches[self.rng.permutation(self.num_examples)]
+
+    def get_data(self, state=None, request=None):
+        batch = state[request]
+        starts = self.starts[batch]
+        lengths = self.lengths[batch]
+
+        steps = numpy.arange(lengths.max() + 1)[:, None]
+        window = self.corpus[starts[None, :] +
+                             numpy.minimum(steps, lengths[None, :])]
+        # Float32, as the mask of the model
+        mask = (steps[:-1] < lengths[None, :]).astype(numpy.float32)
+        return self.filter_sources((window[:-1], window[1:], mask))
+
+
+def get_stream_documents(dataset, which_set, time_length, mini_batch_size,
+                         bucket_batches=100):
+    data = get_data(dataset)
+    dataset = DocumentBuckets(data[which_set], data[which_set + '_offsets'],
+                              time_length, mini_batch_size, bucket_batches)
     stream = DataStream(dataset,
                         iteration_scheme=SequentialExampleScheme(
-                            nb_mini_batches))
+                            dataset.num_examples))
     return stream
 
 
+class RawSequences(Dataset):
+
+    """Minibatches of a 3D array of raw sequences.
+
+    The array has the shape (time, batch, features) and is usually
+    memory-mapped. The minibatch number `i` holds the sequences
+    `[i * mini_batch_size, (i + 1) * mini_batch_size)`. Both the features
+    and the targets, which are the same sequences shifted by one time
+    step, are views of the array.
+
+    Parameters
+    ----------
+    data : :class:`~numpy.ndarray`
+        3D array of shape (time, batch, features).
+    mini_batch_size : int
+        Number of sequences of each minibatch.
+
+    """
+    provides_sources = ('features', 'targets')
+
+    def __init__(self, data, mini_batch_size, **kwargs):
+        self.data = data
+        self.mini_batch_size = mini_batch_size
+        self.num_examples = data.shape[1] // mini_batch_size
+        super(RawSequences, self).__init__(**kwargs)
+
+    def get_data(self, state=None, request=None):
+        sequences = slice(request * self.mini_batch_size,
+                          (request + 1) * self.mini_batch_size)
+        return self.filter_sources((self.data[:, sequences],
+                                    self.data[1:, sequences]))
+
+
 def get_stream_raw(dataset, which_set, mini_batch_size):
     data = get_data(dataset)
 
     # dataset is a 3D array of shape: Time X Batch X Features
-    dataset = data[which_set]
-    time, batch, features = dataset.shape
-    nb_mini_batches = batch / mini_batch_size
-    dataset = dataset[:, :nb_mini_batches * mini_batch_size, :]
-
-    # Create the target_dataset
-    targets_dataset = dataset[1:, :, :]
-
-    # Cut the dataset into several minibatches
-    # dataset is now 4D (nb_mini_batches X Time X mini_batch_size X Features)
-    dataset = numpy.swapaxes(dataset, 0, 1)
-    targets_dataset = numpy.swapaxes(targets_dataset, 0, 1)
-    dataset = numpy.reshape(dataset, (nb_mini_batches, mini_batch_size,
-                                      time, features))
-    targets_dataset = numpy.reshape(targets_dataset, (nb_mini_batches,
-                                                      mini_batch_size,
-                                                      time - 1, features))
-    dataset = numpy.swapaxes(dataset, 1, 2)
-    targets_dataset = numpy.swapaxes(targets_dataset, 1, 2)
-
-    # Create fuel dataset
-    dataset = IndexableDataset({'features': dataset,
-                                'targets': targets_dataset})
+    dataset = RawSequences(data[which_set], mini_batch_size)
     stream = DataStream(dataset,
                         iteration_scheme=SequentialExampleScheme(
-                            nb_mini_batches))
+                            dataset.num_examples))
     return stream
 
 
 def get_minibatch(dataset, mini_batch_size, mini_batch_size_valid,
-                  time_length, total_train_chars=None):
-
-    if has_indices(dataset):
+                  time_length, total_train_chars=None, prefetch=0,
+                  offsets='fixed', procedural_batches=(1000, 20),
+                  generation_workers=0, stride=None, bucket_batches=100):
+
+    if is_procedural(dataset):
+        train_batches, valid_batches = procedural_batches
+        train_stream = get_stream_procedural(dataset, "train", time_length,
+                                             mini_batch_size, train_batches,
+                                             generation_workers)
+        valid_stream = get_stream_procedural(dataset, "valid", time_length,
+                                             mini_batch_size_valid,
+                                             valid_batches,
+                                             generation_workers)
+    elif has_indices(dataset) and has_documents(dataset):
+        train_stream = get_stream_documents(dataset, "train", time_length,
+                                            mini_batch_size, bucket_batches)
+        valid_stream = get_stream_documents(dataset, "valid", time_length,
+                                            mini_batch_size_valid,
+                                            bucket_batches)
+    elif has_indices(dataset):
+        # Only the training windows overlap, the validation carries the
+        # states of the last step of its windows
         train_stream = get_stream_char(dataset, "train", time_length,
-                                       mini_batch_size, total_train_chars)
+                                       mini_batch_size, total_train_chars,
+                                       offsets, stride)
         valid_stream = get_stream_char(dataset, "valid", time_length,
                                        mini_batch_size_valid,
                                        total_train_chars)
     else:
         train_stream = get_stream_raw(dataset, "train", mini_batch_size)
         valid_stream = get_stream_raw(dataset, "valid", mini_batch_size_valid)
+
+    if prefetch > 0:
+        train_stream = PrefetchingDataStream(train_stream, prefetch)
+        valid_stream = PrefetchingDataStream(valid_stream, prefetch)
     return train_stream, valid_stream
 
 if __name__ == "__main__":
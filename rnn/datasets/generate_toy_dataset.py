@@ -7,44 +7,72 @@ class GenerateToy(object):
         self.continue_prob = continue_prob
         self.depth = depth
 
-    def generate(self, length):
-        stack = [0]
-        generated = [0]
-        best_score = 0
-        probability = np.array(
-            [1 - self.continue_prob, self.continue_prob, 0.])
+    def generate_batch(self, length, batch, rng=np.random):
+        """Generate `batch` independent sequences at once.
+
+        Each sequence is a Markov chain with its own stack. All the chains
+        advance together, one vectorized step at a time, and each stack is
+        a row of an array.
+
+        Returns
+        -------
+        generated : :class:`~numpy.ndarray`
+            The sequences, of shape (length + 1, batch).
+        best_score : float
+            The entropy of the process, in bits per symbol.
+
+        """
+        continue_prob = self.continue_prob
+        lanes = np.arange(batch)
+        generated = np.zeros((length + 1, batch), dtype=np.uint8)
+        stack = np.zeros((batch, 16), dtype=np.int64)
+        height = np.zeros(batch, dtype=np.int64)
+        top = np.zeros(batch, dtype=np.int64)
+        score = np.zeros(batch)
 
         for i in range(length):
+            draws = rng.uniform(size=(2, batch))
 
-            probability[0] = (1 - self.continue_prob) * \
-                (1 - stack[-1] / (self.depth - 1.))
-            probability[2] = (1 - self.continue_prob) * \
-                (stack[-1] / (self.depth - 1.))
+            open_prob = (1 - continue_prob) * (1 - top / (self.depth - 1.))
+            close_prob = (1 - continue_prob) * (top / (self.depth - 1.))
 
-            choice = np.random.choice(3, 1, p=probability)[0]
+            # Same order as np.random.choice(3, p=[open, continue, close])
+            opened = draws[0] < open_prob
+            closed = draws[0] >= open_prob + continue_prob
 
-            # Continue
-            if choice == 1:
-                generated.append(stack[-1])
-                best_score += np.log2(self.continue_prob)
+            score += np.where(
+                opened,
+                np.log2(continue_prob / (self.depth - top)),
+                np.where(closed, np.log2(np.maximum(close_prob, 1e-300)),
+                         np.log2(continue_prob)))
 
-            # Close recursion
-            if choice == 2:
-                stack.pop()
-                generated.append(stack[-1])
-                best_score += np.log2(probability[2])
+            # Open a new depth of recursion with a symbol in [top, depth)
+            height += opened
+            height -= closed
+            if height.max() >= stack.shape[1]:
+                stack = np.hstack([stack, np.zeros_like(stack)])
+            new_char = top + (draws[1] * (self.depth - top)).astype(np.int64)
+            stack[lanes[opened], height[opened]] = new_char[opened]
 
-            # Open a new depth of recursion
-            if choice == 0:
-                best_score += np.log2(probability[1] /
-                                      (self.depth - stack[-1]))
-                new_char = np.random.randint(
-                    low=stack[-1], high=self.depth, size=1)[0]
-                stack.append(new_char)
-                generated.append(new_char)
+            # Continue and close recursion both emit the top of the stack
+            top = stack[lanes, height]
+            generated[i + 1] = top
 
-        best_score = - best_score / float(length)
-        return np.array(generated).astype(np.int16), best_score
+        best_score = - score.sum() / float(length * batch)
+        return generated, best_score
+
+    def generate(self, length, rng=np.random, lanes=1):
+        """Generate one sequence of `length + 1` symbols.
+
+        With `lanes > 1`, the sequence is the concatenation of `lanes`
+        independent chains, which is much faster to generate.
+
+        """
+        lane_length = -(-length // lanes)
+        generated, best_score = self.generate_batch(lane_length, lanes, rng)
+        generated = generated[1:].T.flatten()[:length]
+        generated = np.concatenate([[0], generated]).astype(np.int16)
+        return generated, best_score
 
 
 def save(destination, train, valid, test, depth):
@@ -69,11 +97,11 @@ if __name__ == "__main__":
     print train
     # # Valid
     # max_length = 500000
-    # valid, best_score = gen.generate(max_length)
+    # valid, best_score = gen.generate(max_length, lanes=1000)
 
-    # # Train
+    # # Test
     # max_length = 500000
-    # test, best_score = gen.generate(max_length)
+    # test, best_score = gen.generate(max_length, lanes=1000)
 
     # save("/media/win/Users/Eloi/dataset/toy_dependencies/new_05_40",
     #      train,
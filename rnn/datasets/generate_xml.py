@@ -1,9 +1,9 @@
-import random
-import string
 import collections
 
 import numpy as np
 
+from rnn.datasets.vocabulary import Vocabulary
+
 
 class GenerateXML(object):
 
@@ -12,52 +12,88 @@ class GenerateXML(object):
         self.low_number = low_number
         self.max_number = max_number
 
-    def generate(self, length):
-        # Initialize
-        stack = []
-        generated = []
-        current_depth = 0.
-        probability = np.array([1, 0.])
-        string_length = 0
-        best_score = 0
+    def generate_batch(self, length, batch, rng=np.random):
+        """Generate the texts of `batch` independent processes at once.
+
+        Each process opens or closes `length` tags. The processes advance
+        together, one vectorized step at a time, with their stacks of open
+        tags stored as rows of an array.
+
+        Returns
+        -------
+        chars : :class:`~numpy.ndarray`
+            The concatenated texts, as ASCII codes of dtype uint8.
+        lane_starts : :class:`~numpy.ndarray`
+            The position of the text of each process in `chars`.
+        string_length : int
+            The total number of characters.
+
+        """
+        max_depth = int(self.depth)
+        lanes = np.arange(batch)
+        stack_lengths = np.zeros((batch, max_depth + 1), dtype=np.int64)
+        stack_tags = np.zeros((batch, max_depth + 1, self.max_number - 1),
+                              dtype=np.uint8)
+        current_depth = np.zeros(batch, dtype=np.int64)
+
+        closed = np.zeros((batch, length), dtype=bool)
+        tag_lengths = np.zeros((batch, length), dtype=np.int64)
+        tags = np.zeros((batch, length, self.max_number - 1), dtype=np.uint8)
 
         for i in range(length):
-
-            probability[0] = (self.depth - current_depth) / self.depth
-            probability[1] = 1 - (self.depth - current_depth) / self.depth
-
-            choice = np.random.choice(2, 1, p=probability)[0]
-
-            # Open
-            if choice == 0:
-                current_depth += 1
-
-                # Create tag
-                tag_length = np.random.randint(
-                    low_number, max_number, size=1)[0]
-
-                tag = ''.join(
-                    random.SystemRandom().choice(string.ascii_lowercase)
-                    for _ in range(tag_length))
-
-                # Add the tag to the stack
-                stack.append(tag)
-
-                # Add the tag to the generated
-                generated.append("<" + tag + "> ")
-
-                string_length += 3 + tag_length
-
-            # Close recursion
-            if choice == 1:
-                current_depth -= 1
-                tag = stack.pop()
-                generated.append("</" + tag + "> ")
-
-                string_length += 4 + len(tag)
-
-        generated = "".join(generated)
-        return generated, best_score, string_length
+            open_prob = (self.depth - current_depth) / float(self.depth)
+            opened = rng.uniform(size=batch) < open_prob
+
+            # Open: push a new tag
+            current_depth += opened
+            new_lengths = rng.randint(self.low_number, self.max_number,
+                                      size=batch)
+            new_tags = rng.randint(ord('a'), ord('z') + 1,
+                                   size=(batch, self.max_number - 1))
+            stack_lengths[lanes[opened], current_depth[opened]] = \
+                new_lengths[opened]
+            stack_tags[lanes[opened], current_depth[opened]] = \
+                new_tags[opened]
+
+            # Both cases write the tag at the top of the stack
+            tag_lengths[:, i] = stack_lengths[lanes, current_depth]
+            tags[:, i] = stack_tags[lanes, current_depth]
+            closed[:, i] = ~opened
+
+            # Close: pop the tag
+            current_depth -= ~opened
+
+        # Each tag is written "<" "/" letters ">" " " without the unused
+        # letters, and without the "/" when it is opened
+        template = np.zeros(closed.shape + (self.max_number + 3,),
+                            dtype=np.uint8)
+        template[..., 0] = ord('<')
+        template[..., 1] = ord('/')
+        template[..., 2:-2] = tags
+        template[..., -2] = ord('>')
+        template[..., -1] = ord(' ')
+
+        used = np.ones(template.shape, dtype=bool)
+        used[..., 1] = closed
+        used[..., 2:-2] = (np.arange(self.max_number - 1) <
+                           tag_lengths[..., None])
+
+        chars = template[used]
+        lane_lengths = used.sum(axis=(1, 2))
+        lane_starts = np.concatenate([[0], np.cumsum(lane_lengths)[:-1]])
+        return chars, lane_starts, len(chars)
+
+    def generate(self, length, rng=np.random, lanes=1):
+        """Generate a text with `length` opened or closed tags.
+
+        With `lanes > 1`, the text is the concatenation of the texts of
+        `lanes` independent processes, which is much faster to generate.
+
+        """
+        lane_length = -(-length // lanes)
+        chars, _, string_length = self.generate_batch(lane_length, lanes,
+                                                      rng)
+        return chars.tostring(), 0, string_length
 
 
 def get_vocab(text):
@@ -68,8 +104,7 @@ def get_vocab(text):
 
 
 def string_parser(text, vocab):
-    transormed_text = map(lambda char: vocab.index(char), text)
-    return np.array(transormed_text).astype(np.int16)
+    return Vocabulary(vocab).encode(text)
 
 
 def save(destination, train, valid, test, vocab):
@@ -90,18 +125,21 @@ if __name__ == "__main__":
 
     # Train
     max_length = 1000000
-    text, best_score, string_length = gen.generate(max_length)
+    text, best_score, string_length = gen.generate(max_length,
+                                                   lanes=1000)
     vocab = get_vocab(text)
     train = string_parser(text, vocab)
 
     # Valid
     max_length = 50000
-    text, best_score, string_length = gen.generate(max_length)
+    text, best_score, string_length = gen.generate(max_length,
+                                                   lanes=100)
     valid = string_parser(text, vocab)
 
     # Test
     max_length = 50000
-    text, best_score, string_length = gen.generate(max_length)
+    text, best_score, string_length = gen.generate(max_length,
+                                                   lanes=100)
     test = string_parser(text, vocab)
 
     save("/media/win/Users/Eloi/dataset/xml_tags/data",
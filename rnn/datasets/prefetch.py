@@ -0,0 +1,102 @@
+import sys
+import threading
+
+import numpy
+import six
+from six.moves import queue
+
+from fuel.streams import AbstractDataStream
+from fuel.transformers import Transformer
+
+# Time between two checks of the stop event by a blocked producer
+POLL_INTERVAL = 0.1
+
+
+class _EndOfEpoch(object):
+    pass
+
+
+class PrefetchingDataStream(Transformer):
+
+    """Prepares the next minibatches of a stream in a background thread.
+
+    The wrapped stream is iterated in a daemon thread which materializes
+    every minibatch (page faults of memory-mapped corpora, contiguous
+    copies of strided views) and stores it in a bounded queue. The order
+    of the minibatches is preserved, so the hidden states can still be
+    carried from one minibatch to the next.
+
+    Parameters
+    ----------
+    data_stream : instance of :class:`AbstractDataStream`
+        The stream to prefetch from.
+    prefetch : int
+        The maximum number of minibatches prepared in advance.
+
+    """
+
+    def __init__(self, data_stream, prefetch=2, **kwargs):
+        kwargs.setdefault('produces_examples',
+                          data_stream.produces_examples)
+        super(PrefetchingDataStream, self).__init__(data_stream, **kwargs)
+        self.prefetch = prefetch
+        self._thread = None
+        self._queue = None
+        self._stop = None
+
+    def get_epoch_iterator(self, **kwargs):
+        self.stop_prefetching()
+        self.child_epoch_iterator = self.data_stream.get_epoch_iterator()
+        self._queue = queue.Queue(maxsize=self.prefetch)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=_produce,
+            args=(self.child_epoch_iterator, self._queue, self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+        # Skip Transformer.get_epoch_iterator, the child iterator is
+        # already consumed by the producer thread
+        return AbstractDataStream.get_epoch_iterator(self, **kwargs)
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        data = self._queue.get()
+        if isinstance(data, _EndOfEpoch):
+            raise StopIteration
+        if isinstance(data, BaseException):
+            six.reraise(type(data), data, data.traceback)
+        return data
+
+    def stop_prefetching(self):
+        """Stop the producer thread of the current epoch, if any."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop_prefetching()
+        super(PrefetchingDataStream, self).close()
+
+
+def _produce(epoch_iterator, batches, stop):
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for data in epoch_iterator:
+            data = tuple(numpy.ascontiguousarray(source) for source in data)
+            if not put(data):
+                return
+    except Exception as e:
+        e.traceback = sys.exc_info()[2]
+        put(e)
+    else:
+        put(_EndOfEpoch())
@@ -0,0 +1,207 @@
+import multiprocessing
+import string
+
+import numpy
+from fuel import config
+from fuel.datasets import Dataset
+from fuel.schemes import SequentialExampleScheme
+from fuel.streams import DataStream
+
+from rnn.datasets.generate_toy_dataset import GenerateToy
+from rnn.datasets.generate_xml import GenerateXML
+from rnn.datasets.sine_wave import GenerateSineWave
+from rnn.datasets.vocabulary import Vocabulary
+
+# Alphabet of the generated XML tags
+XML_VOCAB = Vocabulary(sorted(' /<>' + string.ascii_lowercase))
+
+
+class SineBatches(object):
+
+    """Minibatches of sums of sine waves, see :class:`GenerateSineWave`."""
+
+    def __init__(self, mini_batch_size, depth=5, time=300):
+        self.mini_batch_size = mini_batch_size
+        self.generator = GenerateSineWave(depth, time)
+
+    def __call__(self, seed):
+        rng = numpy.random.RandomState(seed)
+        # Time X Batch X Features
+        data = self.generator.generate(self.mini_batch_size, rng)
+        return data, data[1:]
+
+
+class ToyBatches(object):
+
+    """Minibatches of the toy dependencies, see :class:`GenerateToy`."""
+
+    def __init__(self, time_length, mini_batch_size, continue_prob=0.5,
+                 depth=40):
+        self.time_length = time_length
+        self.mini_batch_size = mini_batch_size
+        self.generator = GenerateToy(continue_prob, depth)
+
+    def __call__(self, seed):
+        rng = numpy.random.RandomState(seed)
+        # (Time + 1) X Batch, the generated sequences start with 0
+        window, _ = self.generator.generate_batch(
+            self.time_length, self.mini_batch_size, rng)
+        return window[:-1], window[1:]
+
+
+class XMLBatches(object):
+
+    """Minibatches of nested XML tags, see :class:`GenerateXML`."""
+
+    def __init__(self, time_length, mini_batch_size, depth=40.,
+                 low_number=2, max_number=10):
+        self.time_length = time_length
+        self.mini_batch_size = mini_batch_size
+        self.generator = GenerateXML(depth, low_number, max_number)
+
+    def __call__(self, seed):
+        rng = numpy.random.RandomState(seed)
+        # Each tag has at least `low_number + 3` characters
+        length = (self.time_length + 1) // (self.generator.low_number + 3) + 1
+        chars, lane_starts, _ = self.generator.generate_batch(
+            length, self.mini_batch_size, rng)
+        # (Time + 1) X Batch
+        positions = lane_starts + numpy.arange(self.time_length + 1)[:, None]
+        window = XML_VOCAB.encode(chars[positions])
+        return window[:-1], window[1:]
+
+
+def _generate_chunk(args):
+    generator, size, seed, kwargs = args
+    return generator.generate(size, numpy.random.RandomState(seed), **kwargs)
+
+
+def generate_in_pool(generator, sizes, seed, processes, **kwargs):
+    """Generate chunks of a dataset in parallel.
+
+    The chunk number `i` is generated by `generator.generate(sizes[i])`
+    with the seed `(seed, i)`, whatever the number of processes.
+
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_generate_chunk,
+                        [(generator, size, [seed, i], kwargs)
+                         for i, size in enumerate(sizes)])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_generator(dataset, time_length, mini_batch_size):
+    if dataset == "sine_procedural":
+        return SineBatches(mini_batch_size)
+    elif dataset == "toy_procedural":
+        return ToyBatches(time_length, mini_batch_size)
+    elif dataset == "xml_procedural":
+        return XMLBatches(time_length, mini_batch_size)
+    else:
+        assert False
+
+
+def get_metadata(dataset):
+    """The arrays that an extracted corpus would provide, without data."""
+    if dataset == "sine_procedural":
+        return {'feature_size': 1}
+    elif dataset == "toy_procedural":
+        depth = 40
+        return {'vocab': numpy.arange(depth).astype(str),
+                'vocab_size': depth}
+    elif dataset == "xml_procedural":
+        return {'vocab': XML_VOCAB.code_to_char,
+                'vocab_size': len(XML_VOCAB)}
+    else:
+        assert False
+
+
+class ProceduralDataset(Dataset):
+
+    """Minibatches generated on the fly.
+
+    The minibatch number `i` of the epoch `e` is generated from the seed
+    `(seed, e, i)`, so that any minibatch can be reproduced. Validation sets
+    use `fresh_epochs=False` and see the same minibatches at every epoch.
+
+    Parameters
+    ----------
+    generate : callable
+        Picklable callable which takes a seed and returns the tuple
+        `(features, targets)` of a minibatch.
+    num_examples : int
+        The number of minibatches of an epoch.
+    seed : int
+        The seed of the whole dataset.
+    fresh_epochs : bool, optional
+        Whether each epoch generates new minibatches.
+    workers : int, optional
+        The number of processes generating the next minibatches in
+        advance. If 0, the minibatches are generated when requested. The
+        processes are started by :meth:`open` and stopped by
+        :meth:`close`.
+
+    """
+    provides_sources = ('features', 'targets')
+
+    def __init__(self, generate, num_examples, seed, fresh_epochs=True,
+                 workers=0, **kwargs):
+        self.generate = generate
+        self.num_examples = num_examples
+        self.seed = seed
+        self.fresh_epochs = fresh_epochs
+        self.workers = workers
+        self.epochs = 0
+        self.pool = None
+        super(ProceduralDataset, self).__init__(**kwargs)
+
+    def open(self):
+        # The stream opens the dataset when it is created: the workers are
+        # forked early, before anything big is allocated in the main process
+        if self.workers > 0 and self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        epoch = self.epochs
+        if self.fresh_epochs:
+            self.epochs += 1
+        # The minibatches being generated by the workers
+        return {'epoch': epoch, 'pending': {}}
+
+    def next_epoch(self, state):
+        # The workers are kept from one epoch to the next
+        return self.open()
+
+    def close(self, state):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def get_seed(self, state, request):
+        return [self.seed, state['epoch'], request]
+
+    def get_data(self, state=None, request=None):
+        if self.pool is None:
+            data = self.generate(self.get_seed(state, request))
+        else:
+            pending = state['pending']
+            last = min(request + 2 * self.workers, self.num_examples)
+            for i in range(request, last):
+                if i not in pending:
+                    pending[i] = self.pool.apply_async(
+                        self.generate, (self.get_seed(state, i),))
+            data = pending.pop(request).get()
+        return self.filter_sources(data)
+
+
+def get_stream_procedural(dataset, which_set, time_length, mini_batch_size,
+                          num_batches, workers=0):
+    generate = get_generator(dataset, time_length, mini_batch_size)
+    seed = config.default_seed + (which_set != "train")
+    dataset = ProceduralDataset(generate, num_batches, seed,
+                                fresh_epochs=(which_set == "train"),
+                                workers=workers)
+    return DataStream(dataset,
+                      iteration_scheme=SequentialExampleScheme(num_batches))
@@ -1,6 +1,11 @@
+import multiprocessing
+
 import numpy as np
 import matplotlib.pyplot as plt
 
+# Number of sequences synthesized at once, bounds the temporary memory
+CHUNK_SIZE = 10000
+
 
 class GenerateSineWave(object):
 
@@ -8,15 +13,18 @@ class GenerateSineWave(object):
         self.depth = depth
         self.time = time
 
-    def generate(self, batch):
+    def generate(self, batch, rng=np.random):
         data = np.zeros((self.time, batch), dtype=np.float32)
-        for i in range(batch):
-            for d in range(depth):
-                phase = np.random.randn(1)[0]
-                sin = np.sin(phase +
-                             (2 * d + 1 + 0.1 * np.random.randn(1)[0]) *
-                             np.linspace(0, 5 * 2 * np.pi, self.time))
-                data[:, i] += sin / (2 * d + 1)
+        time = np.linspace(0, 5 * 2 * np.pi, self.time)[:, None]
+
+        # Broadcast over the sequences of each chunk: Time X Batch
+        for start in range(0, batch, CHUNK_SIZE):
+            chunk = data[:, start:start + CHUNK_SIZE]
+            size = chunk.shape[1]
+            for d in range(self.depth):
+                phase = rng.randn(size)
+                frequency = 2 * d + 1 + 0.1 * rng.randn(size)
+                chunk += np.sin(phase + frequency * time) / (2 * d + 1)
 
         # Normalize the data
         data /= np.max(np.abs(data), axis=0)
@@ -34,21 +42,26 @@ def save(destination, train, valid, test):
 
 
 if __name__ == "__main__":
+    from rnn.datasets.procedural import generate_in_pool
+
     depth = 10
     time = 300
     generator = GenerateSineWave(depth, time)
+    processes = multiprocessing.cpu_count()
 
     # Train
     batch = 500000
-    train = generator.generate(batch)
+    train = np.concatenate(generate_in_pool(
+        generator, [CHUNK_SIZE] * (batch / CHUNK_SIZE), 0, processes),
+        axis=1)
 
     # Valid
     batch = 10000
-    valid = generator.generate(batch)
+    valid = generator.generate(batch, np.random.RandomState(1))
 
     # Test
     batch = 10000
-    test = generator.generate(batch)
+    test = generator.generate(batch, np.random.RandomState(2))
 
     # Save the data
     save("/media/win/Users/Eloi/dataset/sine_waves/data_10",
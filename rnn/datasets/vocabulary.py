@@ -0,0 +1,105 @@
+import numpy
+
+# Number of byte values, the size of the char -> code lookup array
+NUM_BYTES = 256
+
+
+def compact_dtype(vocab_size):
+    """Smallest unsigned integer dtype able to store `vocab_size` indices."""
+    for dtype in (numpy.uint8, numpy.uint16, numpy.uint32):
+        if vocab_size - 1 <= numpy.iinfo(dtype).max:
+            return numpy.dtype(dtype)
+    return numpy.dtype(numpy.int64)
+
+
+class Vocabulary(object):
+
+    """Converts whole texts to codes and back in vectorized calls.
+
+    The code of a symbol is its position in `symbols`. When all the symbols
+    are single bytes (the character datasets), a text is encoded with one
+    lookup of its bytes into a table of 256 codes. Otherwise (e.g. the
+    numbers of the toy dataset), the symbols are looked up in a dictionary.
+
+    An element of a `S1` array reads as an empty string when it is a NUL
+    byte, so the bytes of such an array are taken from its raw data.
+
+    Parameters
+    ----------
+    symbols : sequence of str
+        The symbol of each code.
+
+    """
+
+    def __init__(self, symbols):
+        self.code_to_char = numpy.asarray(symbols)
+        self.size = len(self.code_to_char)
+        self.dtype = compact_dtype(self.size)
+        if self.code_to_char.dtype == numpy.dtype('S1'):
+            self.is_bytes = True
+            self.byte_values = self.code_to_char.view(numpy.uint8)
+        else:
+            self.is_bytes = all(len(symbol) == 1 and ord(symbol) < NUM_BYTES
+                                for symbol in self.code_to_char)
+            if self.is_bytes:
+                self.byte_values = numpy.array(
+                    [ord(symbol) for symbol in self.code_to_char],
+                    dtype=numpy.uint8)
+        if self.is_bytes:
+            # -1 marks the bytes outside the vocabulary
+            self.char_to_code = -numpy.ones(NUM_BYTES, dtype=numpy.int64)
+            self.char_to_code[self.byte_values] = numpy.arange(self.size)
+        else:
+            self.char_to_code = dict(
+                (symbol, code) for code, symbol in
+                enumerate(self.code_to_char))
+
+    def __len__(self):
+        return self.size
+
+    def encode(self, text):
+        """Codes of a text.
+
+        Parameters
+        ----------
+        text : str or sequence of str
+            A string of bytes, or a sequence of symbols.
+
+        Returns
+        -------
+        codes : :class:`~numpy.ndarray`
+            The 1D array of codes, of the most compact dtype.
+
+        """
+        if not self.is_bytes:
+            try:
+                codes = [self.char_to_code[symbol] for symbol in text]
+            except KeyError as e:
+                raise ValueError("Symbol {!r} is not in the vocabulary"
+                                 .format(e.args[0]))
+            return numpy.array(codes, dtype=self.dtype)
+
+        if isinstance(text, basestring):
+            text = numpy.fromstring(text, dtype=numpy.uint8)
+        else:
+            text = numpy.asarray(text)
+            if text.dtype == numpy.dtype('S1'):
+                text = text.view(numpy.uint8)
+            elif text.dtype != numpy.uint8:
+                text = numpy.fromstring(''.join(text), dtype=numpy.uint8)
+        codes = self.char_to_code[text]
+        unknown = codes < 0
+        if unknown.any():
+            raise ValueError("Character {!r} is not in the vocabulary"
+                             .format(chr(text[unknown.argmax()])))
+        return codes.astype(self.dtype)
+
+    def decode(self, codes):
+        """Array of the symbols of `codes`, of the same shape."""
+        return self.code_to_char[codes]
+
+    def decode_text(self, codes):
+        """The string written by a 1D array of codes."""
+        if self.is_bytes:
+            return self.byte_values[codes].tostring()
+        return ''.join(self.decode(codes))
@@ -10,7 +10,7 @@ from blocks.monitoring.evaluators import (MonitoredQuantityBuffer,
                                           AggregationBuffer)
 from blocks.utils import dict_subset, reraise_as
 
-from rnn.datasets.dataset import has_indices
+from rnn.datasets.dataset import has_documents, has_indices, is_procedural
 from rnn.utils import carry_hidden_state
 
 logger = logging.getLogger()
@@ -122,9 +122,12 @@ class DatasetEvaluator(object):
         outputs = []
         updates = None
 
+        # The generated minibatches are independent sequences
+        reset = (not(has_indices(self.dataset)) or
+                 is_procedural(self.dataset) or has_documents(self.dataset))
         givens, f_updates = carry_hidden_state(state_updates,
                                                self.mini_batch_size,
-                                               reset=not(has_indices(self.dataset)))
+                                               reset=reset)
 
         if self.theano_buffer.accumulation_updates:
             updates = OrderedDict()
@@ -9,16 +9,19 @@ import theano
 
 from blocks.filter import VariableFilter
 from blocks.graph import ComputationGraph
-from blocks.serialization import secure_dump
+from blocks.serialization import load_parameter_values
 from blocks.extensions import SimpleExtension
 from blocks.extensions.monitoring import MonitoringExtension
 
 import matplotlib.pyplot as plt
 from matplotlib.table import Table
 
-from rnn.datasets.dataset import (get_character, conv_into_char,
-                                  get_output_size, has_indices)
-from rnn.utils import carry_hidden_state
+from rnn.build_model.build_model_utils import convert_parameter_values
+from rnn.checkpoint import CheckpointWriter, write_parameter_values
+from rnn.datasets.dataset import (get_vocabulary, conv_into_char,
+                                  get_output_size, has_indices,
+                                  get_index_dtype)
+from rnn.utils import carry_hidden_state, unmasked_inputs
 
 logging.basicConfig(level='INFO')
 logger = logging.getLogger(__name__)
@@ -48,6 +51,10 @@ class EarlyStopping(SimpleExtension):
         A function that takes the current value and the best so far
         and return the best of two. By default :func:`min`, which
         corresponds to tracking the minimum value.
+    writer : :class:`~rnn.checkpoint.CheckpointWriter`, optional
+        The writer of the best model, in the background. The values of
+        the parameters are saved in the format read by
+        :func:`~blocks.serialization.load_parameter_values`.
 
     Attributes
     ----------
@@ -59,35 +66,46 @@ class EarlyStopping(SimpleExtension):
     """
 
     def __init__(self, record_name, patience, path, notification_name=None,
-                 choose_best=min, **kwargs):
+                 choose_best=min, writer=None, **kwargs):
         self.record_name = record_name
         if not notification_name:
             notification_name = record_name + "_best_so_far"
         self.notification_name = notification_name
         self.best_name = "best_" + record_name
         self.choose_best = choose_best
-        self.counter = 0
+        # The counter is kept in the status, to be saved with it
+        self.counter_name = "patience_" + record_name
         self.path = path
         self.patience = patience
+        if writer is None:
+            writer = CheckpointWriter()
+        self.writer = writer
         kwargs.setdefault("after_epoch", True)
+        # Wait for the files which are still being written
+        kwargs.setdefault("after_training", True)
+        kwargs.setdefault("on_interrupt", True)
         super(EarlyStopping, self).__init__(**kwargs)
 
+    @property
+    def counter(self):
+        return self.main_loop.status.get(self.counter_name, 0)
+
+    @counter.setter
+    def counter(self, value):
+        self.main_loop.status[self.counter_name] = value
+
     def _dump(self):
-        try:
-            path = self.path + '/best'
-            self.main_loop.log.current_row['saved_best_to'] = path
-            logger.info("Saving log ...")
-            f = open(self.path + '/log.txt', 'w')
-            f.write(str(self.main_loop.log))
-            f.close()
-            logger.info("Dumping best model ...")
-            secure_dump(
-                self.main_loop.model.parameters, path, use_cpickle=True)
-        except Exception:
-            self.main_loop.log.current_row['saved_best_to'] = None
-            raise
+        path = self.path + '/best'
+        self.main_loop.log.current_row['saved_best_to'] = path
+        logger.info("Dumping best model ...")
+        # The values are copied from the device, the copy is written
+        self.writer.write(path, write_parameter_values,
+                          self.main_loop.model.get_parameter_values())
 
     def do(self, which_callback, *args):
+        if which_callback in ('after_training', 'on_interrupt'):
+            self.writer.flush()
+            return
         current_value = self.main_loop.log.current_row.get(self.record_name)
         if current_value is None:
             self.counter += 1
@@ -122,6 +140,27 @@ class ResetStates(SimpleExtension):
         self.f()
 
 
+class LoadConvertedParameters(SimpleExtension):
+
+    """Load parameter values saved by an older version of the model.
+
+    The values are converted by :func:`convert_parameter_values`, e.g. the
+    separate lookup tables of models saved without `--fused_lookup`.
+
+    """
+
+    def __init__(self, path, args, **kwargs):
+        kwargs.setdefault("before_training", True)
+        super(LoadConvertedParameters, self).__init__(**kwargs)
+        self.path = path
+        self.args = args
+
+    def do(self, which_callback, *args):
+        param_values = convert_parameter_values(
+            load_parameter_values(self.path), self.args)
+        self.main_loop.model.set_parameter_values(param_values)
+
+
 class InteractiveMode(SimpleExtension):
 
     def __init__(self, **kwargs):
@@ -172,8 +211,11 @@ class TextGenerationExtension(SimpleExtension):
         givens, f_updates = carry_hidden_state(updates, 1,
                                                reset=not(self.has_indices))
 
+        inputs, mask_givens = unmasked_inputs(cg.inputs, self.has_indices)
+        givens.extend(mask_givens)
+
         # Compile the theano function
-        self.generate = theano.function(inputs=cg.inputs, outputs=presoft,
+        self.generate = theano.function(inputs=inputs, outputs=presoft,
                                         givens=givens, updates=f_updates)
 
     def do(self, *args):
@@ -211,6 +253,8 @@ class TextGenerationExtension(SimpleExtension):
                 # Sample a character out of the probability distribution
                 argmax = (self.softmax_sampling == 'argmax')
                 last_output_sample = sample(probabilities, argmax)[:, None, :]
+                last_output_sample = last_output_sample.astype(
+                    generated_text.dtype)
 
             else:
                 last_output_sample = last_presoft[:, None, :]
@@ -244,11 +288,10 @@ class TextGenerationExtension(SimpleExtension):
             plt.show()
 
     def interactive_generate(self, initial_text, generation_length, *args):
-        vocab = get_character(self.dataset)
-        initial_code = []
-        for char in initial_text:
-            initial_code += [np.where(vocab == char)[0]]
-        initial_code = np.array(initial_code)
+        vocab = get_vocabulary(self.dataset)
+        # time x batch
+        initial_code = vocab.encode(initial_text)[:, None].astype(
+            get_index_dtype(self.dataset))
         inputs_ = initial_code
         all_output_probabilities = []
         logger.info("\nGeneration:")
@@ -264,13 +307,11 @@ class TextGenerationExtension(SimpleExtension):
             else:
                 argmax = False
             last_output_sample = sample(last_output_probabilities, argmax)
-            inputs_ = np.vstack([inputs_, last_output_sample])
+            inputs_ = np.vstack([inputs_,
+                                 last_output_sample.astype(inputs_.dtype)])
         # time x batch
         whole_sentence_code = inputs_
-        # whole_sentence
-        whole_sentence = ''
-        for char in vocab[whole_sentence_code[:, 0]]:
-            whole_sentence += char
+        whole_sentence = vocab.decode_text(whole_sentence_code[:, 0])
         logger.info(whole_sentence[:initial_code.shape[0]] + ' ...')
         logger.info(whole_sentence)
 
@@ -0,0 +1,242 @@
+import logging
+import multiprocessing
+import os
+
+import numpy
+
+import theano
+from fuel import config
+
+from blocks.extensions import SimpleExtension
+
+from rnn.datasets.dataset import get_stream_char
+from rnn.datasets.prefetch import PrefetchingDataStream
+
+floatX = theano.config.floatX
+logger = logging.getLogger(__name__)
+
+
+# Seconds between two checks of the other processes while waiting
+POLL_INTERVAL = 1.
+
+
+class BrokenBarrierError(RuntimeError):
+    pass
+
+
+class Barrier(object):
+
+    """Barrier shared by forked processes.
+
+    The barrier is broken by :meth:`abort`, or when the `check` given to
+    :meth:`wait` returns False: the waiting processes, and the next ones,
+    raise :class:`BrokenBarrierError` instead of waiting forever for a
+    process which failed.
+
+    """
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.count = multiprocessing.RawValue('i', 0)
+        self.generation = multiprocessing.RawValue('i', 0)
+        self.broken = multiprocessing.RawValue('i', 0)
+        self.condition = multiprocessing.Condition()
+
+    def abort(self):
+        with self.condition:
+            self.broken.value = 1
+            self.condition.notify_all()
+
+    def wait(self, check=None):
+        """Wait for the other processes.
+
+        Parameters
+        ----------
+        check : callable, optional
+            Called every `POLL_INTERVAL` seconds while waiting, the
+            barrier is broken if it returns False.
+
+        """
+        with self.condition:
+            if self.broken.value:
+                raise BrokenBarrierError
+            generation = self.generation.value
+            self.count.value += 1
+            if self.count.value == self.parties:
+                self.count.value = 0
+                self.generation.value += 1
+                self.condition.notify_all()
+            while generation == self.generation.value:
+                self.condition.wait(POLL_INTERVAL)
+                if generation != self.generation.value:
+                    break
+                if (not self.broken.value and check is not None and
+                        not check()):
+                    self.broken.value = 1
+                    self.condition.notify_all()
+                if self.broken.value:
+                    raise BrokenBarrierError
+
+
+class ParameterAveraging(SimpleExtension):
+
+    """Data-parallel training by periodic averaging of the parameters.
+
+    The process which creates the extension forks the other workers with
+    :meth:`fork`. Each worker trains its own copy of the model on its own
+    minibatches, with its own step rule state and carried hidden states.
+    Every `every_n_batches` batches, each worker copies its parameters
+    into its row of a shared memory buffer, waits for the others and sets
+    its parameters to the mean of the rows.
+
+    When a worker stops (early stopping, interruption), it joins a last
+    averaging step and the others stop after it. When a worker fails or
+    dies, the others raise instead of waiting for it, and the failure is
+    raised by :meth:`join` in the original process.
+
+    Parameters
+    ----------
+    parameters : list of :class:`~tensor.TensorSharedVariable`
+        The parameters to average, the same in all the workers.
+    workers : int
+        The number of workers, including the current process.
+
+    """
+
+    def __init__(self, parameters, workers, **kwargs):
+        self.parameters = parameters
+        self.workers = workers
+        self.worker = 0
+        self.parent = os.getpid()
+        self.pids = []
+        # Exit status of the workers which ended while we were waiting
+        self.statuses = {}
+        # Whether this worker went through the last averaging step
+        self.done = False
+        sizes = [parameter.get_value(borrow=True).size
+                 for parameter in parameters]
+        self.offsets = numpy.cumsum([0] + sizes)
+
+        typecode = 'f' if floatX == 'float32' else 'd'
+        shared = multiprocessing.RawArray(typecode,
+                                          workers * int(self.offsets[-1]))
+        self.rows = numpy.frombuffer(shared, dtype=floatX).reshape(
+            (workers, int(self.offsets[-1])))
+        self.barrier = Barrier(workers)
+        # Set by the first worker which stops
+        self.stop = multiprocessing.RawValue('i', 0)
+        self.stopped_by_others = False
+
+        kwargs.setdefault("after_training", True)
+        super(ParameterAveraging, self).__init__(**kwargs)
+
+    def fork(self):
+        """Start the other workers.
+
+        Returns
+        -------
+        int
+            The index of the worker run by the calling process, 0 in the
+            original process.
+
+        """
+        for worker in range(1, self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self.worker = worker
+                self.pids = []
+                return worker
+            self.pids.append(pid)
+        return 0
+
+    def alive(self):
+        """Whether the other workers can still reach the barrier."""
+        if self.worker > 0:
+            return os.getppid() == self.parent
+        for pid in self.pids:
+            if pid not in self.statuses:
+                ended, status = os.waitpid(pid, os.WNOHANG)
+                if ended:
+                    self.statuses[pid] = status
+        return not self.statuses
+
+    def join(self):
+        """Wait for the end of the other workers.
+
+        If this worker did not go through the last averaging step (e.g.
+        its training raised), the other workers are stopped first.
+
+        """
+        if not self.done:
+            self.barrier.abort()
+        failed = 0
+        for pid in self.pids:
+            status = self.statuses.pop(pid, None)
+            if status is None:
+                _, status = os.waitpid(pid, 0)
+            failed += status != 0
+        self.pids = []
+        if failed and self.done:
+            raise RuntimeError("{} worker(s) failed".format(failed))
+
+    def wait(self):
+        try:
+            self.barrier.wait(self.alive)
+        except BrokenBarrierError:
+            raise RuntimeError("Another worker failed")
+
+    def do(self, which_callback, *args):
+        final = which_callback == 'after_training'
+        if final and self.stopped_by_others:
+            return
+
+        row = self.rows[self.worker]
+        for parameter, start, end in zip(self.parameters, self.offsets[:-1],
+                                         self.offsets[1:]):
+            row[start:end] = parameter.get_value(borrow=True).ravel()
+        if final:
+            self.stop.value = 1
+        self.wait()
+
+        mean = self.rows.mean(axis=0)
+        stop = self.stop.value
+        # Nobody writes its row or stops the next step before everybody has
+        # read them
+        self.wait()
+
+        for parameter, start, end in zip(self.parameters, self.offsets[:-1],
+                                         self.offsets[1:]):
+            value = parameter.get_value(borrow=True)
+            parameter.set_value(
+                mean[start:end].reshape(value.shape).astype(value.dtype))
+        if stop:
+            self.done = True
+        if stop and not final:
+            self.stopped_by_others = True
+            self.main_loop.log.current_row['training_finish_requested'] = True
+
+
+def run_worker(main_loop, averaging):
+    """Run the main loop of a forked worker, then exit the process."""
+    try:
+        main_loop.run()
+    except BaseException:
+        logger.exception("Worker failed")
+        averaging.barrier.abort()
+        os._exit(1)
+    os._exit(0)
+
+
+def get_shard_stream(args, worker):
+    """The training stream of a worker: its columns of the corpus."""
+    rng = None
+    if args.batch_offsets == 'random':
+        # Each worker draws its own sequences
+        rng = numpy.random.RandomState(config.default_seed + worker)
+    stream = get_stream_char(args.dataset, "train", args.time_length,
+                             args.mini_batch_size, args.tot_num_char,
+                             args.batch_offsets, args.tbptt_stride or None,
+                             shard=(worker, args.workers), rng=rng)
+    if args.prefetch > 0:
+        stream = PrefetchingDataStream(stream, args.prefetch)
+    return stream
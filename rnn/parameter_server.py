@@ -0,0 +1,440 @@
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import numpy
+from six.moves import socketserver
+
+import theano
+
+from blocks.algorithms import DifferentiableCostMinimizer
+from blocks.extensions import SimpleExtension
+from blocks.main_loop import TrainingFinish
+
+logger = logging.getLogger(__name__)
+
+# Size of the header giving the length of a message
+HEADER = struct.Struct('!Q')
+MAX_HEADER_SIZE = 1 << 20
+
+# Kinds of the arrays accepted in a message: booleans, integers and floats
+ARRAY_KINDS = 'biuf'
+
+# Address of the server when none is given
+DEFAULT_ADDRESS = '127.0.0.1:5555'
+
+# Seconds between two attempts to connect to the server
+CONNECT_INTERVAL = 1.
+CONNECT_ATTEMPTS = 60
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def send_message(connection, message, arrays=()):
+    """Send a message and numerical arrays.
+
+    The message is sent as JSON, followed by the raw data of the arrays,
+    so that receiving a message never runs code from the peer (as
+    unpickling could).
+
+    """
+    arrays = [numpy.ascontiguousarray(array) for array in arrays]
+    header = json.dumps({
+        'message': message,
+        'arrays': [(array.dtype.str, array.shape) for array in arrays]})
+    connection.sendall(HEADER.pack(len(header)) + header.encode('utf-8'))
+    for array in arrays:
+        connection.sendall(array.tobytes())
+
+
+def receive_exactly(connection, size):
+    chunks = []
+    while size > 0:
+        chunk = connection.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError("The connection was closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def receive_message(connection):
+    """Receive a message sent by :func:`send_message`.
+
+    Returns
+    -------
+    message
+        The message, decoded from JSON.
+    arrays : list of :class:`numpy.ndarray`
+        The arrays sent with the message.
+
+    """
+    size, = HEADER.unpack(receive_exactly(connection, HEADER.size))
+    if size > MAX_HEADER_SIZE:
+        raise ValueError("Message header of {} bytes".format(size))
+    header = json.loads(receive_exactly(connection, size).decode('utf-8'))
+    arrays = []
+    for dtype, shape in header['arrays']:
+        dtype = numpy.dtype(str(dtype))
+        if dtype.kind not in ARRAY_KINDS:
+            raise ValueError("Array of type {} in a message".format(dtype))
+        shape = tuple(int(length) for length in shape)
+        data = receive_exactly(connection,
+                               dtype.itemsize * int(numpy.prod(shape)))
+        arrays.append(numpy.frombuffer(data, dtype=dtype).reshape(shape))
+    return header['message'], arrays
+
+
+class ParameterServer(object):
+
+    """The parameters, updated with the gradients pushed by the workers.
+
+    The parameters are given by the first worker which connects, so the
+    server does not need to build the model.
+
+    Parameters
+    ----------
+    step_rule : :class:`~blocks.algorithms.StepRule`
+        The step rule applied to each pushed gradient.
+    max_staleness : int
+        The maximum number of updates between the parameters used by a
+        worker and the current parameters for its gradients to be applied.
+    log_every : int, optional
+        The number of updates between two logs of the statistics.
+
+    """
+
+    def __init__(self, step_rule, max_staleness, log_every=1000):
+        self.step_rule = step_rule
+        self.max_staleness = max_staleness
+        self.log_every = log_every
+        self.parameters = None
+        self.version = 0
+        self.stopped = False
+        # Worker -> counts of its pushes
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def initialize(self, names, values):
+        with self.lock:
+            if self.parameters is not None:
+                return
+            self.parameters = [theano.shared(value.copy(), name=str(name))
+                               for name, value in zip(names, values)]
+            gradients = OrderedDict(
+                (parameter, parameter.type(parameter.name + '_grad'))
+                for parameter in self.parameters)
+            steps, step_rule_updates = self.step_rule.compute_steps(
+                gradients)
+            updates = [(parameter, parameter - steps[parameter])
+                       for parameter in self.parameters]
+            self._apply = theano.function(
+                list(gradients.values()), [],
+                updates=updates + step_rule_updates)
+            logger.info("Serving {} parameters".format(len(names)))
+
+    def pull(self):
+        with self.lock:
+            return self.version, [parameter.get_value()
+                                  for parameter in self.parameters]
+
+    def push(self, worker, version, gradients):
+        """Apply the gradients of a worker, unless they are too stale.
+
+        Returns
+        -------
+        accepted : bool
+            Whether the gradients were applied.
+        version : int
+            The number of updates of the parameters.
+        stopped : bool
+            Whether the training is over.
+
+        """
+        with self.lock:
+            stats = self.workers.setdefault(
+                worker, {'pushes': 0, 'rejected': 0, 'staleness': 0,
+                         'start_time': time.time()})
+            stats['pushes'] += 1
+            staleness = self.version - version
+            accepted = staleness <= self.max_staleness
+            if accepted:
+                self._apply(*gradients)
+                self.version += 1
+                stats['staleness'] += staleness
+            else:
+                stats['rejected'] += 1
+            if accepted and self.version % self.log_every == 0:
+                logger.info(self.format_stats())
+            return accepted, self.version, self.stopped
+
+    def check_gradients(self, gradients):
+        if self.parameters is None:
+            raise ValueError("Gradients pushed before the parameters")
+        shapes = [parameter.get_value(borrow=True).shape
+                  for parameter in self.parameters]
+        if [gradient.shape for gradient in gradients] != shapes:
+            raise ValueError("The gradients do not match the parameters")
+
+    def get_stats(self):
+        """Per-worker statistics: pushes per second, rejected pushes and
+        mean staleness of the applied gradients."""
+        with self.lock:
+            return self._get_stats()
+
+    def _get_stats(self):
+        now = time.time()
+        stats = {}
+        for worker, counts in self.workers.items():
+            applied = counts['pushes'] - counts['rejected']
+            stats[worker] = {
+                'pushes_per_second': counts['pushes'] / max(
+                    now - counts['start_time'], 1e-6),
+                'rejected': counts['rejected'],
+                'mean_staleness': counts['staleness'] / float(max(applied,
+                                                                  1))}
+        return stats
+
+    def format_stats(self):
+        lines = ["Update {}".format(self.version)]
+        for worker, stats in sorted(self._get_stats().items()):
+            lines.append(
+                "worker {}: {:.2f} pushes/s, {} rejected, staleness "
+                "{:.2f}".format(worker, stats['pushes_per_second'],
+                                stats['rejected'], stats['mean_staleness']))
+        return '\n'.join(lines)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+
+
+class ParameterServerHandler(socketserver.BaseRequestHandler):
+
+    """Serves the requests of one worker until it disconnects."""
+
+    def handle(self):
+        server = self.server
+        with server.connections_lock:
+            server.connections += 1
+        try:
+            while True:
+                try:
+                    message, arrays = receive_message(self.request)
+                except EOFError:
+                    return
+                send_message(self.request, *self.reply(message, arrays))
+        finally:
+            with server.connections_lock:
+                server.connections -= 1
+                done = (server.parameter_server.stopped and
+                        server.connections == 0)
+            if done:
+                # shutdown waits for serve_forever, in another thread
+                threading.Thread(target=server.shutdown).start()
+
+    def reply(self, message, arrays):
+        """The reply to a message, and the arrays sent with it."""
+        parameter_server = self.server.parameter_server
+        command = message[0]
+        if command == 'init':
+            parameter_server.initialize(message[1], arrays)
+            return parameter_server.version, ()
+        elif command == 'pull':
+            version, values = parameter_server.pull()
+            return version, values
+        elif command == 'push':
+            worker, version = message[1:]
+            parameter_server.check_gradients(arrays)
+            return parameter_server.push(worker, version, arrays), ()
+        elif command == 'stats':
+            return parameter_server.get_stats(), ()
+        elif command == 'stop':
+            parameter_server.stop()
+            return parameter_server.version, ()
+        raise ValueError("unknown command: " + str(command))
+
+
+class ParameterServerTCPServer(socketserver.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, parameter_server):
+        socketserver.ThreadingTCPServer.__init__(self, address,
+                                                 ParameterServerHandler)
+        self.parameter_server = parameter_server
+        self.connections = 0
+        self.connections_lock = threading.Lock()
+
+
+def serve(address, step_rule, max_staleness):
+    """Run a parameter server until the training is stopped and all the
+    workers have disconnected.
+
+    The server holds the parameters and the state of the step rule. Each
+    worker computes the gradients of its own minibatches with its copy of
+    the parameters, pushes them to the server, which applies them at once,
+    and pulls the new parameters from time to time (see
+    :class:`AsyncGradientDescent`). The messages are sent over TCP, so the
+    workers can run in local processes over the loopback interface, or on
+    other machines. The server takes the options of the step rule, e.g.::
+
+        python -m rnn.parameter_server --ps_address 127.0.0.1:5555 \\
+            --algorithm adam --learning_rate 1e-3
+
+    and each worker the same address, the number of `--workers` and its
+    index `--worker`. The server listens on the loopback interface by
+    default. Any peer which can connect can change the parameters, so
+    only listen on another interface of a trusted network. The first
+    worker monitors and saves the model, and stops the others at the end
+    of its training.
+
+    """
+    parameter_server = ParameterServer(step_rule, max_staleness)
+    server = ParameterServerTCPServer(address, parameter_server)
+    logger.info("Parameter server listening on {}:{}".format(
+        *server.server_address))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+    logger.info(parameter_server.format_stats())
+
+
+class ParameterClient(object):
+
+    """Connection of a worker to the parameter server."""
+
+    def __init__(self, address):
+        for attempt in range(CONNECT_ATTEMPTS):
+            try:
+                self.connection = socket.create_connection(address)
+                break
+            except socket.error:
+                # The server may not be started yet
+                if attempt == CONNECT_ATTEMPTS - 1:
+                    raise
+                time.sleep(CONNECT_INTERVAL)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def request(self, message, arrays=()):
+        send_message(self.connection, message, arrays)
+        return receive_message(self.connection)
+
+    def initialize(self, names, values):
+        return self.request(['init', names], values)[0]
+
+    def pull(self):
+        return self.request(['pull'])
+
+    def push(self, worker, version, gradients):
+        return self.request(['push', worker, version], gradients)[0]
+
+    def get_stats(self):
+        return self.request(['stats'])[0]
+
+    def stop(self):
+        return self.request(['stop'])[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class AsyncGradientDescent(DifferentiableCostMinimizer):
+
+    """Training algorithm of a worker of the parameter server.
+
+    The gradients of each minibatch are pushed to the server. The worker
+    pulls the parameters when its gradients are rejected, or when its
+    copy is more than `max_staleness / 2` updates old. The other updates
+    (e.g. of the carried hidden states) are applied locally.
+
+    Parameters
+    ----------
+    client : :class:`ParameterClient`
+        The connection to the server.
+    worker : int
+        The index of the worker, for the statistics.
+    max_staleness : int
+        The staleness bound of the server.
+
+    """
+
+    def __init__(self, client, worker, max_staleness, **kwargs):
+        super(AsyncGradientDescent, self).__init__(**kwargs)
+        self.client = client
+        self.worker = worker
+        self.max_staleness = max_staleness
+        self.version = None
+        # The state of the step rule is on the server
+        self.step_rule_updates = []
+
+    def initialize(self):
+        gradients = theano.grad(self.cost, self.parameters)
+        self._function = theano.function(self.inputs, gradients,
+                                         updates=self.updates)
+        self.client.initialize(
+            [parameter.name for parameter in self.parameters],
+            [parameter.get_value() for parameter in self.parameters])
+        self.pull()
+
+    def pull(self):
+        self.version, values = self.client.pull()
+        for parameter, value in zip(self.parameters, values):
+            parameter.set_value(value)
+
+    def process_batch(self, batch):
+        ordered_batch = [batch[v.name] for v in self.inputs]
+        gradients = self._function(*ordered_batch)
+        accepted, version, stopped = self.client.push(
+            self.worker, self.version, gradients)
+        if stopped:
+            raise TrainingFinish
+        if not accepted or version - self.version > self.max_staleness // 2:
+            self.pull()
+
+
+class ParameterServerMonitoring(SimpleExtension):
+
+    """Monitoring of the training by the first worker.
+
+    The parameters of the worker are replaced by those of the server, so
+    that the extensions which follow (validation, early stopping,
+    checkpoints) use them. The statistics of the workers are recorded in
+    the log. The training of all the workers is stopped at the end of the
+    training.
+
+    """
+
+    def __init__(self, client, **kwargs):
+        self.client = client
+        kwargs.setdefault("after_epoch", True)
+        kwargs.setdefault("after_training", True)
+        super(ParameterServerMonitoring, self).__init__(**kwargs)
+
+    def do(self, which_callback, *args):
+        self.main_loop.algorithm.pull()
+        if which_callback == 'after_training':
+            self.client.stop()
+            return
+        current_row = self.main_loop.log.current_row
+        for worker, stats in self.client.get_stats().items():
+            for name, value in stats.items():
+                current_row['worker{}_{}'.format(worker, name)] = value
+
+
+if __name__ == "__main__":
+    from rnn.train import learning_algorithm
+    from rnn.utils import parse_args
+
+    args = parse_args()
+    serve(parse_address(args.ps_address or DEFAULT_ADDRESS),
+          learning_algorithm(args), args.max_staleness)
@@ -0,0 +1,77 @@
+import theano
+from theano import tensor
+
+
+def split_segments(sequence, segment_length):
+    """Split the time of a sequence into segments.
+
+    The time is padded with zeros to a multiple of `segment_length`.
+
+    Returns
+    -------
+    :class:`~tensor.TensorVariable`
+        The sequence in the shape (segments, segment_length, ...).
+
+    """
+    length = sequence.shape[0]
+    segments = (length + segment_length - 1) // segment_length
+    padded = tensor.zeros(
+        [segments * segment_length] +
+        [sequence.shape[i] for i in range(1, sequence.ndim)],
+        dtype=sequence.dtype)
+    padded = tensor.set_subtensor(padded[:length], sequence)
+    return padded.reshape(
+        [segments, segment_length] +
+        [sequence.shape[i] for i in range(1, sequence.ndim)],
+        ndim=sequence.ndim + 1)
+
+
+def checkpointed_costs(segment_costs, sequences, states, segment_length):
+    """Sum of the costs of sequences, computed segment by segment.
+
+    The time steps are split into segments of `segment_length` steps. An
+    outer scan iterates over the segments and `segment_costs` computes the
+    states of the steps of a segment (usually with an inner scan) and the
+    costs of its positions. Only the outputs of the outer scan are kept for
+    the backward pass, i.e. the states at the end of each segment and the
+    sums of the costs. The steps of a segment, the output layer and the
+    costs are recomputed from the states at its start when computing the
+    gradient, so the memory grows with the number of segments instead of
+    the number of time steps.
+
+    The last segment is padded with zeros, the padded steps must neither
+    change the states nor count in the costs (zero masks). Since each
+    segment is computed twice, `segment_costs` must be deterministic.
+
+    Parameters
+    ----------
+    segment_costs : callable
+        Called with the segment of each sequence, in the shape
+        (segment_length, ...), followed by the states at the start of the
+        segment. Returns the states at the end of the segment, followed by
+        the sum of the costs of the segment and their number.
+    sequences : list of :class:`~tensor.TensorVariable`
+        The sequences, with the time as first axis.
+    states : list of :class:`~tensor.TensorVariable`
+        The initial states.
+    segment_length : int
+        The number of steps of a segment.
+
+    Returns
+    -------
+    boundaries : list of :class:`~tensor.TensorVariable`
+        The states at the end of each segment, in the shape
+        (segments, ...).
+    total : :class:`~tensor.TensorVariable`
+        The sum of the costs of all the segments.
+    count : :class:`~tensor.TensorVariable`
+        The number of these costs.
+
+    """
+    results, updates = theano.scan(
+        segment_costs,
+        sequences=[split_segments(sequence, segment_length)
+                   for sequence in sequences],
+        outputs_info=list(states) + [None, None])
+    assert not updates
+    return results[:-2], results[-2].sum(), results[-1].sum()
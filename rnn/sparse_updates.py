@@ -0,0 +1,162 @@
+import logging
+
+import numpy as np
+
+import theano
+from theano import tensor
+from theano.gof.graph import ancestors
+from theano.tensor.extra_ops import Unique
+from theano.tensor.subtensor import AdvancedSubtensor1
+
+from blocks.graph import ComputationGraph
+from blocks.utils import shared_floatx, shared_floatx_zeros_matching
+
+floatX = theano.config.floatX
+logging.basicConfig(level='INFO')
+logger = logging.getLogger(__name__)
+
+# Name of the tables of LookupTable and FusedLookupTable
+LOOKUP_NAME = 'W_lookup'
+
+# Constants of the blocks step rules built by rnn.train.learning_algorithm
+ADAM_BETA1 = 0.9
+ADAM_BETA2 = 0.999
+ADAM_EPSILON = 1e-8
+RMSPROP_DECAY_RATE = 0.9
+RMSPROP_MAX_SCALING = 1e5
+
+
+def lookup_gathers(cost, table):
+    """The rows of `table` gathered in the graph of `cost`.
+
+    The gathered rows can come from a noisy version of the table, see
+    :func:`blocks.graph.apply_noise`.
+
+    """
+    gathers = []
+    for variable in ComputationGraph(cost).variables:
+        if (variable.owner is not None and
+                isinstance(variable.owner.op, AdvancedSubtensor1) and
+                table in ancestors([variable.owner.inputs[0]]) and
+                variable not in gathers):
+            gathers.append(variable)
+    return gathers
+
+
+def clip_rows(step, threshold):
+    norm = tensor.sqrt(tensor.sqr(step).sum())
+    return step * tensor.minimum(1., threshold / tensor.maximum(norm, 1e-7))
+
+
+def sparse_step(table, rows, gradient, args):
+    """Step of the step rule of `args` for some rows of `table`.
+
+    The state of the step rule (moments...) is stored for every row but
+    only the given rows are read and updated, as in lazy Adam.
+
+    Returns
+    -------
+    step : :class:`~tensor.TensorVariable`
+        The step of each row, to be subtracted from the table.
+    updates : list of tuples
+        The updates of the state of the step rule.
+
+    """
+    learning_rate = np.cast[floatX](float(args.learning_rate))
+    threshold = np.cast[floatX](args.clipping)
+
+    if args.algorithm == 'adam':
+        mean = shared_floatx_zeros_matching(table, 'mean')
+        variance = shared_floatx_zeros_matching(table, 'variance')
+        time = shared_floatx(0., 'time')
+        t1 = time + 1
+        mean_t = ADAM_BETA1 * mean[rows] + (1 - ADAM_BETA1) * gradient
+        variance_t = (ADAM_BETA2 * variance[rows] +
+                      (1 - ADAM_BETA2) * tensor.sqr(gradient))
+        corrected_rate = (learning_rate *
+                          tensor.sqrt(1. - ADAM_BETA2 ** t1) /
+                          (1. - ADAM_BETA1 ** t1))
+        step = (corrected_rate * mean_t /
+                (tensor.sqrt(variance_t) + ADAM_EPSILON))
+        # Step clipping, as [adam, clipping] in learning_algorithm
+        step = clip_rows(step, threshold)
+        updates = [(mean, tensor.set_subtensor(mean[rows], mean_t)),
+                   (variance,
+                    tensor.set_subtensor(variance[rows], variance_t)),
+                   (time, t1)]
+
+    elif args.algorithm == 'rms_prop':
+        gradient = clip_rows(gradient, threshold)
+        mean_square = shared_floatx_zeros_matching(table, 'mean_square')
+        mean_square_t = (RMSPROP_DECAY_RATE * mean_square[rows] +
+                         (1 - RMSPROP_DECAY_RATE) * tensor.sqr(gradient))
+        rms = tensor.maximum(tensor.sqrt(mean_square_t),
+                             1. / RMSPROP_MAX_SCALING)
+        step = learning_rate * gradient / rms
+        updates = [(mean_square,
+                    tensor.set_subtensor(mean_square[rows], mean_square_t))]
+
+    else:
+        gradient = clip_rows(gradient, threshold)
+        velocity = shared_floatx_zeros_matching(table, 'velocity')
+        step = (np.cast[floatX](args.momentum) * velocity[rows] +
+                learning_rate * gradient)
+        updates = [(velocity, tensor.set_subtensor(velocity[rows], step))]
+
+    return tensor.cast(step, floatX), updates
+
+
+def sparse_lookup_updates(cost, parameters, args):
+    """Row-sparse updates of the lookup tables among `parameters`.
+
+    The gradient of each lookup table is only computed for the rows
+    gathered by the minibatch (summed over their occurrences), and the step
+    rule only reads and writes these rows of the table and of its state.
+    The gradient clipping is computed on these rows, for each table.
+
+    Parameters
+    ----------
+    cost : :class:`~tensor.TensorVariable`
+        The cost to minimize.
+    parameters : list of :class:`~tensor.TensorSharedVariable`
+        All the parameters of the model.
+    args : :class:`argparse.Namespace`
+        The options of the step rule (see :func:`rnn.train.learning_algorithm`).
+
+    Returns
+    -------
+    dense_parameters : list of :class:`~tensor.TensorSharedVariable`
+        The parameters to train with the usual step rule.
+    updates : list of tuples
+        The updates of the lookup tables and of their step rule state.
+
+    """
+    dense_parameters = []
+    updates = []
+    for parameter in parameters:
+        gathers = []
+        if parameter.name == LOOKUP_NAME:
+            gathers = lookup_gathers(cost, parameter)
+        if not gathers:
+            dense_parameters.append(parameter)
+            continue
+        logger.info("Row-sparse updates of " + str(parameter))
+
+        indices = tensor.concatenate(
+            [tensor.cast(gather.owner.inputs[1], 'int64')
+             for gather in gathers])
+        gradients = tensor.concatenate(
+            tensor.grad(cost, wrt=gathers), axis=0)
+
+        # Sum the gradients of the occurrences of each row
+        rows, inverse = Unique(return_inverse=True)(indices)
+        gradient = tensor.inc_subtensor(
+            tensor.zeros((rows.shape[0], parameter.shape[1]),
+                         dtype=floatX)[inverse],
+            gradients)
+
+        step, step_updates = sparse_step(parameter, rows, gradient, args)
+        updates.append(
+            (parameter, tensor.inc_subtensor(parameter[rows], -step)))
+        updates.extend(step_updates)
+    return dense_parameters, updates
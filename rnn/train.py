@@ -18,9 +18,18 @@ from blocks.model import Model
 from blocks.roles import WEIGHT
 
 from rnn.extensions import (EarlyStopping, TextGenerationExtension,
-                            ResetStates, InteractiveMode)
+                            ResetStates, InteractiveMode,
+                            LoadConvertedParameters)
 
+from rnn.checkpoint import (CheckpointWriter, ResumableCheckpoint,
+                            training_state_variables)
 from rnn.datastream_monitoring import DataStreamMonitoring
+from rnn.datasets.dataset import has_documents, is_procedural
+from rnn.parallel import ParameterAveraging, get_shard_stream, run_worker
+from rnn.parameter_server import (AsyncGradientDescent, ParameterClient,
+                                  ParameterServerMonitoring, parse_address)
+from rnn.sparse_updates import sparse_lookup_updates
+from rnn.training_log import JsonLinesLog
 
 floatX = theano.config.floatX
 logging.basicConfig(level='INFO')
@@ -52,7 +61,13 @@ def learning_algorithm(args):
 
 
 def train_model(cost, unregularized_cost, updates,
-                train_stream, valid_stream, args, gate_values=None):
+                train_stream, valid_stream, args, gate_values=None,
+                monitored_variables=None, train_updates=None):
+
+    # The training minibatches may carry the states of another step than
+    # the validation and the generation (see get_state_updates)
+    if train_updates is None:
+        train_updates = updates
 
     step_rule = learning_algorithm(args)
     cg = ComputationGraph(cost)
@@ -69,17 +84,94 @@ def train_model(cost, unregularized_cost, updates,
 
     logger.info(cg.parameters)
 
+    # The lookup tables can be updated on the rows of the minibatch only
+    parameters = cg.parameters
+    sparse_updates = []
+    if args.sparse_lookup:
+        parameters, sparse_updates = sparse_lookup_updates(cost, parameters,
+                                                           args)
+
     # Define algorithm
-    algorithm = GradientDescent(cost=cost, step_rule=step_rule,
-                                parameters=cg.parameters)
+    client = None
+    if args.ps_address is not None:
+        # The step rule is applied by the parameter server
+        client = ParameterClient(parse_address(args.ps_address))
+        algorithm = AsyncGradientDescent(
+            client=client, worker=args.worker,
+            max_staleness=args.max_staleness, cost=cost,
+            parameters=parameters)
+    else:
+        algorithm = GradientDescent(cost=cost, step_rule=step_rule,
+                                    parameters=parameters)
+    algorithm.add_updates(sparse_updates)
     # Add the updates to carry the hidden state
-    algorithm.add_updates(updates)
+    algorithm.add_updates(train_updates)
+
+    # Reset the initial states
+    if (args.dataset == "sine" or args.batch_offsets == "random" or
+            is_procedural(args.dataset) or has_documents(args.dataset)):
+        reset_frequency = 1
+    else:
+        reset_frequency = 100
+    reset_states = ResetStates([v for v, _ in updates],
+                               every_n_batches=reset_frequency)
 
     # Extensions to be added
     extensions = []
 
-    # Load from a dumped model
-    if args.load_path is not None:
+    # Data parallelism: the other workers are forked here, before the
+    # compilation. Each worker trains on its own columns of the corpus, and
+    # only the first one monitors and saves the model
+    averaging = None
+    if args.workers > 1 and client is None:
+        averaging = ParameterAveraging(cg.parameters, args.workers,
+                                       every_n_batches=args.sync_every)
+        worker = averaging.fork()
+        train_stream = get_shard_stream(args, worker)
+        if worker > 0:
+            run_worker(MainLoop(model=Model(cost), data_stream=train_stream,
+                                algorithm=algorithm,
+                                extensions=[averaging, reset_states]),
+                       averaging)
+        extensions.append(averaging)
+
+    # Asynchronous training: the workers run in their own processes, maybe
+    # on other machines, and only the first one monitors and saves the model
+    if client is not None:
+        if args.workers > 1:
+            train_stream = get_shard_stream(args, args.worker)
+        if args.worker > 0:
+            MainLoop(model=Model(cost), data_stream=train_stream,
+                     algorithm=algorithm,
+                     extensions=[reset_states]).run()
+            client.close()
+            return
+        # The parameters of the server are pulled before the validation
+        # and the checkpoints
+        extensions.append(ParameterServerMonitoring(
+            client, every_n_batches=args.monitoring_freq))
+
+    # The checkpoints to resume the training, which are restored before
+    # the other extensions start
+    writer = CheckpointWriter()
+    if not args.interactive_mode:
+        checkpoint_kwargs = {}
+        if args.save_freq > 0:
+            checkpoint_kwargs['every_n_batches'] = args.save_freq
+        extensions.append(ResumableCheckpoint(
+            os.path.join(args.save_path, 'checkpoint'),
+            training_state_variables(algorithm,
+                                     train_updates + sparse_updates,
+                                     cg.parameters),
+            resume_from=args.resume_from, writer=writer,
+            **checkpoint_kwargs))
+
+    # Load from a dumped model, converting the models saved by older
+    # versions (separate lookup tables, time of the clockwork modules)
+    if args.load_path is not None and (args.fused_lookup or
+                                       args.rnn_type == 'clockwork'):
+        extensions.append(LoadConvertedParameters(args.load_path, args))
+    elif args.load_path is not None:
         extensions.append(Load(args.load_path))
 
     # Generation extension
@@ -97,7 +189,8 @@ def train_model(cost, unregularized_cost, updates,
 
     # Training and Validation score monitoring
     extensions.extend([
-        TrainingDataMonitoring([cost], prefix='train',
+        TrainingDataMonitoring([cost] + (monitored_variables or []),
+                               prefix='train',
                                every_n_batches=args.monitoring_freq),
         DataStreamMonitoring([cost, unregularized_cost],
                              valid_stream, args.mini_batch_size_valid,
@@ -113,25 +206,28 @@ def train_model(cost, unregularized_cost, updates,
             os.makedirs(args.save_path)
         elif 'test' in args.save_path:
             print "Rewriting in " + args.save_path
+        elif args.resume_from is not None:
+            print "Resuming in " + args.save_path
         else:
             raise Exception('Directory already exists')
 
     # Early stopping
     extensions.append(EarlyStopping('valid_' + unregularized_cost.name,
                                     args.patience, args.save_path,
+                                    writer=writer,
                                     every_n_batches=args.monitoring_freq))
 
+    # The history of the training, one line per row of the log
+    if not args.interactive_mode:
+        extensions.append(JsonLinesLog(
+            os.path.join(args.save_path, 'log.jsonl'),
+            every_n_batches=args.monitoring_freq))
+
     # Printing
     extensions.append(ProgressBar())
     extensions.append(Printing(every_n_batches=args.monitoring_freq))
 
-    # Reset the initial states
-    if args.dataset == "sine":
-        reset_frequency = 1
-    else:
-        reset_frequency = 100
-    extensions.append(ResetStates([v for v, _ in updates],
-                                  every_n_batches=reset_frequency))
+    extensions.append(reset_states)
 
     # Visualizing extensions
     if args.interactive_mode:
@@ -143,4 +239,10 @@ def train_model(cost, unregularized_cost, updates,
         algorithm=algorithm,
         extensions=extensions
     )
-    main_loop.run()
+    try:
+        main_loop.run()
+    finally:
+        if averaging is not None:
+            averaging.join()
+    if client is not None:
+        client.close()
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import time
+
+import numpy
+
+from blocks.extensions import SimpleExtension
+
+from rnn.checkpoint import write_atomically
+
+logger = logging.getLogger(__name__)
+
+
+def to_json(value):
+    if isinstance(value, (numpy.ndarray, numpy.generic)):
+        return value.tolist()
+    return str(value)
+
+
+class JsonLinesLog(SimpleExtension):
+
+    """Append the rows of the training log to a file, one JSON line each.
+
+    Each line holds the iteration and the records of a row (costs,
+    patience...), as well as the `wall_time` in seconds since the
+    beginning of the training on the rows where the extension is called.
+    The rows are only written once, when they are complete, i.e. when
+    the iteration is over. The lines are buffered and written
+    `buffer_rows` at a time, and at the end of each epoch and of the
+    training, including an interrupted or failed training. See
+    :func:`load_log` to read them.
+
+    The rows from the first iteration of the training on are removed from
+    the file when the training starts: a training resumed from a
+    checkpoint writes again the rows after the checkpoint.
+
+    Parameters
+    ----------
+    path : str
+        The file to append the rows to.
+    buffer_rows : int, optional
+        The number of rows which are written at once.
+
+    """
+
+    def __init__(self, path, buffer_rows=100, **kwargs):
+        self.path = path
+        self.buffer_rows = buffer_rows
+        self.buffer = []
+        self.last_written = -1
+        self.start_time = time.time()
+        kwargs.setdefault("before_training", True)
+        kwargs.setdefault("after_epoch", True)
+        kwargs.setdefault("after_training", True)
+        kwargs.setdefault("on_interrupt", True)
+        kwargs.setdefault("on_error", True)
+        super(JsonLinesLog, self).__init__(**kwargs)
+
+    def do(self, which_callback, *args):
+        log = self.main_loop.log
+        done = log.status['iterations_done']
+        if which_callback == 'before_training':
+            # The rows before the checkpoint of a resumed training are
+            # already written, the rows after it are written again
+            self.last_written = done - 1
+            truncate_log(self.path, done)
+            return
+        log.current_row['wall_time'] = time.time() - self.start_time
+
+        last = which_callback in ('after_training', 'on_interrupt',
+                                  'on_error')
+        for iteration in range(self.last_written + 1, done + last):
+            row = log.get(iteration)
+            if row:
+                row = dict(row, iteration=iteration)
+                self.buffer.append(json.dumps(row, sort_keys=True,
+                                              default=to_json))
+        self.last_written = done - 1 + last
+
+        if (len(self.buffer) >= self.buffer_rows or
+                which_callback != 'after_batch'):
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        with open(self.path, 'a') as log_file:
+            log_file.write('\n'.join(self.buffer) + '\n')
+        self.buffer = []
+
+
+def write_lines(log_file, lines):
+    log_file.writelines(lines)
+
+
+def truncate_log(path, iterations):
+    """Remove the rows of the iteration `iterations` and after from a
+    :class:`JsonLinesLog` file, and its incomplete last line if any."""
+    if not os.path.exists(path):
+        return
+    with open(path) as log_file:
+        lines = [line for line in log_file if line.strip()]
+    kept = []
+    for line in lines:
+        try:
+            row = json.loads(line)
+        except ValueError:
+            continue
+        if row['iteration'] < iterations:
+            kept.append(line.rstrip('\n') + '\n')
+    if kept != lines:
+        logger.info("Removing {} rows from {}".format(len(lines) - len(kept),
+                                                       path))
+        write_atomically(path, write_lines, kept)
+
+
+def load_log(path):
+    """Load the history of a training from a :class:`JsonLinesLog` file.
+
+    Returns
+    -------
+    history : dict
+        The array of the `iteration` of each row and, for each record
+        name, the array of its value on each row. The numerical records
+        (and booleans) are floating point arrays, with NaN on the rows
+        where they are not recorded. The other records are object arrays,
+        with None on these rows.
+
+    """
+    with open(path) as log_file:
+        lines = [line for line in log_file if line.strip()]
+    rows = []
+    for i, line in enumerate(lines):
+        try:
+            rows.append(json.loads(line))
+        except ValueError:
+            # The last line of an interrupted training can be incomplete
+            if i < len(lines) - 1:
+                raise
+            logger.warning("Incomplete last line in " + path)
+
+    names = set()
+    for row in rows:
+        names.update(row)
+    history = {}
+    for name in names:
+        values = [row.get(name) for row in rows]
+        try:
+            history[name] = numpy.array(
+                [numpy.nan if value is None else value for value in values],
+                dtype=float)
+        except (TypeError, ValueError):
+            history[name] = numpy.array(values, dtype=object)
+    if rows:
+        history['iteration'] = history['iteration'].astype(numpy.int64)
+    return history
@@ -2,6 +2,9 @@ import argparse
 import logging
 import numpy
 import theano
+from theano import tensor
+
+from rnn.datasets.build_corpus import parse_separator
 
 logging.basicConfig(level='INFO')
 logger = logging.getLogger(__name__)
@@ -23,6 +26,21 @@ def parse_args():
                         default=False)
     parser.add_argument('--skip_output', action="store_true",
                         default=False)
+    parser.add_argument('--fused_lookup', action='store_true',
+                        default=False)
+    parser.add_argument('--sparse_lookup', action='store_true',
+                        default=False,
+                        help="update only the gathered rows of the lookup "
+                        "tables; their clipping uses the norm of these rows "
+                        "of each table, not the global norm of all the "
+                        "parameters")
+    parser.add_argument('--tbptt_stride', type=int,
+                        default=0)
+    parser.add_argument('--checkpoint_every', type=int,
+                        default=0,
+                        help="compute the cost by segments of this many "
+                        "steps, storing the states for the backward pass "
+                        "only at the end of each segment")
     parser.add_argument('--algorithm', choices=['rms_prop', 'adam', 'sgd'],
                         default='adam')
 
@@ -43,7 +61,8 @@ def parse_args():
     parser.add_argument('--dataset',
                         choices=['wikipedia', 'penntree',
                                  'mytext', 'wikipedia_junyoung', 'toy',
-                                 'xml', 'sine'],
+                                 'xml', 'sine', 'toy_procedural',
+                                 'xml_procedural', 'sine_procedural'],
                         default='sine')
     parser.add_argument('--time_length', type=int,
                         default=300)
@@ -60,11 +79,36 @@ def parse_args():
                         default=5)
     parser.add_argument('--load_path', type=str,
                         default=None)
+    parser.add_argument('--resume_from', type=str,
+                        default=None)
+    parser.add_argument('--save_freq', type=int,
+                        default=0)
     parser.add_argument('--save_path', type=str,
                         default="/data/lisatmp3/zablocki/" +
                         "new_toy_4l_5units_simple_noskip_05_40")
     parser.add_argument('--used_inputs', type=int,
                         default=None)
+    parser.add_argument('--prefetch', type=int,
+                        default=0)
+    parser.add_argument('--batch_offsets', choices=['fixed', 'contiguous',
+                                                    'random'],
+                        default='fixed')
+    parser.add_argument('--procedural_batches', type=int, nargs=2,
+                        default=[1000, 20])
+    parser.add_argument('--generation_workers', type=int,
+                        default=2)
+    parser.add_argument('--bucket_batches', type=int,
+                        default=100)
+    parser.add_argument('--workers', type=int,
+                        default=1)
+    parser.add_argument('--sync_every', type=int,
+                        default=10)
+    parser.add_argument('--ps_address', type=str,
+                        default=None)
+    parser.add_argument('--worker', type=int,
+                        default=0)
+    parser.add_argument('--max_staleness', type=int,
+                        default=10)
 
     # Training options
     parser.add_argument('--learning_rate', type=float,
@@ -90,6 +134,12 @@ def parse_args():
                         default="/data/lisatmp3/zablocki/train.txt")
     parser.add_argument('--valid_path', type=str,
                         default="/data/lisatmp3/zablocki/valid.txt")
+    parser.add_argument('--test_path', type=str,
+                        default=None)
+    parser.add_argument('--document_separator', type=parse_separator,
+                        default=None,
+                        help="the byte ending each document, as a byte "
+                        "value (10) or with escapes (\\n)")
     parser.add_argument('--softmax_sampling', type=str,
                         choices=['random_sample', 'argmax'],
                         default='random_sample')
@@ -139,3 +189,25 @@ def carry_hidden_state(updates, mini_batch_size, reset=False):
         f_updates = [(x, upd) for x, (_, upd) in zip(state_vars, updates)]
 
     return givens, f_updates
+
+
+def unmasked_inputs(inputs, use_indices):
+    """The inputs of a generation function, without the mask.
+
+    The generated sequences have no padding, the mask is given by ones.
+
+    Returns
+    -------
+    inputs : list of :class:`~tensor.TensorVariable`
+        The other inputs.
+    givens : list of tuples
+        The replacement of the mask, if it is an input.
+
+    """
+    givens = []
+    for mask in [v for v in inputs if v.name == 'mask']:
+        features = [v for v in inputs if v.name == 'features'][0]
+        if not use_indices:
+            features = features[:, :, 0]
+        givens.append((mask, tensor.ones_like(features, dtype=mask.dtype)))
+    return [v for v in inputs if v.name != 'mask'], givens
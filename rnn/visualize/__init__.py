@@ -1,6 +1,8 @@
 from blocks.model import Model
 from blocks.serialization import load_parameter_values
 
+from rnn.build_model.build_model_utils import convert_parameter_values
+
 from rnn.visualize.visualize_gates import (
     visualize_gates_soft, visualize_gates_lstm)
 from rnn.visualize.visualize_states import visualize_states
@@ -21,7 +23,9 @@ def run_visualizations(cost, updates,
     # Load the parameters from a dumped model
     assert args.load_path is not None
     model = Model(cost)
-    model.set_parameter_values(load_parameter_values(args.load_path))
+    param_values = convert_parameter_values(
+        load_parameter_values(args.load_path), args)
+    model.set_parameter_values(param_values)
 
     # Run a visualization
     if args.visualize == "generate":
@@ -10,7 +10,7 @@ import theano
 
 from blocks.filter import VariableFilter
 from blocks.graph import ComputationGraph
-from rnn.utils import carry_hidden_state
+from rnn.utils import carry_hidden_state, unmasked_inputs
 from rnn.datasets.dataset import has_indices, conv_into_char, get_output_size
 
 logging.basicConfig(level='INFO')
@@ -36,8 +36,11 @@ def visualize_generate(cost, hidden_states, updates,
     if args.hide_all_except is not None:
         pass
 
+    inputs, mask_givens = unmasked_inputs(cg.inputs, use_indices)
+    givens.extend(mask_givens)
+
     # Compile the theano function
-    compiled = theano.function(inputs=cg.inputs, outputs=presoft,
+    compiled = theano.function(inputs=inputs, outputs=presoft,
                                givens=givens, updates=f_updates)
 
     epoch_iterator = train_stream.get_epoch_iterator()
@@ -68,6 +71,8 @@ def visualize_generate(cost, hidden_states, updates,
                 # Sample a character out of the probability distribution
                 argmax = (args.softmax_sampling == 'argmax')
                 last_output_sample = sample(probabilities, argmax)[:, None, :]
+                last_output_sample = last_output_sample.astype(
+                    generated_text.dtype)
 
                 # Concatenate the new value to the text
                 generated_text = np.vstack(
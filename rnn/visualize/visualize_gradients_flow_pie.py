@@ -10,7 +10,7 @@ from theano import tensor
 from theano.compile import Mode
 
 from blocks.graph import ComputationGraph
-from rnn.datasets.dataset import get_character
+from rnn.datasets.dataset import get_vocabulary, get_index_dtype
 
 
 logging.basicConfig(level='INFO')
@@ -66,11 +66,8 @@ def visualize_gradients_flow_pie(hidden_states, updates,
     logger.info("The function has been compiled")
 
     # input text
-    vocab = get_character(args.dataset)
-    code = []
-    for char in text:
-        code += [np.where(vocab == char)[0]]
-    code = np.array(code)
+    code = get_vocabulary(args.dataset).encode(text)[:, None]
+    code = code.astype(get_index_dtype(args.dataset))
 
     res = [f(code) for f in compiled_functions]
     all_time_steps = []
@@ -0,0 +1,181 @@
+import numpy
+from numpy.testing import assert_allclose
+
+import theano
+from theano import tensor
+
+from blocks import initialization
+from blocks.bricks import MLP, Logistic, Tanh
+
+from rnn.bricks import (LSTM, AnalysisLSTM, HardGatedRecurrent,
+                        SoftGatedRecurrent, gate_from_projection,
+                        gate_input_projection)
+
+floatX = theano.config.floatX
+
+
+def test_gate_projection():
+    # The projection of the inputs before the recurrence followed by the
+    # projection of the states gives the MLP of the concatenation
+    dim = 3
+    rng = numpy.random.RandomState(1)
+    for activations, dims in [([Logistic()], [2 * dim, 1]),
+                              ([Tanh(), Logistic()], [2 * dim, 4, 1])]:
+        mlp = MLP(activations, dims,
+                  weights_init=initialization.IsotropicGaussian(0.5),
+                  biases_init=initialization.IsotropicGaussian(0.5))
+        mlp.initialize()
+
+        inputs = tensor.matrix('inputs')
+        states = tensor.matrix('states')
+        expected = mlp.apply(tensor.concatenate((inputs, states), axis=1))
+        computed = gate_from_projection(
+            mlp, gate_input_projection(mlp, inputs, dim), states, dim)
+        f = theano.function([inputs, states], [expected, computed])
+
+        expected_values, computed_values = f(
+            rng.randn(5, dim).astype(floatX),
+            rng.randn(5, dim).astype(floatX))
+        assert_allclose(computed_values, expected_values, rtol=1e-5)
+
+
+def test_gated_initial_states():
+    # Without `states`, the gated transitions start from their learned
+    # initial states. The gates of the hard transition are always open, so
+    # that both applications draw the same updates.
+    dim = 3
+    rng = numpy.random.RandomState(1)
+    for transition_class in [SoftGatedRecurrent, HardGatedRecurrent]:
+        mlp = MLP([Logistic()], [2 * dim, 1],
+                  weights_init=initialization.IsotropicGaussian(0.1),
+                  biases_init=initialization.Constant(100))
+        transition = transition_class(dim=dim, mlp=mlp, activation=Tanh())
+        transition.allocate()
+        mlp.initialize()
+        transition.parameters[0].set_value(
+            0.5 * rng.randn(dim, dim).astype(floatX))
+        transition.parameters[1].set_value(rng.randn(dim).astype(floatX))
+
+        inputs = tensor.tensor3('inputs')
+        default = transition.apply(inputs=inputs)[0]
+        given = transition.apply(
+            inputs=inputs,
+            states=tensor.repeat(transition.parameters[1][None, :],
+                                 inputs.shape[1], 0))[0]
+        f = theano.function([inputs], [default, given])
+
+        default_values, given_values = f(rng.randn(4, 2, dim).astype(floatX))
+        assert_allclose(default_values, given_values)
+
+
+def dense_hard_gated(transition, inputs, gate_inputs, random, mask, states):
+    # The former formulation, which computes the update of every row and
+    # selects the rows whose gate is open
+    def step(inputs, gate_inputs, random, mask, states):
+        gate_value = gate_from_projection(transition.mlp, gate_inputs,
+                                          states, transition.dim)[:, 0]
+        valid = tensor.gt(mask, 0)
+        opened = tensor.le(random, gate_value) * valid
+        next_states = tensor.tanh(
+            states.dot(transition.state_to_state) + inputs)
+        return (tensor.switch(opened[:, None], next_states, states),
+                tensor.cast(valid.sum() - opened.sum(), floatX))
+
+    (all_states, skipped), _ = theano.scan(
+        step, sequences=[inputs, gate_inputs, random, mask],
+        outputs_info=[states, None])
+    return all_states, skipped
+
+
+def test_hard_gated_recurrent():
+    # Updating the opened rows only gives the states and the gradients of
+    # the dense formulation, and counts the closed rows inside the mask
+    dim = 3
+    length = 6
+    batch = 5
+    rng = numpy.random.RandomState(1)
+    mlp = MLP([Logistic()], [2 * dim, 1],
+              weights_init=initialization.IsotropicGaussian(1.),
+              biases_init=initialization.Constant(0))
+    transition = HardGatedRecurrent(dim=dim, mlp=mlp, activation=Tanh())
+    transition.allocate()
+    mlp.initialize()
+    transition.parameters[0].set_value(
+        0.5 * rng.randn(dim, dim).astype(floatX))
+
+    inputs = tensor.tensor3('inputs')
+    gate_inputs = tensor.tensor3('gate_inputs')
+    random = tensor.vector('random')
+    mask = tensor.matrix('mask')
+    states = tensor.matrix('states')
+    weights = tensor.tensor3('weights')
+    computed, skipped = transition.apply_gated(
+        inputs=inputs, gate_inputs=gate_inputs, random=random, mask=mask,
+        states=states)
+    expected, expected_skipped = dense_hard_gated(
+        transition, inputs, gate_inputs, random, mask, states)
+    wrt = [transition.state_to_state, states]
+    f = theano.function(
+        [inputs, gate_inputs, random, mask, states, weights],
+        [computed, skipped, expected, expected_skipped] +
+        tensor.grad((computed * weights).sum(), wrt) +
+        tensor.grad((expected * weights).sum(), wrt))
+
+    random_values = rng.uniform(size=length).astype(floatX)
+    # All the gates of the third step are closed
+    random_values[2] = 1.
+    mask_values = (rng.uniform(size=(length, batch)) < 0.7).astype(floatX)
+    values = f(rng.randn(length, batch, dim).astype(floatX),
+               rng.randn(length, batch, 1).astype(floatX),
+               random_values, mask_values,
+               rng.randn(batch, dim).astype(floatX),
+               rng.randn(length, batch, dim).astype(floatX))
+
+    assert_allclose(values[0], values[2], rtol=1e-5)
+    assert_allclose(values[1], values[3])
+    for computed_grad, expected_grad in zip(values[4:6], values[6:]):
+        assert_allclose(computed_grad, expected_grad, rtol=1e-5)
+    assert_allclose(values[0][2], values[0][1])
+    assert values[1][2] == mask_values[2].sum()
+    # Some rows are updated, and the skipped rows are inside the mask
+    assert (values[1] < mask_values.sum(axis=1)).any()
+    assert (values[1] <= mask_values.sum(axis=1)).all()
+
+
+def test_analysis_lstm():
+    # With the parameters of an LSTM, the analysis LSTM computes the same
+    # states and cells, and returns the gates of every step as well
+    dim = 3
+    rng = numpy.random.RandomState(1)
+    lstm = LSTM(dim=dim, name='lstm',
+                weights_init=initialization.IsotropicGaussian(0.5))
+    lstm.initialize()
+    analysis = AnalysisLSTM(dim=dim)
+    analysis.allocate()
+    assert ([p.name for p in analysis.parameters] ==
+            [p.name for p in lstm.parameters])
+    for parameter, value in zip(analysis.parameters, lstm.parameters):
+        parameter.set_value(value.get_value())
+
+    inputs = tensor.tensor3('inputs')
+    mask = tensor.matrix('mask')
+    f = theano.function([inputs, mask],
+                        lstm.apply(inputs=inputs, mask=mask) +
+                        analysis.apply(inputs=inputs, mask=mask))
+
+    mask_values = numpy.ones((5, 2), dtype=floatX)
+    mask_values[3:, 1] = 0
+    values = f(rng.randn(5, 2, 4 * dim).astype(floatX), mask_values)
+    assert len(values) == 7
+    assert_allclose(values[2], values[0])
+    assert_allclose(values[3], values[1])
+    for gate in values[4:]:
+        assert gate.shape == (5, 2, dim)
+        assert ((gate > 0) & (gate < 1)).all()
+
+
+if __name__ == "__main__":
+    test_gate_projection()
+    test_gated_initial_states()
+    test_hard_gated_recurrent()
+    test_analysis_lstm()
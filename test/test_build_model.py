@@ -0,0 +1,115 @@
+from argparse import Namespace
+
+import numpy
+from numpy.testing import assert_allclose
+
+import theano
+from theano import tensor
+
+from blocks.graph import ComputationGraph
+from blocks.model import Model
+
+from rnn.build_model.build_model_cw import build_model_cw
+from rnn.build_model.build_model_lstm import build_model_lstm
+from rnn.build_model.build_model_soft import build_model_soft
+from rnn.build_model.build_model_vanilla import build_model_vanilla
+
+floatX = theano.config.floatX
+
+BUILDERS = {'simple': build_model_vanilla, 'lstm': build_model_lstm,
+            'clockwork': build_model_cw, 'soft': build_model_soft}
+
+
+def model_args(**kwargs):
+    args = Namespace(rnn_type='simple', dataset='toy_procedural', layers=2,
+                     state_dim=3, skip_connections=False, skip_output=False,
+                     fused_lookup=False, mini_batch_size=2, load_path=None,
+                     context=1, time_length=5, tbptt_stride=0,
+                     used_inputs=None, checkpoint_every=0,
+                     visualize='nothing', mlp_layers=1,
+                     mlp_activation='logistic', module_order='fast_in_slow')
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+
+def test_state_updates():
+    # The training windows start k1 steps apart and carry the states of the
+    # step k1 - 1, the monitoring and the generation carry the last states
+    args = model_args(tbptt_stride=2)
+    cost, _, updates, train_updates, hidden_states = build_model_vanilla(
+        args)
+    assert [v for v, _ in updates] == [v for v, _ in train_updates]
+
+    features = [v for v in ComputationGraph(cost).inputs
+                if v.name == 'features'][0]
+    f = theano.function([features],
+                        hidden_states + [u for _, u in updates] +
+                        [u for _, u in train_updates])
+    rng = numpy.random.RandomState(1)
+    values = f(rng.randint(40, size=(5, 2)).astype(features.dtype))
+    states, last, carried = values[:2], values[2:4], values[4:]
+    for d in range(args.layers):
+        assert_allclose(last[d], states[d][-1])
+        assert_allclose(carried[d], states[d][1])
+
+
+def compile_model(args):
+    # The cost, its gradients with respect to the parameters (sorted by
+    # name) and the carried states, as a function of the features and the
+    # targets
+    results = BUILDERS[args.rnn_type](args)
+    cost, updates, train_updates = results[0], results[2], results[3]
+    parameters = Model(cost).get_parameter_dict()
+    names = sorted(parameters)
+    inputs = dict((v.name, v) for v in ComputationGraph(cost).inputs)
+    f = theano.function(
+        [inputs['features'], inputs['targets']],
+        [cost] + tensor.grad(cost, [parameters[name] for name in names]) +
+        [u for _, u in updates + train_updates])
+    return f, parameters
+
+
+def check_checkpointed(dataset, **kwargs):
+    # The checkpointed cost is the cost of the whole sequences, with the
+    # same gradients, and carries the same states
+    rng = numpy.random.RandomState(1)
+    f, parameters = compile_model(model_args(dataset=dataset, **kwargs))
+    checkpointed, checkpointed_parameters = compile_model(
+        model_args(dataset=dataset, checkpoint_every=2, **kwargs))
+    assert sorted(parameters) == sorted(checkpointed_parameters)
+    for name, parameter in parameters.items():
+        checkpointed_parameters[name].set_value(parameter.get_value())
+
+    if dataset == 'toy_procedural':
+        features = rng.randint(40, size=(5, 2)).astype('uint8')
+        targets = rng.randint(40, size=(5, 2)).astype('uint8')
+    else:
+        features = rng.randn(5, 2, 1).astype(floatX)
+        targets = rng.randn(4, 2, 1).astype(floatX)
+    values = f(features, targets)
+    checkpointed_values = checkpointed(features, targets)
+    assert len(values) == len(checkpointed_values)
+    for value, checkpointed_value in zip(values, checkpointed_values):
+        assert_allclose(value, checkpointed_value, rtol=1e-5, atol=1e-7)
+
+
+def test_checkpointed_costs():
+    for rnn_type in ['simple', 'lstm', 'clockwork', 'soft']:
+        check_checkpointed('toy_procedural', rnn_type=rnn_type,
+                           tbptt_stride=4)
+    check_checkpointed('sine_procedural', rnn_type='simple', context=2)
+    check_checkpointed('toy_procedural', rnn_type='lstm',
+                       skip_connections=True)
+
+    # The generation carries the states without the targets
+    cost, _, updates, _, _ = build_model_vanilla(model_args(
+        checkpoint_every=2))
+    features = [v for v in ComputationGraph(cost).inputs
+                if v.name == 'features'][0]
+    theano.function([features], [u for _, u in updates])
+
+
+if __name__ == "__main__":
+    test_state_updates()
+    test_checkpointed_costs()
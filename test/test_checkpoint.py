@@ -0,0 +1,203 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy
+from numpy.testing import assert_allclose
+
+import theano
+from theano import tensor
+
+from blocks import initialization
+from blocks.algorithms import GradientDescent, Momentum
+from blocks.bricks import Linear
+from blocks.extensions import FinishAfter
+from blocks.extensions.monitoring import TrainingDataMonitoring
+from blocks.graph import ComputationGraph
+from blocks.main_loop import MainLoop
+from blocks.model import Model
+from blocks.serialization import load_parameter_values
+from blocks.utils import shared_floatx_zeros
+
+from fuel.datasets import IndexableDataset
+from fuel.schemes import SequentialScheme
+from fuel.streams import DataStream
+
+from rnn.checkpoint import (CheckpointWriter, ResumableCheckpoint,
+                            training_state_variables, write_atomically)
+from rnn.extensions import EarlyStopping
+
+floatX = theano.config.floatX
+
+
+def build_main_loop(iterations, path=None, resume_from=None,
+                    extensions=()):
+    x = tensor.matrix('features')
+    linear = Linear(input_dim=3, output_dim=1,
+                    weights_init=initialization.Constant(0.1),
+                    biases_init=initialization.Constant(0))
+    linear.initialize()
+    # A carried state, as the hidden states of the RNNs
+    state = shared_floatx_zeros((2, 1), name='state')
+    h = linear.apply(x) + state
+    cost = tensor.sqr(h - 1).mean()
+    cost.name = 'cost'
+    updates = [(state, 0.5 * h)]
+
+    parameters = ComputationGraph(cost).parameters
+    algorithm = GradientDescent(cost=cost, parameters=parameters,
+                                step_rule=Momentum(0.1, 0.9))
+    algorithm.add_updates(updates)
+
+    features = numpy.random.RandomState(1).rand(20, 3).astype(floatX)
+    stream = DataStream(IndexableDataset({'features': features}),
+                        iteration_scheme=SequentialScheme(20, 2))
+
+    extensions = list(extensions)
+    if path is not None:
+        extensions.append(ResumableCheckpoint(
+            path, training_state_variables(algorithm, updates, parameters),
+            resume_from=resume_from))
+    # The monitoring adds its accumulators to the algorithm
+    extensions.extend([
+        TrainingDataMonitoring([cost], prefix='train', after_batch=True),
+        FinishAfter(after_n_batches=iterations)])
+    main_loop = MainLoop(algorithm, stream, model=Model(cost),
+                         extensions=extensions)
+    return main_loop, linear, state
+
+
+def test_resumable_checkpoint():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'checkpoint')
+        main_loop, _, _ = build_main_loop(3, path)
+        main_loop.run()
+        assert os.path.exists(path)
+
+        main_loop, linear, state = build_main_loop(5, path, resume_from=path)
+        main_loop.run()
+        assert main_loop.status['iterations_done'] == 5
+
+        reference, reference_linear, reference_state = build_main_loop(5)
+        reference.run()
+        assert_allclose(linear.W.get_value(), reference_linear.W.get_value(),
+                        rtol=1e-5)
+        assert_allclose(linear.b.get_value(), reference_linear.b.get_value(),
+                        rtol=1e-5)
+        assert_allclose(state.get_value(), reference_state.get_value(),
+                        rtol=1e-5)
+    finally:
+        shutil.rmtree(directory)
+
+
+def write_text(text_file, text):
+    text_file.write(text)
+
+
+def test_write_atomically():
+    # A failed write keeps the previous file, and no temporary file
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'best')
+        write_atomically(path, write_text, 'previous')
+
+        def fail(text_file, text):
+            text_file.write(text[:3])
+            raise IOError('disk full')
+
+        try:
+            write_atomically(path, fail, 'next')
+        except IOError:
+            pass
+        else:
+            assert False
+        assert os.listdir(directory) == ['best']
+        with open(path) as text_file:
+            assert text_file.read() == 'previous'
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_checkpoint_writer_pending():
+    # Besides the file being written, at most max_pending files wait to be
+    # written and the next write blocks
+    directory = tempfile.mkdtemp()
+    try:
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow(text_file, text):
+            started.set()
+            release.wait()
+            text_file.write(text)
+
+        writer = CheckpointWriter(max_pending=1)
+        writer.write(os.path.join(directory, 'a'), slow, 'a')
+        started.wait()
+        writer.write(os.path.join(directory, 'b'), write_text, 'b')
+        blocked = threading.Thread(
+            target=writer.write,
+            args=(os.path.join(directory, 'c'), write_text, 'c'))
+        blocked.start()
+        blocked.join(0.2)
+        assert blocked.is_alive()
+        assert len(writer.pending) == 1
+
+        release.set()
+        blocked.join()
+        writer.flush()
+        assert sorted(os.listdir(directory)) == ['a', 'b', 'c']
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_checkpoint_writer_error():
+    # An error of the writer thread is raised by the next flush, once
+    directory = tempfile.mkdtemp()
+    try:
+        def fail(text_file, text):
+            raise IOError('disk full')
+
+        writer = CheckpointWriter()
+        writer.write(os.path.join(directory, 'best'), fail, 'best')
+        try:
+            writer.flush()
+        except IOError as e:
+            assert str(e) == 'disk full'
+        else:
+            assert False
+        writer.flush()
+        assert os.listdir(directory) == []
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_early_stopping_best():
+    # The best model is written after the first epoch (10 batches) in the
+    # format read by load_parameter_values
+    directory = tempfile.mkdtemp()
+    try:
+        main_loop, _, _ = build_main_loop(12, extensions=[
+            EarlyStopping('train_cost', 2, directory)])
+        main_loop.run()
+        path = os.path.join(directory, 'best')
+        assert main_loop.log[10]['saved_best_to'] == path
+
+        reference, linear, _ = build_main_loop(10)
+        reference.run()
+        values = load_parameter_values(path)
+        assert sorted(values) == ['/linear.W', '/linear.b']
+        assert_allclose(values['/linear.W'], linear.W.get_value())
+        assert_allclose(values['/linear.b'], linear.b.get_value())
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test_resumable_checkpoint()
+    test_write_atomically()
+    test_checkpoint_writer_pending()
+    test_checkpoint_writer_error()
+    test_early_stopping_best()
@@ -1,5 +1,8 @@
 from collections import OrderedDict
 
+import numpy
+from numpy.testing import assert_allclose
+
 import theano
 from theano import tensor
 
@@ -8,10 +11,12 @@ from blocks.bricks import FeedforwardSequence, Tanh
 from blocks.bricks.parallel import Fork
 from blocks.bricks.recurrent import RecurrentStack, SimpleRecurrent
 
-from rnn.bricks import LookupTable, ClockworkBase
-from rnn.datasets.dataset import get_minibatch_char
+from rnn.bricks import LookupTable, ClockworkBase, ClockworkStack
+from rnn.datasets.dataset import get_minibatch, get_output_size
 from rnn.utils import parse_args
 
+floatX = theano.config.floatX
+
 
 def build_fork_lookup(vocab_size, time_length, args):
     x = tensor.lmatrix('features')
@@ -88,6 +93,62 @@ def build_fork_lookup(vocab_size, time_length, args):
     f_h = theano.function([x], h)
     return f_pre_rnn, f_h
 
+
+def test_clockwork_stack():
+    # ClockworkStack computes the same states as the RecurrentStack of
+    # ClockworkBase which switches between the new and the old states
+    dim = 3
+    periods = [1, 2, 4]
+
+    def transitions():
+        return [ClockworkBase(dim=dim, activation=Tanh(), period=period)
+                for period in periods]
+
+    stack = RecurrentStack(
+        transitions(), weights_init=initialization.IsotropicGaussian(0.5),
+        biases_init=initialization.Constant(0))
+    stack.initialize()
+    skipping = ClockworkStack(
+        transitions(), weights_init=initialization.Constant(0),
+        biases_init=initialization.Constant(0))
+    skipping.initialize()
+    for level in range(len(periods)):
+        skipping.transitions[level].W.set_value(
+            stack.transitions[level].W.get_value())
+        if level > 0:
+            skipping.forks[level - 1].children[0].W.set_value(
+                stack.forks[level - 1].children[0].W.get_value())
+
+    x = tensor.tensor3('inputs')
+    mask = tensor.matrix('mask')
+    states = [tensor.matrix('states_' + str(level))
+              for level in range(len(periods))]
+    kwargs = {'inputs': x}
+    for level, level_states in enumerate(states):
+        kwargs[ClockworkStack.suffix('states', level)] = level_states
+    # RecurrentStack returns the states and the time of each level
+    expected = stack.apply(mask=mask, low_memory=True, as_list=True,
+                           **kwargs)[::2]
+    computed = skipping.apply(mask=mask, as_list=True, **kwargs)
+    f = theano.function([x, mask] + states, expected + computed)
+
+    rng = numpy.random.RandomState(1)
+    batch_size = 2
+    initial_states = [rng.randn(batch_size, dim).astype(floatX)
+                      for _ in periods]
+    # The longest period divides 8, but not 7 nor 6
+    for length in [8, 7, 6]:
+        inputs = rng.randn(length, batch_size, dim).astype(floatX)
+        mask_values = numpy.ones((length, batch_size), dtype=floatX)
+        mask_values[-2:, 1] = 0
+        values = f(inputs, mask_values, *initial_states)
+        for expected_states, states_values in zip(
+                values[:len(periods)], values[len(periods):]):
+            assert states_values.shape == (length, batch_size, dim)
+            assert_allclose(states_values, expected_states, rtol=1e-5,
+                            atol=1e-6)
+
+
 if __name__ == "__main__":
     args = parse_args()
 
@@ -97,8 +158,10 @@ if __name__ == "__main__":
     time_length = 10
 
     # Prepare data
-    train_stream, valid_stream, vocab_size = get_minibatch_char(
-        dataset, mini_batch_size, time_length, args.tot_num_char)
+    train_stream, valid_stream = get_minibatch(
+        dataset, mini_batch_size, mini_batch_size, time_length,
+        args.tot_num_char)
+    vocab_size = get_output_size(dataset)
 
     f_pre_rnn, f_h = build_fork_lookup(vocab_size, time_length, args)
     data = next(train_stream.get_epoch_iterator())[1]
@@ -0,0 +1,99 @@
+from argparse import Namespace
+
+import numpy
+from numpy.testing import assert_allclose
+
+import theano
+from theano import tensor
+
+from blocks.filter import VariableFilter
+from blocks.graph import ComputationGraph
+
+from rnn.build_model.build_model_utils import get_costs
+
+floatX = theano.config.floatX
+
+
+def compile_cost(dataset, context):
+    # The cost of given states, the output of the output layer for all the
+    # positions and the gradient of the cost with respect to the states
+    args = Namespace(dataset=dataset, context=context, tbptt_stride=0,
+                     used_inputs=None, rnn_type='simple', layers=1,
+                     state_dim=4, skip_connections=False, skip_output=False)
+    h = tensor.tensor3('h')
+    x_mask = tensor.matrix('mask')
+    cost, unregularized_cost = get_costs(h, x_mask, args)
+
+    cg = ComputationGraph(cost)
+    presoft = VariableFilter(theano_name='presoft')(cg.variables)[0]
+    targets = [v for v in cg.inputs if v.name == 'targets'][0]
+    return theano.function([h, x_mask, targets],
+                           [unregularized_cost, presoft,
+                            tensor.grad(cost, h)])
+
+
+def random_targets(dataset, rng, length, batch):
+    if dataset == 'toy_procedural':
+        return rng.randint(40, size=(length, batch)).astype(numpy.uint8)
+    # The target of the step t is the input of the step t + 1
+    return rng.randn(length - 1, batch, 1).astype(floatX)
+
+
+def test_cross_entropy():
+    # The cost of the gathered rows is the mean cross entropy of the
+    # positions after the context and inside the mask, in bits
+    rng = numpy.random.RandomState(1)
+    f = compile_cost('toy_procedural', context=2)
+    h = rng.randn(6, 3, 4).astype(floatX)
+    mask = numpy.ones((6, 3), dtype=floatX)
+    mask[4:, 1] = 0
+    mask[3:, 2] = 0
+    targets = random_targets('toy_procedural', rng, 6, 3)
+    cost, presoft, _ = f(h, mask, targets)
+
+    log_probabilities = presoft - presoft.max(axis=2)[:, :, None]
+    log_probabilities -= numpy.log(
+        numpy.exp(log_probabilities).sum(axis=2))[:, :, None]
+    cross_entropy = -log_probabilities.reshape((18, 40))[
+        numpy.arange(18), targets.flatten()].reshape((6, 3))
+    y_mask = mask.copy()
+    y_mask[:2] = 0
+    assert_allclose(cost, (cross_entropy * y_mask).sum() / y_mask.sum() /
+                    numpy.log(2), rtol=1e-5)
+
+
+def test_squared_error():
+    # The states of the step t predict the inputs of the step t + 1
+    rng = numpy.random.RandomState(1)
+    f = compile_cost('sine_procedural', context=1)
+    h = rng.randn(6, 3, 4).astype(floatX)
+    mask = numpy.ones((6, 3), dtype=floatX)
+    mask[4:, 1] = 0
+    targets = random_targets('sine_procedural', rng, 6, 3)
+    cost, presoft, _ = f(h, mask, targets)
+
+    y_mask = mask[1:].copy()
+    y_mask[:1] = 0
+    squared_error = ((targets - presoft[:-1]) ** 2).sum(axis=2)
+    assert_allclose(cost, (squared_error * y_mask).sum() / y_mask.sum(),
+                    rtol=1e-5)
+
+
+def test_no_valid_position():
+    # A minibatch of documents shorter than the context has no position in
+    # the cost
+    rng = numpy.random.RandomState(1)
+    for dataset in ['toy_procedural', 'sine_procedural']:
+        f = compile_cost(dataset, context=4)
+        h = rng.randn(6, 3, 4).astype(floatX)
+        mask = numpy.zeros((6, 3), dtype=floatX)
+        mask[:3] = 1
+        cost, _, gradient = f(h, mask, random_targets(dataset, rng, 6, 3))
+        assert cost == 0
+        assert_allclose(gradient, 0)
+
+
+if __name__ == "__main__":
+    test_cross_entropy()
+    test_squared_error()
+    test_no_valid_position()
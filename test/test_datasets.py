@@ -0,0 +1,352 @@
+import argparse
+import os
+import shutil
+import tempfile
+
+import numpy
+from numpy.testing import assert_array_equal
+
+from rnn.datasets.build_corpus import build_corpus, parse_separator
+from rnn.datasets import dataset as dataset_module
+from rnn.datasets.dataset import (CharacterCorpus, DocumentBuckets,
+                                  MappedCorpus, _opened_corpora,
+                                  extract_archive, get_cache_path, get_data,
+                                  get_stream_raw, open_text_corpus)
+from rnn.datasets.procedural import ProceduralDataset, ToyBatches
+from rnn.datasets.vocabulary import Vocabulary
+
+
+def reference_char_minibatches(corpus, time_length, mini_batch_size):
+    # Former implementation of get_stream_char, which copied the corpus
+    nb_mini_batches = corpus.shape[0] / (mini_batch_size * time_length)
+    total_chars = nb_mini_batches * mini_batch_size * time_length
+
+    dataset = corpus[:total_chars]
+    dataset = dataset.reshape(mini_batch_size, total_chars / mini_batch_size)
+    dataset = dataset.T
+
+    targets_dataset = dataset[1:, :]
+    targets_dataset = numpy.concatenate(
+        (targets_dataset,
+         numpy.zeros((1, mini_batch_size)).astype(corpus.dtype)), axis=0)
+
+    dataset = dataset.reshape(nb_mini_batches, time_length, mini_batch_size)
+    targets_dataset = targets_dataset.reshape(
+        nb_mini_batches, time_length, mini_batch_size)
+    return dataset, targets_dataset
+
+
+def test_character_corpus():
+    corpus = numpy.arange(1, 104).astype(numpy.int64)
+    time_length = 7
+    mini_batch_size = 4
+
+    features, targets = reference_char_minibatches(corpus, time_length,
+                                                   mini_batch_size)
+    dataset = CharacterCorpus(corpus, time_length, mini_batch_size)
+
+    assert dataset.num_examples == features.shape[0]
+    for i in range(dataset.num_examples):
+        batch = dataset.get_data(request=i)
+        assert_array_equal(batch[0], features[i])
+        assert_array_equal(batch[1], targets[i])
+
+
+def test_character_corpus_contiguous_offsets():
+    corpus = numpy.arange(1, 104).astype(numpy.uint8)
+    dataset = CharacterCorpus(corpus, 5, 3, offsets='contiguous',
+                              rng=numpy.random.RandomState(1))
+
+    state = dataset.open()
+    batches = [dataset.get_data(state, i)
+               for i in range(dataset.num_examples)]
+    features = numpy.concatenate([batch[0] for batch in batches])
+    targets = numpy.concatenate([batch[1] for batch in batches])
+
+    # Each column is a contiguous piece of the corpus
+    assert_array_equal(numpy.diff(features, axis=0), 1)
+    assert_array_equal(targets, features + 1)
+    assert features.dtype == numpy.uint8
+
+
+def test_character_corpus_stride():
+    corpus = numpy.arange(1, 104).astype(numpy.uint8)
+    dataset = CharacterCorpus(corpus, 6, 3, stride=2)
+
+    # Each column holds 30 characters, with windows starting every 2 steps
+    assert dataset.num_examples == 13
+    for i in range(dataset.num_examples):
+        features, targets = dataset.get_data(request=i)
+        assert_array_equal(features[:, 0], corpus[2 * i:2 * i + 6])
+        assert_array_equal(features[:, 2], corpus[60 + 2 * i:66 + 2 * i])
+        assert_array_equal(targets[:-1], features[1:])
+
+
+def reference_raw_minibatches(data, mini_batch_size):
+    # Former implementation of get_stream_raw, which copied the array
+    time, batch, features = data.shape
+    nb_mini_batches = batch / mini_batch_size
+    data = data[:, :nb_mini_batches * mini_batch_size, :]
+    targets = data[1:, :, :]
+
+    data = numpy.swapaxes(data, 0, 1)
+    targets = numpy.swapaxes(targets, 0, 1)
+    data = numpy.reshape(data, (nb_mini_batches, mini_batch_size, time,
+                                features))
+    targets = numpy.reshape(targets, (nb_mini_batches, mini_batch_size,
+                                      time - 1, features))
+    return numpy.swapaxes(data, 1, 2), numpy.swapaxes(targets, 1, 2)
+
+
+def test_raw_sequences():
+    # The sequences have the same length: the minibatches are neither
+    # padded nor masked, and the last incomplete minibatch is dropped
+    time, batch, size = 6, 11, 2
+    data = numpy.arange(time * batch * size, dtype=numpy.float32).reshape(
+        (time, batch, size))
+    _opened_corpora['sine'] = {'train': data}
+    try:
+        stream = get_stream_raw('sine', 'train', 4)
+        assert stream.sources == ('features', 'targets')
+        batches = list(stream.get_epoch_iterator())
+    finally:
+        del _opened_corpora['sine']
+
+    features, targets = reference_raw_minibatches(data, 4)
+    assert len(batches) == len(features) == 2
+    for i, (batch_features, batch_targets) in enumerate(batches):
+        assert batch_features.shape == (time, 4, size)
+        assert batch_targets.shape == (time - 1, 4, size)
+        assert_array_equal(batch_features, features[i])
+        assert_array_equal(batch_targets, targets[i])
+        # The sequences `[4 i, 4 i + 4)`, as views of the array
+        assert_array_equal(batch_features[0, :, 0],
+                           data[0, 4 * i:4 * i + 4, 0])
+        assert_array_equal(batch_targets, batch_features[1:])
+        assert numpy.may_share_memory(batch_features, data)
+        assert numpy.may_share_memory(batch_targets, data)
+
+
+def test_document_buckets():
+    corpus = numpy.arange(30).astype(numpy.uint8)
+    offsets = [0, 3, 10, 12, 13, 30]
+    dataset = DocumentBuckets(corpus, offsets, 5, 2, bucket_batches=4,
+                              rng=numpy.random.RandomState(1))
+
+    # The documents are cut into pieces of at most 5 steps, the document
+    # of a single character has no step
+    assert_array_equal(dataset.starts, [0, 3, 8, 10, 13, 18, 23, 28])
+    assert_array_equal(dataset.lengths, [2, 5, 1, 1, 5, 5, 5, 1])
+    assert dataset.num_examples == 4
+
+    state = dataset.open()
+    starts = []
+    padded_steps = 0
+    for i in range(dataset.num_examples):
+        features, targets, mask = dataset.get_data(state, i)
+        assert features.shape == targets.shape == mask.shape
+        assert mask.dtype == numpy.float32
+        assert_array_equal(mask.max(axis=1), 1)
+        assert_array_equal((targets - features) * mask, mask)
+        starts.extend(features[0])
+        padded_steps += mask.size
+    assert_array_equal(sorted(starts), dataset.starts)
+    # The pieces of a minibatch have similar lengths
+    assert padded_steps == 26
+
+
+def test_vocabulary():
+    vocab = Vocabulary(['e', ' ', 't', 'h'])
+    codes = vocab.encode("the het")
+    assert_array_equal(codes, [2, 3, 0, 1, 3, 0, 2])
+    assert codes.dtype == numpy.uint8
+    assert vocab.decode_text(codes) == "the het"
+
+    numbers = Vocabulary(numpy.arange(300).astype(str))
+    codes = numbers.encode(['12', '299', '0'])
+    assert_array_equal(codes, [12, 299, 0])
+    assert codes.dtype == numpy.uint16
+
+    # The NUL byte reads as '' from a S1 array
+    nul = Vocabulary(numpy.array(['a', '\x00']))
+    codes = nul.encode("a\x00\x00a")
+    assert_array_equal(codes, [0, 1, 1, 0])
+    assert nul.decode_text(codes) == "a\x00\x00a"
+
+
+def test_build_corpus():
+    directory = tempfile.mkdtemp()
+    try:
+        train_path = os.path.join(directory, 'train.txt')
+        valid_path = os.path.join(directory, 'valid.txt')
+        with open(train_path, 'w') as text_file:
+            text_file.write("abracadabra")
+        with open(valid_path, 'w') as text_file:
+            text_file.write("cabrac\x00")
+        corpus_path = os.path.join(directory, 'corpus')
+        os.mkdir(corpus_path)
+        build_corpus(corpus_path, train_path, valid_path, block_size=4)
+
+        corpus = MappedCorpus(corpus_path)
+        assert_array_equal(corpus['vocab'].view(numpy.uint8),
+                           [ord(char) for char in "abcr\x00d"])
+        assert corpus['vocab_size'] == 6
+        assert_array_equal(corpus['train'],
+                           [0, 1, 3, 0, 2, 0, 5, 0, 1, 3, 0])
+        assert_array_equal(corpus['test'], [2, 0, 1, 3, 0, 2, 4])
+        assert corpus['train'].dtype == numpy.uint8
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_build_corpus_documents():
+    directory = tempfile.mkdtemp()
+    try:
+        train_path = os.path.join(directory, 'train.txt')
+        valid_path = os.path.join(directory, 'valid.txt')
+        with open(train_path, 'w') as text_file:
+            text_file.write("ab\nabc\n")
+        with open(valid_path, 'w') as text_file:
+            text_file.write("a\n\nb")
+        corpus_path = os.path.join(directory, 'corpus')
+        os.mkdir(corpus_path)
+        build_corpus(corpus_path, train_path, valid_path,
+                     document_separator='\n', block_size=4)
+
+        corpus = MappedCorpus(corpus_path)
+        assert_array_equal(corpus['train_offsets'], [0, 3, 7])
+        assert_array_equal(corpus['valid_offsets'], [0, 2, 3, 4])
+    finally:
+        shutil.rmtree(directory)
+
+
+def set_cache_path(path):
+    # Sets the RNN_CACHE_PATH environment variable, returns its former value
+    former = os.environ.get('RNN_CACHE_PATH')
+    if path is None:
+        os.environ.pop('RNN_CACHE_PATH', None)
+    else:
+        os.environ['RNN_CACHE_PATH'] = path
+    return former
+
+
+def test_extract_archive():
+    directory = tempfile.mkdtemp()
+    former = set_cache_path(os.path.join(directory, 'cache', 'npy'))
+    try:
+        path = os.path.join(directory, 'data.npz')
+        train = numpy.arange(1 << 21) % 7
+        numpy.savez(path, train=train, valid=numpy.arange(5),
+                    vocab_size=numpy.array(7))
+
+        # The missing cache directory is created
+        cache_path = get_cache_path(path)
+        assert cache_path.startswith(os.environ['RNN_CACHE_PATH'])
+        extract_archive(path, cache_path)
+        assert sorted(os.listdir(os.path.dirname(cache_path))) == [
+            os.path.basename(cache_path)]
+        corpus = MappedCorpus(cache_path)
+        assert corpus['train'].dtype == numpy.uint8
+        assert isinstance(corpus['train'], numpy.memmap)
+        assert_array_equal(corpus['train'], train)
+        assert_array_equal(corpus['valid'], numpy.arange(5))
+        assert corpus['vocab_size'] == 7
+
+        # The cache of another version of the layout is not used
+        version = dataset_module.CACHE_VERSION
+        dataset_module.CACHE_VERSION = version + 1
+        try:
+            assert not os.path.exists(get_cache_path(path))
+        finally:
+            dataset_module.CACHE_VERSION = version
+    finally:
+        set_cache_path(former)
+        shutil.rmtree(directory)
+
+
+def test_open_text_corpus():
+    # The corpus is built once and registered, it is only mapped again
+    # when the files are opened again
+    directory = tempfile.mkdtemp()
+    former = set_cache_path(os.path.join(directory, 'cache'))
+    try:
+        train_path = os.path.join(directory, 'train.txt')
+        valid_path = os.path.join(directory, 'valid.txt')
+        with open(train_path, 'w') as text_file:
+            text_file.write("abcab")
+        with open(valid_path, 'w') as text_file:
+            text_file.write("ba")
+
+        corpus = open_text_corpus('mytext', train_path, valid_path)
+        assert get_data('mytext') is corpus
+        cache_files = os.listdir(os.environ['RNN_CACHE_PATH'])
+        assert len(cache_files) == 1
+        train_file = os.path.join(corpus.path, 'train.npy')
+        mtime = os.stat(train_file).st_mtime
+
+        reopened = open_text_corpus('mytext', train_path, valid_path)
+        assert get_data('mytext') is reopened
+        assert reopened.path == corpus.path
+        assert os.listdir(os.environ['RNN_CACHE_PATH']) == cache_files
+        assert os.stat(train_file).st_mtime == mtime
+        vocab = corpus['vocab']
+        assert ''.join(vocab[reopened['train']]) == "abcab"
+    finally:
+        _opened_corpora.pop('mytext', None)
+        set_cache_path(former)
+        shutil.rmtree(directory)
+
+
+def test_parse_separator():
+    assert parse_separator('\\n') == '\n'
+    assert parse_separator('\\x00') == '\x00'
+    assert parse_separator('10') == '\n'
+    assert parse_separator(';') == ';'
+    for value in ['\\n\\n', '256', '', '\\x0']:
+        try:
+            parse_separator(value)
+        except argparse.ArgumentTypeError:
+            pass
+        else:
+            assert False
+
+
+def test_procedural_dataset():
+    # The minibatch `i` of the epoch `e` is generated from the seed
+    # `(seed, e, i)`, whatever the workers and the order of the requests
+    generate = ToyBatches(6, 3)
+    for workers in [0, 2]:
+        for fresh_epochs in [True, False]:
+            dataset = ProceduralDataset(generate, 4, 1,
+                                        fresh_epochs=fresh_epochs,
+                                        workers=workers)
+            state = dataset.open()
+            batches = [dataset.get_data(state, i) for i in [0, 3, 1, 2]]
+            state = dataset.next_epoch(state)
+            batches.append(dataset.get_data(state, 2))
+            dataset.close(state)
+            assert dataset.pool is None
+
+            seeds = [[1, 0, i] for i in [0, 3, 1, 2]]
+            seeds.append([1, int(fresh_epochs), 2])
+            for batch, seed in zip(batches, seeds):
+                features, targets = generate(seed)
+                assert_array_equal(batch[0], features)
+                assert_array_equal(batch[1], targets)
+    assert not numpy.array_equal(generate([1, 0, 2])[0],
+                                 generate([1, 1, 2])[0])
+
+
+if __name__ == "__main__":
+    test_character_corpus()
+    test_character_corpus_contiguous_offsets()
+    test_character_corpus_stride()
+    test_raw_sequences()
+    test_document_buckets()
+    test_vocabulary()
+    test_build_corpus()
+    test_build_corpus_documents()
+    test_extract_archive()
+    test_open_text_corpus()
+    test_parse_separator()
+    test_procedural_dataset()
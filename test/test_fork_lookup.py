@@ -1,14 +1,22 @@
+import numpy
+from numpy.testing import assert_allclose
+
 import theano
 from theano import tensor
 
 from blocks import initialization
 from blocks.bricks import FeedforwardSequence
 from blocks.bricks.parallel import Fork
+from blocks.model import Model
 
-from rnn.bricks import LookupTable
-from rnn.datasets.dataset import get_minibatch_char
+from rnn.bricks import FusedLookupTable, LookupTable
+from rnn.build_model.build_model_utils import (FUSED_LOOKUP_NAME,
+                                               fuse_lookup_parameters)
+from rnn.datasets.dataset import get_minibatch, get_output_size
 from rnn.utils import parse_args
 
+floatX = theano.config.floatX
+
 
 def build_fork_lookup(vocab_size, args):
     x = tensor.lmatrix('features')
@@ -49,6 +57,65 @@ def build_fork_lookup(vocab_size, args):
     f = theano.function([x], pre_rnn)
     return f
 
+
+def test_fused_lookup_table():
+    # The fused table, with the parameters of a Fork of lookup tables
+    # converted by fuse_lookup_parameters, gives the same representations
+    vocab_size = 7
+    # The Fork gives the dimension of the prototype to all its outputs
+    dims = [3, 3, 3]
+    x = tensor.matrix('features', dtype='uint8')
+
+    lookup = LookupTable(length=vocab_size, dim=dims[0])
+    fork = Fork(output_names=['inputs', 'inputs#1', 'inputs#2'],
+                input_dim=vocab_size, output_dims=dims,
+                prototype=FeedforwardSequence([lookup.apply]),
+                weights_init=initialization.IsotropicGaussian(0.1),
+                biases_init=initialization.IsotropicGaussian(0.1))
+    fork.initialize()
+    expected = fork.apply(x)
+
+    fused = FusedLookupTable(length=vocab_size, dims=dims,
+                             name=FUSED_LOOKUP_NAME,
+                             weights_init=initialization.Constant(0),
+                             biases_init=initialization.Constant(0))
+    fused.initialize()
+    computed = fused.apply(x, as_list=True)
+    Model(computed).set_parameter_values(
+        fuse_lookup_parameters(Model(expected).get_parameter_values()))
+
+    f = theano.function([x], expected + computed)
+    indices = numpy.random.RandomState(1).randint(
+        vocab_size, size=(5, 2)).astype('uint8')
+    values = f(indices)
+    for expected_values, computed_values in zip(values[:3], values[3:]):
+        assert computed_values.shape == expected_values.shape
+        assert_allclose(computed_values, expected_values, rtol=1e-6)
+
+
+def test_fuse_lookup_parameters():
+    W = [numpy.ones((4, 2)), 2 * numpy.ones((4, 3))]
+    b = [numpy.arange(2), numpy.arange(3)]
+    W_rnn = numpy.zeros((2, 2))
+    # Older models use "_1", numpy.savez writes "-" as brick delimiter
+    param_values = {
+        '-fork-fork_inputs_1-lookuptable.W_lookup': W[1],
+        '-fork-fork_inputs_1-lookuptable.b_lookup': b[1],
+        '-fork-fork_inputs-lookuptable.W_lookup': W[0],
+        '-fork-fork_inputs-lookuptable.b_lookup': b[0],
+        '-recurrentstack-simplerecurrent#0.W_state': W_rnn}
+    fused = fuse_lookup_parameters(param_values)
+    assert sorted(fused) == ['-recurrentstack-simplerecurrent#0.W_state',
+                             '/' + FUSED_LOOKUP_NAME + '.W_lookup']
+    assert_allclose(fused['/' + FUSED_LOOKUP_NAME + '.W_lookup'],
+                    numpy.concatenate([W[0] + b[0], W[1] + b[1]], axis=1))
+    assert fused['-recurrentstack-simplerecurrent#0.W_state'] is W_rnn
+
+    # Parameters without separate tables are unchanged
+    unchanged = fuse_lookup_parameters({'a': W_rnn})
+    assert list(unchanged) == ['a'] and unchanged['a'] is W_rnn
+
+
 if __name__ == "__main__":
     args = parse_args()
 
@@ -58,8 +125,10 @@ if __name__ == "__main__":
     time_length = 5
 
     # Prepare data
-    train_stream, valid_stream, vocab_size = get_minibatch_char(
-        dataset, mini_batch_size, time_length, args.tot_num_char)
+    train_stream, valid_stream = get_minibatch(
+        dataset, mini_batch_size, mini_batch_size, time_length,
+        args.tot_num_char)
+    vocab_size = get_output_size(dataset)
 
     f = build_fork_lookup(vocab_size, args)
     data = next(train_stream.get_epoch_iterator())[1]
@@ -0,0 +1,88 @@
+import numpy
+from numpy.testing import assert_allclose, assert_array_equal
+
+from rnn.datasets.generate_toy_dataset import GenerateToy
+from rnn.datasets.generate_xml import GenerateXML
+
+
+def reference_toy_lane(gen, draws):
+    # Former sequential implementation of GenerateToy.generate, which
+    # takes the uniform draws of each step instead of calling np.random
+    stack = [0]
+    generated = [0]
+    score = 0
+    probability = numpy.array([1 - gen.continue_prob, gen.continue_prob, 0.])
+    for choice_draw, char_draw in draws:
+        probability[0] = (1 - gen.continue_prob) * \
+            (1 - stack[-1] / (gen.depth - 1.))
+        probability[2] = (1 - gen.continue_prob) * \
+            (stack[-1] / (gen.depth - 1.))
+        choice = numpy.searchsorted(numpy.cumsum(probability), choice_draw,
+                                    side='right')
+
+        if choice == 1:
+            generated.append(stack[-1])
+            score += numpy.log2(gen.continue_prob)
+        elif choice == 2:
+            # The bottom of the stack is never closed
+            assert len(stack) > 1
+            stack.pop()
+            generated.append(stack[-1])
+            score += numpy.log2(probability[2])
+        else:
+            score += numpy.log2(probability[1] / (gen.depth - stack[-1]))
+            new_char = stack[-1] + int(char_draw * (gen.depth - stack[-1]))
+            stack.append(new_char)
+            generated.append(new_char)
+    return generated, score
+
+
+def test_generate_toy():
+    length = 200
+    batch = 4
+    gen = GenerateToy(0.5, 5)
+    rng = numpy.random.RandomState(1)
+    draws = numpy.array([rng.uniform(size=(2, batch))
+                         for _ in range(length)])
+
+    generated, best_score = gen.generate_batch(
+        length, batch, numpy.random.RandomState(1))
+
+    score = 0
+    for lane in range(batch):
+        expected, lane_score = reference_toy_lane(gen, draws[:, :, lane])
+        assert_array_equal(generated[:, lane], expected)
+        score += lane_score
+    assert_allclose(best_score, - score / (length * batch))
+
+
+def test_generate_xml():
+    length = 100
+    batch = 3
+    depth = 4
+    gen = GenerateXML(depth, 2, 5)
+    chars, lane_starts, string_length = gen.generate_batch(
+        length, batch, numpy.random.RandomState(1))
+    assert string_length == len(chars)
+
+    text = chars.tostring()
+    lane_ends = list(lane_starts[1:]) + [len(text)]
+    for start, end in zip(lane_starts, lane_ends):
+        # Each process writes `length` tags, and closes a tag only if it is
+        # the last one opened
+        tags = text[start:end].split()
+        assert len(tags) == length
+        stack = []
+        for tag in tags:
+            assert tag[0] == '<' and tag[-1] == '>'
+            if tag[1] == '/':
+                assert stack and stack.pop() == tag[2:-1]
+            else:
+                assert 2 <= len(tag[1:-1]) < 5
+                stack.append(tag[1:-1])
+            assert len(stack) <= depth
+
+
+if __name__ == "__main__":
+    test_generate_toy()
+    test_generate_xml()
@@ -0,0 +1,143 @@
+import os
+import signal
+from argparse import Namespace
+
+import numpy
+
+import theano
+
+from rnn.datasets.dataset import _opened_corpora
+from rnn.parallel import (Barrier, BrokenBarrierError, ParameterAveraging,
+                          get_shard_stream)
+
+floatX = theano.config.floatX
+
+
+def wait_broken(barrier, check=None):
+    try:
+        barrier.wait(check)
+    except BrokenBarrierError:
+        return True
+    return False
+
+
+def test_barrier():
+    barrier = Barrier(2)
+    pid = os.fork()
+    if pid == 0:
+        barrier.wait()
+        os._exit(0)
+    barrier.wait()
+    assert os.waitpid(pid, 0)[1] == 0
+
+
+def test_barrier_dead_process():
+    barrier = Barrier(2)
+    pid = os.fork()
+    if pid == 0:
+        # Dies without reaching the barrier
+        os._exit(1)
+
+    def alive():
+        ended, _ = os.waitpid(pid, os.WNOHANG)
+        return not ended
+
+    assert wait_broken(barrier, alive)
+    # The next processes do not wait either
+    assert wait_broken(barrier)
+
+
+def test_barrier_abort():
+    barrier = Barrier(3)
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if wait_broken(barrier) else 1)
+    barrier.abort()
+    assert os.waitpid(pid, 0)[1] == 0
+
+
+def fork_averaging(values):
+    # A parameter averaged by the workers, with the value `values[i]` in
+    # the worker `i`
+    averaging = ParameterAveraging(
+        [theano.shared(numpy.zeros(values.shape[1:], dtype=floatX))],
+        values.shape[0])
+    worker = averaging.fork()
+    if worker > 0:
+        # A blocked worker is killed instead of blocking the test
+        signal.alarm(10)
+    averaging.parameters[0].set_value(values[worker].astype(floatX))
+    averaging.main_loop = Namespace(log=Namespace(current_row={}))
+    return averaging, worker
+
+
+def end_worker(worker, success):
+    if worker > 0:
+        os._exit(0 if success else 1)
+
+
+def test_parameter_averaging():
+    values = numpy.random.RandomState(1).rand(2, 3, 4)
+    averaging, worker = fork_averaging(values)
+    averaging.do('after_batch')
+    success = numpy.allclose(averaging.parameters[0].get_value(),
+                             values.mean(axis=0))
+    averaging.do('after_training')
+    end_worker(worker, success)
+
+    assert success
+    # Raises if the other worker failed
+    averaging.join()
+
+
+def test_parameter_averaging_stop():
+    # The first worker stops, the other one stops after the same averaging
+    # step instead of waiting for it in the next one
+    values = numpy.random.RandomState(1).rand(2, 3)
+    averaging, worker = fork_averaging(values)
+    if worker == 0:
+        averaging.do('after_training')
+        success = True
+    else:
+        averaging.do('after_batch')
+        current_row = averaging.main_loop.log.current_row
+        success = current_row.get('training_finish_requested', False)
+        averaging.do('after_training')
+    success = success and numpy.allclose(
+        averaging.parameters[0].get_value(), values.mean(axis=0))
+    end_worker(worker, success)
+
+    assert success
+    averaging.join()
+
+
+def test_shard_stream():
+    # The workers read disjoint columns of the corpus
+    _opened_corpora['mytext'] = {'train': numpy.arange(1000)}
+    try:
+        for offsets in ['fixed', 'contiguous']:
+            args = Namespace(dataset='mytext', time_length=5,
+                             mini_batch_size=3, tot_num_char=None,
+                             batch_offsets=offsets, tbptt_stride=0,
+                             workers=3, prefetch=0)
+            shards = []
+            for worker in range(args.workers):
+                stream = get_shard_stream(args, worker)
+                shards.append(numpy.concatenate(
+                    [features.flatten()
+                     for features, _ in stream.get_epoch_iterator()]))
+            for i, shard in enumerate(shards):
+                assert len(shard) == len(shards[0]) > 0
+                for other in shards[i + 1:]:
+                    assert not set(shard) & set(other)
+    finally:
+        del _opened_corpora['mytext']
+
+
+if __name__ == "__main__":
+    test_barrier()
+    test_barrier_dead_process()
+    test_barrier_abort()
+    test_parameter_averaging()
+    test_parameter_averaging_stop()
+    test_shard_stream()
@@ -0,0 +1,105 @@
+import os
+import threading
+
+import numpy
+
+import theano
+from theano import tensor
+
+from blocks import initialization
+from blocks.algorithms import Scale
+from blocks.bricks import Linear
+from blocks.extensions import FinishAfter
+from blocks.graph import ComputationGraph
+from blocks.main_loop import MainLoop
+from blocks.model import Model
+
+from fuel.datasets import IndexableDataset
+from fuel.schemes import SequentialScheme
+from fuel.streams import DataStream
+
+from rnn.parameter_server import (AsyncGradientDescent, ParameterClient,
+                                  ParameterServer, ParameterServerTCPServer)
+
+floatX = theano.config.floatX
+WEIGHTS = numpy.array([[1.], [-2.], [0.5]], dtype=floatX)
+
+
+def get_data(worker):
+    features = numpy.random.RandomState(worker).rand(40, 3).astype(floatX)
+    return features, features.dot(WEIGHTS)
+
+
+def run_worker(address, worker, iterations):
+    x = tensor.matrix('features')
+    y = tensor.matrix('targets')
+    linear = Linear(input_dim=3, output_dim=1,
+                    weights_init=initialization.Constant(0),
+                    biases_init=initialization.Constant(0))
+    linear.initialize()
+    cost = tensor.sqr(linear.apply(x) - y).mean()
+    cost.name = 'cost'
+
+    features, targets = get_data(worker)
+    stream = DataStream(
+        IndexableDataset({'features': features, 'targets': targets}),
+        iteration_scheme=SequentialScheme(40, 4))
+    algorithm = AsyncGradientDescent(
+        client=ParameterClient(address), worker=worker, max_staleness=2,
+        cost=cost, parameters=ComputationGraph(cost).parameters)
+    MainLoop(algorithm, stream, model=Model(cost),
+             extensions=[FinishAfter(after_n_batches=iterations)]).run()
+    algorithm.client.close()
+
+
+def test_parameter_server():
+    parameter_server = ParameterServer(Scale(0.1), max_staleness=2)
+    server = ParameterServerTCPServer(('127.0.0.1', 0), parameter_server)
+    address = server.server_address
+
+    # Two workers in local processes
+    pids = []
+    for worker in range(2):
+        pid = os.fork()
+        if pid == 0:
+            server.socket.close()
+            try:
+                run_worker(address, worker, 100)
+            except BaseException:
+                os._exit(1)
+            os._exit(0)
+        pids.append(pid)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        for pid in pids:
+            assert os.waitpid(pid, 0)[1] == 0
+
+        client = ParameterClient(address)
+        stats = client.get_stats()
+        assert sorted(stats) == ['0', '1']
+        rejected = sum(worker['rejected'] for worker in stats.values())
+        version, values = client.pull()
+        assert version == 200 - rejected
+        weights, = [value for value in values if value.shape == (3, 1)]
+        biases, = [value for value in values if value.shape == (1,)]
+        for worker in range(2):
+            features, targets = get_data(worker)
+            error = features.dot(weights) + biases - targets
+            assert (error ** 2).mean() < 0.01 * (targets ** 2).mean()
+
+        # The workers are told that the training is over
+        client.stop()
+        accepted, _, stopped = client.push(
+            2, version, [numpy.zeros_like(value) for value in values])
+        assert accepted and stopped
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    test_parameter_server()
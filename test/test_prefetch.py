@@ -0,0 +1,75 @@
+from collections import OrderedDict
+
+import numpy
+from numpy.testing import assert_array_equal
+
+from fuel.datasets import IndexableDataset
+from fuel.schemes import SequentialScheme
+from fuel.streams import DataStream
+from fuel.transformers import Mapping
+
+from rnn.datasets.prefetch import PrefetchingDataStream
+
+
+def build_stream(examples=20, batch_size=2):
+    features = numpy.arange(3 * examples).reshape((examples, 3))
+    dataset = IndexableDataset(OrderedDict([('features', features)]))
+    return DataStream(dataset,
+                      iteration_scheme=SequentialScheme(examples, batch_size))
+
+
+def test_prefetch_order():
+    stream = build_stream()
+    prefetching = PrefetchingDataStream(build_stream(), prefetch=3)
+    assert prefetching.sources == stream.sources
+    for _ in range(2):
+        expected = list(stream.get_epoch_iterator())
+        batches = list(prefetching.get_epoch_iterator())
+        assert len(batches) == len(expected) == 10
+        for batch, expected_batch in zip(batches, expected):
+            assert_array_equal(batch[0], expected_batch[0])
+    prefetching.close()
+
+
+def test_prefetch_exception():
+    # An error of the wrapped stream is raised by the consumer, after the
+    # minibatches read before it
+    def fail(data):
+        if data[0][0, 0] == 12:
+            raise ValueError('corrupted minibatch')
+        return data
+
+    stream = PrefetchingDataStream(Mapping(build_stream(), fail), prefetch=2)
+    iterator = stream.get_epoch_iterator()
+    for i in range(2):
+        assert next(iterator)[0][0, 0] == 6 * i
+    try:
+        next(iterator)
+    except ValueError as e:
+        assert str(e) == 'corrupted minibatch'
+    else:
+        assert False
+    stream.close()
+
+
+def test_prefetch_abandoned_epoch():
+    # The producer is blocked on a full queue when the epoch is abandoned,
+    # it is stopped by the next epoch and by close
+    stream = PrefetchingDataStream(build_stream(), prefetch=1)
+    threads = []
+    for _ in range(3):
+        iterator = stream.get_epoch_iterator()
+        assert not any(thread.is_alive() for thread in threads)
+        threads.append(stream._thread)
+        assert_array_equal(next(iterator)[0][0], [0, 1, 2])
+        threads[-1].join(0.5)
+        assert threads[-1].is_alive()
+    stream.close()
+    assert not any(thread.is_alive() for thread in threads)
+    assert stream._thread is None
+
+
+if __name__ == "__main__":
+    test_prefetch_order()
+    test_prefetch_exception()
+    test_prefetch_abandoned_epoch()
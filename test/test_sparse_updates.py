@@ -0,0 +1,59 @@
+from argparse import Namespace
+from collections import OrderedDict
+
+import numpy
+from numpy.testing import assert_allclose
+
+import theano
+from theano import tensor
+
+from rnn.sparse_updates import LOOKUP_NAME, sparse_lookup_updates
+from rnn.train import learning_algorithm
+
+floatX = theano.config.floatX
+
+
+def build_update(args, sparse):
+    table = theano.shared(
+        numpy.random.RandomState(1).randn(6, 3).astype(floatX),
+        name=LOOKUP_NAME)
+    indices = tensor.lvector('indices')
+    cost = tensor.sqr(table[indices] - 1).sum()
+
+    if sparse:
+        dense_parameters, updates = sparse_lookup_updates(cost, [table],
+                                                          args)
+        assert not dense_parameters
+    else:
+        gradients = OrderedDict([(table, tensor.grad(cost, table))])
+        steps, updates = learning_algorithm(args).compute_steps(gradients)
+        updates = [(table, table - steps[table])] + updates
+    return table, theano.function([indices], [], updates=updates)
+
+
+def test_sparse_lookup_updates():
+    # The rows which are not gathered have a zero gradient, so the step of
+    # the dense rules is zero on these rows and the lazy updates of the
+    # gathered rows give the same table. As there is a single table, the
+    # clipping of its rows is also the clipping of the global norm.
+    indices = numpy.array([1, 3, 3, 0])
+    for algorithm in ['sgd', 'adam', 'rms_prop']:
+        for clipping in [1e5, 1.]:
+            args = Namespace(algorithm=algorithm, learning_rate=0.01,
+                             momentum=0.9, clipping=clipping)
+            dense_table, dense_update = build_update(args, sparse=False)
+            sparse_table, sparse_update = build_update(args, sparse=True)
+            initial = sparse_table.get_value()
+            for _ in range(3):
+                dense_update(indices)
+                sparse_update(indices)
+                assert_allclose(sparse_table.get_value(),
+                                dense_table.get_value(), rtol=1e-4,
+                                atol=1e-6)
+            # The rows which are not gathered are not changed
+            assert_allclose(sparse_table.get_value()[[2, 4, 5]],
+                            initial[[2, 4, 5]])
+
+
+if __name__ == "__main__":
+    test_sparse_lookup_updates()
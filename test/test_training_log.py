@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+from argparse import Namespace
+
+import numpy
+from numpy.testing import assert_allclose, assert_array_equal
+
+from blocks.log import TrainingLog
+
+from rnn.training_log import JsonLinesLog, load_log
+
+
+def start_log(path, iterations_done=0, buffer_rows=100):
+    # A log extension of a main loop, which is resumed after
+    # `iterations_done` iterations
+    log = TrainingLog()
+    log.status['iterations_done'] = iterations_done
+    extension = JsonLinesLog(path, buffer_rows=buffer_rows)
+    extension.main_loop = Namespace(log=log)
+    extension.do('before_training')
+    return extension, log
+
+
+def run_batches(extension, log, iterations):
+    for iteration in iterations:
+        log.status['iterations_done'] = iteration
+        log.current_row['cost'] = iteration / 10.
+        if iteration % 2 == 0:
+            log.current_row['saved_best_to'] = 'best'
+        extension.do('after_batch')
+
+
+def test_write_load():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'log.jsonl')
+        extension, log = start_log(path, buffer_rows=2)
+        run_batches(extension, log, range(1, 6))
+        extension.do('after_training')
+
+        history = load_log(path)
+        assert_array_equal(history['iteration'], range(1, 6))
+        assert_allclose(history['cost'], numpy.arange(1, 6) / 10.)
+        assert list(history['saved_best_to']) == [None, 'best', None, 'best',
+                                                  None]
+        assert numpy.all(numpy.diff(history['wall_time']) >= 0)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_failed_training():
+    # The buffered rows are written when the training fails
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'log.jsonl')
+        extension, log = start_log(path)
+        run_batches(extension, log, range(1, 4))
+        assert not os.path.exists(path)
+        extension.do('on_error', ValueError())
+        assert_array_equal(load_log(path)['iteration'], range(1, 4))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_resumed_log():
+    # A training resumed from the checkpoint of the iteration 4 writes
+    # again the rows after it, and drops the incomplete last line
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'log.jsonl')
+        extension, log = start_log(path)
+        run_batches(extension, log, range(1, 7))
+        extension.do('on_interrupt')
+        with open(path, 'a') as log_file:
+            log_file.write('{"cost": 0.')
+
+        extension, log = start_log(path, iterations_done=4)
+        assert_array_equal(load_log(path)['iteration'], range(1, 4))
+        run_batches(extension, log, range(5, 8))
+        extension.do('after_training')
+        history = load_log(path)
+        assert_array_equal(history['iteration'], [1, 2, 3, 5, 6, 7])
+        assert_allclose(history['cost'], [.1, .2, .3, .5, .6, .7])
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    test_write_load()
+    test_failed_training()
+    test_resumed_log()